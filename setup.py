@@ -16,7 +16,7 @@ setup(
         'gisterical': 'src/gisterical',
         },
     package_data={
-        'gisterical': ['data/countries.geojson', 'data/worldcities.csv']
+        'gisterical': ['data/countries.geojson', 'data/worldcities.csv', 'settings/settings.json']
     },
     url='https://github.com/pavelcherepan/gisterical',
     long_description=long_description,
@@ -36,11 +36,13 @@ setup(
           'attrs',
           'ImageHash',
           'Pillow',
+          'numpy',
+          'scipy',
           'psycopg2-binary>=2.8'
       ],
     entry_points={
         "console_scripts": [
-            "gisterical=gisterical:main",
+            "gisterical=gisterical.main:main",
         ],
     },
 )
\ No newline at end of file
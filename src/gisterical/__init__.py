@@ -1,4 +1,10 @@
-from gisterical.main import main
+def __getattr__(name: str):
+    # the command line is only imported when it's used, importing the package
+    # or one of its modules doesn't parse arguments or load the settings
+    if name == "main":
+        from gisterical.main import main
 
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+        # replaces the gisterical.main submodule set by the import, as before
+        globals()["main"] = main
+        return main
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,4 @@
+from gisterical.main import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+from pathlib import Path
+from itertools import islice
+from collections.abc import Mapping
+from typing import Iterable, Iterator
+
+import numpy as np
+
+
+_BUILD_CHUNK = 65536
+
+
+class ColumnarMetadata:
+    """Sort metadata of many images held in a few flat arrays instead of a
+    ``FileMeta`` object per image.
+
+    Paths are stored as one UTF-8 buffer with offsets, dates as
+    ``datetime64`` and countries, cities and geohashes as integer codes into
+    lists of distinct names, so memory grows by a few dozen bytes per image.
+    """
+
+    def __init__(
+        self,
+        path_buffer: bytes,
+        path_offsets: np.ndarray,
+        timestamp: np.ndarray,
+        country_codes: np.ndarray,
+        country_names: list[str],
+        city_codes: np.ndarray,
+        city_names: list[str],
+        geohash_codes: np.ndarray,
+        geohash_names: list[str],
+    ):
+        self.path_buffer = path_buffer
+        self.path_offsets = path_offsets
+        self.timestamp = timestamp
+        self.country_codes = country_codes
+        self.country_names = country_names
+        self.city_codes = city_codes
+        self.city_names = city_names
+        self.geohash_codes = geohash_codes
+        self.geohash_names = geohash_names
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple]) -> "ColumnarMetadata":
+        """Build from (path, date, country, city, geohash) rows, e.g. straight
+        from a database cursor, converting them a chunk at a time.
+
+        Countries, cities and geohashes are coded by their folder names, so
+        values that end up in the same folder share a code.
+        """
+        buf = bytearray()
+        lengths, stamps, countries, cities, cells = [], [], [], [], []
+        country_index: dict[str, int] = {}
+        city_index: dict[str, int] = {}
+        cell_index: dict[str, int] = {}
+
+        it = iter(rows)
+        while chunk := list(islice(it, _BUILD_CHUNK)):
+            encoded = [str(r[0]).encode("utf-8", "surrogateescape") for r in chunk]
+            buf += b"".join(encoded)
+            lengths.append(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+            stamps.append(np.array([r[1] for r in chunk], dtype="datetime64[us]"))
+            countries.append(np.array(
+                [country_index.setdefault(str(r[2]), len(country_index)) for r in chunk], dtype=np.int32
+            ))
+            cities.append(np.array(
+                [city_index.setdefault(str(r[3]), len(city_index)) for r in chunk], dtype=np.int32
+            ))
+            cells.append(np.array(
+                [cell_index.setdefault(str(r[4]), len(cell_index)) for r in chunk], dtype=np.int32
+            ))
+
+        def cat(parts: list[np.ndarray], dtype: str) -> np.ndarray:
+            return np.concatenate(parts) if parts else np.empty(0, dtype=dtype)
+
+        return cls(
+            path_buffer=bytes(buf),
+            path_offsets=np.concatenate([[0], np.cumsum(cat(lengths, "int64"))]).astype(np.int64),
+            timestamp=cat(stamps, "datetime64[us]"),
+            country_codes=cat(countries, "int32"),
+            country_names=list(country_index),
+            city_codes=cat(cities, "int32"),
+            city_names=list(city_index),
+            geohash_codes=cat(cells, "int32"),
+            geohash_names=list(cell_index),
+        )
+
+    def __len__(self) -> int:
+        return len(self.timestamp)
+
+    def path(self, i: int) -> str:
+        return self.path_buffer[self.path_offsets[i]:self.path_offsets[i + 1]].decode("utf-8", "surrogateescape")
+
+    def key(self, condition: str) -> tuple[np.ndarray, list[str] | None]:
+        """Integer key of every image for a sort condition, along with the
+        names of the codes for country, city and geohash keys."""
+        ts = self.timestamp
+        if condition == "Y":
+            return ts.astype("datetime64[Y]").astype(np.int64) + 1970, None
+        if condition == "m":
+            return ts.astype("datetime64[M]").astype(np.int64) % 12 + 1, None
+        if condition == "d":
+            return (ts.astype("datetime64[D]") - ts.astype("datetime64[M]")).astype(np.int64) + 1, None
+        if condition == "C":
+            return self.country_codes, self.country_names
+        if condition == "c":
+            return self.city_codes, self.city_names
+        if condition == "g":
+            return self.geohash_codes, self.geohash_names
+        raise ValueError(f"Unknown sort condition '{condition}'.")
+
+
+class SortPlan(Mapping):
+    """Folder -> files plan in the same shape as the result of ``traverse``,
+    keeping row indices per folder and only creating the file paths of a
+    folder when it is looked up.
+    """
+
+    def __init__(self, meta: ColumnarMetadata, folders: list[Path], order: np.ndarray, bounds: np.ndarray):
+        self.meta = meta
+        self._folders = {f: i for i, f in enumerate(folders)}
+        self._order = order
+        self._bounds = bounds
+
+    def __getitem__(self, folder: Path) -> list[Path]:
+        i = self._folders[folder]
+        rows = self._order[self._bounds[i]:self._bounds[i + 1]]
+        return [Path(self.meta.path(r)) for r in rows.tolist()]
+
+    def __iter__(self) -> Iterator[Path]:
+        return iter(self._folders)
+
+    def __len__(self) -> int:
+        return len(self._folders)
+
+
+def sort_plan(meta: ColumnarMetadata, root: Path, conditions: list[str]) -> SortPlan:
+    """Group the images into leaf folders by the sort conditions with a
+    single stable ``lexsort`` over their keys.
+
+    Args:
+        meta (ColumnarMetadata): Metadata of the images.
+        root (Path): Output folder.
+        conditions (list[str]): Sort flags, e.g. ["Y", "m", "C"].
+
+    Returns:
+        SortPlan: Leaf folders and the files that go into them.
+    """
+    n = len(meta)
+    if not conditions or not n:
+        return SortPlan(meta, [root], np.arange(n), np.array([0, n]))
+
+    keys = [meta.key(c) for c in conditions]
+    # lexsort sorts by the last key first and is stable, so every group
+    # keeps the images in their original order
+    order = np.lexsort([k for k, _ in reversed(keys)])
+    change = np.zeros(n, dtype=bool)
+    change[0] = True
+    for k, _ in keys:
+        sk = k[order]
+        change[1:] |= sk[1:] != sk[:-1]
+    starts = np.flatnonzero(change)
+    bounds = np.append(starts, n)
+
+    first = order[starts]
+    parts = [
+        [names[v] for v in k[first].tolist()] if names is not None else list(map(str, k[first].tolist()))
+        for k, names in keys
+    ]
+    folders = [root.joinpath(*p) for p in zip(*parts)]
+    return SortPlan(meta, folders, order, bounds)
+
+
+if __name__ == "__main__":
+    # compare memory and time against FileMeta objects and traverse:
+    # python -m gisterical.core.columnar [n]
+    import sys
+    import time
+    import random
+    import tracemalloc
+    import datetime as dt
+
+    from gisterical.core.create_folder_structure import Node, traverse
+    from gisterical.util.file_meta import FileMeta
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rnd = random.Random(0)
+    start = dt.datetime(2010, 1, 1)
+    rows = [
+        (
+            f"/photos/{rnd.randrange(1000)}/IMG_{i:07d}.jpg",
+            start + dt.timedelta(seconds=rnd.randrange(10 * 365 * 86400)),
+            f"country_{rnd.randrange(50)}",
+            f"city_{rnd.randrange(500)}",
+            f"u{rnd.randrange(32 ** 3):03x}",
+        )
+        for i in range(n)
+    ]
+    conditions = ["Y", "m", "C"]
+
+    def with_objects():
+        return traverse(Node(Path("out"), [FileMeta.from_row(r) for r in rows], conditions))
+
+    def with_columns():
+        return sort_plan(ColumnarMetadata.from_rows(rows), Path("out"), conditions)
+
+    results = {}
+    for name, fn in (("FileMeta + traverse", with_objects), ("columnar", with_columns)):
+        t = time.perf_counter()
+        results[name] = fn()
+        elapsed = time.perf_counter() - t
+        # peak memory is measured on a separate run, tracing slows everything down
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:>20}: {elapsed:.2f} s, peak {peak / 2**20:.0f} MB")
+
+    assert results["columnar"] == results["FileMeta + traverse"]
@@ -0,0 +1,160 @@
+import os
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from gisterical.core.sort_journal import SortJournal
+from gisterical.util.file_ops import copy as copy_file, same_path
+
+
+@dataclass
+class CopyStats:
+    files: int = 0
+    bytes: int = 0
+    failed: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+
+
+class CopyEngine:
+    """Copy files on a thread pool, limiting the number of concurrent
+    transfers for every pair of source and target devices. The transfer
+    itself is done by ``copy``, which can also link or move the files.
+
+    Transfers between different pairs of devices run independently of each
+    other, and within a pair they are started in inode (or path) order of
+    the source files, which on spinning disks mostly matches their position
+    on the disk and keeps the reads close to sequential.
+
+    With a ``journal``, targets that already hold the current version of
+    their source are skipped and every completed transfer is recorded.
+    """
+
+    def __init__(
+        self,
+        per_device: int = 2,
+        order: str = "inode",
+        copy: Callable[[Path, Path], None] = copy_file,
+        report_every: float = 5.0,
+        keep_done: bool = False,
+        journal: SortJournal | None = None,
+    ):
+        if order not in {"inode", "path"}:
+            raise ValueError(f"Unknown transfer order '{order}', expected 'inode' or 'path'.")
+        self.per_device = max(1, per_device)
+        self.order = order
+        self.copy = copy
+        self.report_every = report_every
+        self.keep_done = keep_done
+        self.journal = journal
+        # (source, target) of every successful transfer when keep_done is set
+        self.done: list[tuple[Path, Path]] = []
+        self._lock = threading.Lock()
+        self._stats = CopyStats()
+        self._last_report = 0.0
+        self._last_bytes = 0
+
+    def run(self, transfers: Iterable[tuple[str | Path, str | Path]]) -> CopyStats:
+        """Copy every source file to its target path.
+
+        Args:
+            transfers (Iterable[tuple[str | Path, str | Path]]): Pairs of source and target paths.
+                Target folders must already exist.
+
+        Raises:
+            Exception: Any error of a worker other than a failed transfer, which is only
+                counted, once all workers have stopped.
+
+        Returns:
+            CopyStats: Number of files and bytes transferred, failures and time taken.
+        """
+        self._stats = CopyStats()
+        self.done = []
+        start = self._last_report = time.perf_counter()
+        self._last_bytes = 0
+        groups = self._group(transfers)
+
+        workers = self.per_device * len(groups)
+        try:
+            if workers:
+                with ThreadPoolExecutor(max_workers=workers) as ex:
+                    futures = [
+                        ex.submit(self._worker, queue) for queue in groups.values() for _ in range(self.per_device)
+                    ]
+                # errors outside a single transfer, e.g. writing the journal
+                for f in futures:
+                    f.result()
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+
+        stats = self._stats
+        stats.seconds = time.perf_counter() - start
+        rate = stats.bytes / stats.seconds / 2**20 if stats.seconds else 0.0
+        logger.info(
+            f"Transferred {stats.files} files ({stats.bytes / 2**30:.2f} GB) in {stats.seconds:.1f} s, "
+            f"{rate:.1f} MB/s."
+        )
+        if stats.skipped:
+            logger.info(f"{stats.skipped} files were already in place.")
+        if stats.failed:
+            logger.warning(f"{stats.failed} files could not be transferred.")
+        return stats
+
+    def _group(self, transfers: Iterable[tuple[str | Path, str | Path]]) -> dict[tuple[int, int], deque]:
+        groups: dict[tuple[int, int], list] = {}
+        target_devices: dict[Path, int] = {}
+        for src, dst in transfers:
+            src, dst = Path(src), Path(dst)
+            try:
+                st = os.stat(src)
+                dev = target_devices.get(dst.parent)
+                if dev is None:
+                    dev = target_devices[dst.parent] = os.stat(dst.parent).st_dev
+            except OSError as e:
+                logger.warning(f"Could not transfer {src}: {e}")
+                self._stats.failed += 1
+                continue
+            if same_path(src, dst) or (self.journal is not None and self.journal.is_placed(src, dst, st)):
+                self._stats.skipped += 1
+                continue
+            key = st.st_ino if self.order == "inode" else str(src)
+            groups.setdefault((st.st_dev, dev), []).append((key, src, dst, st))
+        return {k: deque(sorted(v, key=lambda t: t[0])) for k, v in groups.items()}
+
+    def _worker(self, queue: deque) -> None:
+        while True:
+            try:
+                _, src, dst, st = queue.popleft()
+            except IndexError:
+                return
+            try:
+                self.copy(src, dst)
+            except Exception as e:
+                logger.warning(f"Could not transfer {src}: {e}")
+                with self._lock:
+                    self._stats.failed += 1
+                continue
+            if self.journal is not None:
+                self.journal.record(src, dst, st)
+            with self._lock:
+                self._stats.files += 1
+                self._stats.bytes += st.st_size
+                if self.keep_done:
+                    self.done.append((src, dst))
+                self._report()
+
+    def _report(self) -> None:
+        now = time.perf_counter()
+        if now - self._last_report < self.report_every:
+            return
+        rate = (self._stats.bytes - self._last_bytes) / (now - self._last_report) / 2**20
+        logger.info(f"{self._stats.files} files transferred, {rate:.1f} MB/s.")
+        self._last_report = now
+        self._last_bytes = self._stats.bytes
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
-from typing import Any
+from typing import Any, Callable, Hashable, Iterable, Mapping
+from operator import attrgetter
 from pathlib import Path
-from shutil import copyfile
 from dataclasses import dataclass, field
 
+from gisterical.core.copy_engine import CopyEngine
+from gisterical.core.sort_journal import resolve_collisions
 from gisterical.util import FileMeta
 
 
@@ -28,15 +30,36 @@ def filter_city(data: list[FileMeta]) -> set[str]:
     return {i.city for i in data}
 
 
+def filter_geohash(data: list[FileMeta]) -> set[str]:
+    return {i.geohash for i in data}
+
+
 condition_dict = {
-    "Y": {"fun": filter_year, "id": 1},
-    "m": {"fun": filter_month, "id": 1},
-    "d": {"fun": filter_day, "id": 1},
-    "C": {"fun": filter_country, "id": 2},
-    "c": {"fun": filter_city, "id": 3},
+    "Y": {"fun": filter_year, "id": 1, "attr": "date.year"},
+    "m": {"fun": filter_month, "id": 1, "attr": "date.month"},
+    "d": {"fun": filter_day, "id": 1, "attr": "date.day"},
+    "C": {"fun": filter_country, "id": 2, "attr": "country"},
+    "c": {"fun": filter_city, "id": 3, "attr": "city"},
+    # geohash cut to the precision of the g<precision> sort flag by the query
+    "g": {"fun": filter_geohash, "id": 4, "attr": "geohash"},
 }
 
 
+def partition(data: Iterable[Any], key: Callable[[Any], Hashable]) -> dict[Hashable, list[Any]]:
+    """Bucket records by key in a single pass, keeping the order of the
+    records within every bucket and the buckets in order of first appearance.
+    """
+    groups: dict[Hashable, list[Any]] = {}
+    for i in data:
+        k = key(i)
+        bucket = groups.get(k)
+        if bucket is None:
+            groups[k] = [i]
+        else:
+            bucket.append(i)
+    return groups
+
+
 @dataclass
 class Node:
     folder: Path
@@ -47,52 +70,44 @@ class Node:
     def children(self) -> list["Node"] | None:
         if len(self.conditions) == 0:
             return None
-        current_condition = self.conditions[0]
-        fun = condition_dict[current_condition]["fun"]
-
-        fnames: list[int | str] = fun(self.metadata)
-        children_data: dict[str, dict[str, Any]] = {str(n): {} for n in fnames}
-        for f in fnames:
-            children_data[str(f)]["folder"] = self.folder / str(f)
-            children_data[str(f)]["conditions"] = self.conditions[1:]
-            if current_condition == "C":
-                children_data[str(f)]["metadata"] = [i or "Unknown_country" for i in self.metadata if i.country == f]
-
-            elif current_condition == "Y":
-                children_data[str(f)]["metadata"] = [i for i in self.metadata if i.date.year == f]
-            elif current_condition == "c":
-                children_data[str(f)]["metadata"] = [i or "Unknown_city" for i in self.metadata if i.city == f]
-
-
-            elif current_condition == "d":
-                children_data[str(f)]["metadata"] = [i for i in self.metadata if i.date.day == f]
-            elif current_condition == "m":
-                children_data[str(f)]["metadata"] = [i for i in self.metadata if i.date.month == f]
-        return [Node(**i) for i in children_data.values()]
+        key = attrgetter(condition_dict[self.conditions[0]]["attr"])
+        return [
+            Node(folder=self.folder / str(value), metadata=data, conditions=self.conditions[1:])
+            for value, data in partition(self.metadata, key).items()
+        ]
 
 
 def traverse(
     root: Node, folders: dict[Path, list[str | Path]] | None = None
 ) -> dict[Path, list[str | Path]]:
-    # build a dictionary with folderPath as the key and list of file paths as value
+    """Map every leaf folder of the tree to the files that go into it.
+
+    Instead of walking the tree level by level, the records are bucketed
+    once by the values of all conditions together and every bucket becomes
+    a leaf folder.
+
+    Args:
+        root (Node): Root of the tree.
+        folders (dict[Path, list[str | Path]] | None, optional): Mapping to add the leaf
+            folders to. Defaults to a new dictionary.
+
+    Returns:
+        dict[Path, list[str | Path]]: Leaf folder paths and the paths of their files.
+    """
     folders = folders or {}
-    r = root.children
-    if not r or len(root.conditions) == 0:
+    if not root.conditions or not root.metadata:
         if root.folder not in folders:
-            # for leaf node add folder name and corresponding files
             folders[root.folder] = [i.path for i in root.metadata]
-    else:
-        for child in r:
-            if isinstance(child, Node):
-                par = child.folder.parent
-                # we only want the data from leaf nodes so
-                # if the record for the current folder's parent
-                # already exists we delete it from the dictionary
-                # and add the current folder data
-                if par in folders:
-                    del folders[par]
-                folders[child.folder] = [i.path for i in child.metadata]
-                traverse(child, folders)
+        return folders
+
+    # only leaves are kept, so the root itself is replaced by its leaves
+    folders.pop(root.folder, None)
+    key = attrgetter(*(condition_dict[c]["attr"] for c in root.conditions))
+    for values, data in partition(root.metadata, key).items():
+        if len(root.conditions) == 1:
+            values = (values,)
+        leaf = root.folder.joinpath(*map(str, values))
+        folders.setdefault(leaf, []).extend(i.path for i in data)
     return folders
 
 
@@ -113,27 +128,55 @@ def make_folder(path: Path, children: list[Path] = None) -> None:
         return make_folder(path.parent, children)
 
 
-def populate_folder_structure(files: dict[Path, list[str | Path]]):
-    for target_fol, original_files in files.items():
-        for f in original_files:
-            target_file = target_fol / Path(f).name
-            copyfile(str(f), str(target_file))
+def populate_folder_structure(files: Mapping[Path, list[str | Path]], engine: CopyEngine | None = None):
+    engine = engine or CopyEngine()
+    transfers = (
+        (f, target_fol / Path(f).name) for target_fol, original_files in files.items() for f in original_files
+    )
+    engine.run(resolve_collisions(transfers, engine.journal))
 
 
 if __name__ == "__main__":
-    pass
-    # from database.db_api import DbApi
-    # COND = ["Y", "m", ]
-
-    # api = DbApi()
-    # d = api.get_photo_path_date()
-    
-    # n = Node(Path('temp'), metadata=d, conditions=COND)
-    
-    # tree = traverse(n)
-    
-    # for leaf in tree:
-    #     make_folder(leaf)
-        
-    # move_files(tree)
-
+    # compare against grouping with a rescan of the records for every
+    # distinct value: python -m gisterical.core.create_folder_structure [n]
+    import sys
+    import time
+    import random
+    import datetime as dt
+
+    def rescan_traverse(node: Node, folders: dict[Path, list[str | Path]]) -> dict[Path, list[str | Path]]:
+        if not node.conditions:
+            folders[node.folder] = [i.path for i in node.metadata]
+            return folders
+        cond = node.conditions[0]
+        key = attrgetter(condition_dict[cond]["attr"])
+        for value in condition_dict[cond]["fun"](node.metadata):
+            data = [i for i in node.metadata if key(i) == value]
+            rescan_traverse(Node(node.folder / str(value), data, node.conditions[1:]), folders)
+        return folders
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rnd = random.Random(0)
+    start = dt.datetime(2010, 1, 1)
+    countries = [f"country_{i}" for i in range(50)]
+    cities = [f"city_{i}" for i in range(500)]
+    data = [
+        FileMeta(
+            path=f"/photos/{i}.jpg",
+            date=start + dt.timedelta(seconds=rnd.randrange(10 * 365 * 86400)),
+            country=rnd.choice(countries),
+            city=rnd.choice(cities),
+        )
+        for i in range(n)
+    ]
+
+    for conditions in (["Y", "m"], ["Y", "m", "d"], ["Y", "m", "d", "C", "c"]):
+        root = Node(Path("out"), metadata=data, conditions=conditions)
+        t = time.perf_counter()
+        res = traverse(root)
+        t_new = time.perf_counter() - t
+        t = time.perf_counter()
+        old = rescan_traverse(root, {})
+        t_old = time.perf_counter() - t
+        assert res == old
+        print(f"{''.join(conditions):>6}: {len(res)} folders, rescan {t_old:.2f} s, single pass {t_new:.2f} s")
@@ -0,0 +1,242 @@
+from itertools import combinations
+
+import numpy as np
+from loguru import logger
+
+
+# number of set bits for every 16-bit value, used for a vectorized popcount
+_POPCOUNT = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+_CHUNKS = 4
+_CHUNK_BITS = 16
+
+
+def hamming(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Element-wise Hamming distance between two arrays of 64-bit hashes."""
+    x = np.bitwise_xor(a.astype(np.uint64), b.astype(np.uint64))
+    return _POPCOUNT[x.view(np.uint16).reshape(-1, 4)].sum(axis=1, dtype=np.int64)
+
+
+def _masks(bits: int, radius: int) -> np.ndarray:
+    """All ``bits``-wide masks with at most ``radius`` bits set."""
+    masks = [0]
+    for r in range(1, radius + 1):
+        masks.extend(sum(1 << i for i in c) for c in combinations(range(bits), r))
+    return np.array(masks, dtype=np.uint64)
+
+
+class HashIndex:
+    """Multi-index hashing over 64-bit perceptual hashes.
+
+    Each hash is split into four 16-bit chunks. Two hashes within Hamming
+    distance ``d`` must have at least one chunk within ``d // 4`` bits of
+    each other, so candidates are found by looking up every chunk (and its
+    near variants) in per-chunk bucket arrays, and only the candidates are
+    compared with a vectorized popcount. New hashes can be added at any time,
+    they are merged into the bucket arrays and only they are compared with
+    the rest when clustering again.
+    """
+
+    def __init__(self, ids: np.ndarray | list[int] | None = None, hashes: np.ndarray | list[int] | None = None):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self._order: list[np.ndarray] | None = None
+        self._start: list[np.ndarray] | None = None
+        # union-find over the positions of the hashes clustered so far, at
+        # the distance they were clustered at
+        self._parent = np.empty(0, dtype=np.int64)
+        self._linked = np.empty(0, dtype=bool)
+        self._clustered_at: int | None = None
+        if ids is not None and hashes is not None:
+            self.add(ids, hashes)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def add(self, ids: np.ndarray | list[int], hashes: np.ndarray | list[int]) -> None:
+        """Add hashes to the index.
+
+        Args:
+            ids (np.ndarray | list[int]): Identifiers of the images, e.g. database ids.
+            hashes (np.ndarray | list[int]): 64-bit hashes of the images.
+        """
+        new = np.asarray(hashes, dtype=np.uint64)
+        base = len(self.hashes)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.hashes = np.concatenate([self.hashes, new])
+        if self._order is None or not len(new):
+            # built on the first lookup
+            return
+        for i in range(_CHUNKS):
+            keys = self._chunk(new, i).astype(np.int64)
+            pos = np.argsort(keys, kind="stable")
+            # new positions are larger than all others, so they go to the end
+            # of their buckets and every bucket stays sorted by position
+            self._order[i] = np.insert(self._order[i], self._start[i][keys[pos] + 1], base + pos)
+            counts = np.bincount(keys, minlength=1 << _CHUNK_BITS)
+            self._start[i] = self._start[i] + np.concatenate([[0], np.cumsum(counts)])
+
+    def _chunk(self, h: np.ndarray, i: int) -> np.ndarray:
+        return (h >> np.uint64(i * _CHUNK_BITS)) & np.uint64((1 << _CHUNK_BITS) - 1)
+
+    def _build(self) -> None:
+        # for every chunk the hash positions sorted by chunk value plus the
+        # offset where each of the 2**16 possible values starts, so a bucket
+        # lookup is two array reads instead of a binary search
+        self._order, self._start = [], []
+        for i in range(_CHUNKS):
+            keys = self._chunk(self.hashes, i).astype(np.int64)
+            self._order.append(np.argsort(keys, kind="stable"))
+            counts = np.bincount(keys, minlength=1 << _CHUNK_BITS)
+            self._start.append(np.concatenate([[0], np.cumsum(counts)]))
+
+    def _matches(self, queries: np.ndarray, max_distance: int) -> tuple[np.ndarray, np.ndarray]:
+        """Positions of (query, indexed hash) pairs within ``max_distance``.
+
+        Candidates sharing a chunk within radius are verified one block at a
+        time so that memory stays proportional to the number of matches.
+        """
+        if self._order is None:
+            self._build()
+        masks = _masks(_CHUNK_BITS, max_distance // _CHUNKS)
+        q_idx, h_idx = [], []
+        for i in range(_CHUNKS):
+            q_keys = self._chunk(queries, i)
+            for m in masks:
+                target = (q_keys ^ m).astype(np.int64)
+                lo = self._start[i][target]
+                cnt = self._start[i][target + 1] - lo
+                if not cnt.any():
+                    continue
+                q = np.repeat(np.arange(len(queries)), cnt)
+                # positions lo..hi-1 for every query, flattened
+                offs = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+                h = self._order[i][np.repeat(lo, cnt) + offs]
+                keep = hamming(queries[q], self.hashes[h]) <= max_distance
+                q_idx.append(q[keep])
+                h_idx.append(h[keep])
+        if not q_idx:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(q_idx), np.concatenate(h_idx)
+
+    def neighbours(self, h: int, max_distance: int = 4) -> list[tuple[int, int]]:
+        """Find indexed hashes within ``max_distance`` of a hash.
+
+        Args:
+            h (int): 64-bit hash to look up.
+            max_distance (int, optional): Maximum Hamming distance. Defaults to 4.
+
+        Returns:
+            list[tuple[int, int]]: Ids of the matches and their distances, closest first.
+        """
+        _, pos = self._matches(np.array([h], dtype=np.uint64), max_distance)
+        pos = np.unique(pos)
+        dist = hamming(self.hashes[pos], np.full(len(pos), h, dtype=np.uint64))
+        res = sorted(zip(dist.tolist(), self.ids[pos].tolist()))
+        return [(i, d) for d, i in res]
+
+    def clusters(self, max_distance: int = 4) -> list[list[int]]:
+        """Group all indexed hashes into clusters of near-duplicates, where
+        every member is within ``max_distance`` of at least one other member.
+
+        Args:
+            max_distance (int, optional): Maximum Hamming distance. Defaults to 4.
+
+        Returns:
+            list[list[int]]: Ids of the images in every cluster with more than one member.
+        """
+        if self._clustered_at != max_distance:
+            self._parent = np.empty(0, dtype=np.int64)
+            self._linked = np.empty(0, dtype=bool)
+            self._clustered_at = max_distance
+        # only hashes added since the last call are looked up, matches among
+        # the older ones are already in the union-find
+        done = len(self._parent)
+        self._parent = np.concatenate([self._parent, np.arange(done, len(self), dtype=np.int64)])
+        self._linked = np.concatenate([self._linked, np.zeros(len(self) - done, dtype=bool)])
+        parent = self._parent
+        q, b = self._matches(self.hashes[done:], max_distance)
+        a = q + done
+        keep = a != b
+        a, b = a[keep], b[keep]
+        self._linked[a] = True
+        self._linked[b] = True
+
+        def find(x: int) -> int:
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for x, y in zip(a.tolist(), b.tolist()):
+            rx, ry = find(x), find(y)
+            if rx != ry:
+                parent[max(rx, ry)] = min(rx, ry)
+
+        groups: dict[int, list[int]] = {}
+        for x in np.flatnonzero(self._linked).tolist():
+            groups.setdefault(find(x), []).append(int(self.ids[x]))
+        return sorted(groups.values(), key=lambda g: (-len(g), g))
+
+
+def _signed(h: int) -> int:
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+class LibraryHashes:
+    """Hash index of the hashed images in the database, kept between runs by
+    a long running process. Every refresh only reads images added since the
+    previous one; the index is rebuilt when hashes of indexed images changed
+    or images were removed, which a checksum of the hashes tells.
+    """
+
+    def __init__(self):
+        self.index = HashIndex()
+        self.paths: dict[int, str] = {}
+        self.last_id = 0
+        self._count = 0
+        self._sum = 0
+
+    def refresh(self, api) -> int:
+        """Add images hashed since the last refresh to the index.
+
+        Args:
+            api (DbApi): Database to read the hashes from.
+
+        Returns:
+            int: Number of images added to the index.
+        """
+        if self.last_id and api.get_hash_checksum(self.last_id) != (self._count, self._sum):
+            logger.info("Indexed hashes changed, rebuilding the duplicate index.")
+            self.__init__()
+        rows = api.get_image_hashes(self.last_id)
+        if rows:
+            self.index.add([i[0] for i in rows], [i[2] for i in rows])
+            self.paths.update((i[0], i[1]) for i in rows)
+            self.last_id = rows[-1][0]
+            self._count += len(rows)
+            self._sum += sum(_signed(i[2]) for i in rows)
+        return len(rows)
+
+
+if __name__ == "__main__":
+    # python -m gisterical.core.duplicates
+    import time
+
+    rng = np.random.default_rng(0)
+    n = 200_000
+    hashes = rng.integers(0, 2**63, n, dtype=np.int64).astype(np.uint64)
+    # plant near-duplicates by flipping a few bits of some hashes
+    dup = rng.integers(0, n, 2_000)
+    flips = np.uint64(1) << rng.integers(0, 64, 2_000).astype(np.uint64)
+    hashes = np.concatenate([hashes, hashes[dup] ^ flips])
+
+    t = time.perf_counter()
+    idx = HashIndex(np.arange(len(hashes)), hashes)
+    c = idx.clusters(max_distance=6)
+    print(f"{len(hashes)} hashes, {len(c)} clusters in {time.perf_counter() - t:.2f} s")
+
+    t = time.perf_counter()
+    idx.add(np.arange(len(hashes), len(hashes) + 1_000), hashes[:1_000] ^ np.uint64(1))
+    c = idx.clusters(max_distance=6)
+    print(f"1000 more hashes, {len(c)} clusters in {time.perf_counter() - t:.2f} s")
@@ -0,0 +1,292 @@
+import os
+import struct
+from pathlib import Path
+from typing import Any, Callable
+
+
+RAW_FIELDS: tuple[str, ...] = (
+    'gps_latitude',
+    'gps_latitude_ref',
+    'gps_longitude',
+    'gps_longitude_ref',
+    'gps_altitude',
+    'datetime_original',
+    'gps_horizontal_positioning_error',
+    'gps_img_direction',
+    'make',
+    'model',
+)
+DEFAULT_DATE = '1900:1:1 00:00:00'
+UNKNOWN_MAKE = 'unknown device'
+UNKNOWN_MODEL = 'unknown model'
+# values stored for a file without EXIF data or one that can't be read,
+# the same the exif library fallback uses
+EMPTY_RAW: tuple[Any, ...] = (
+    None, None, None, None, None, DEFAULT_DATE, -999, -999, UNKNOWN_MAKE, UNKNOWN_MODEL
+)
+
+# maximum number of bytes read from a single file before giving up
+# and letting the exif library deal with it
+DEFAULT_READ_BUDGET = 256 * 1024
+
+# IFD0
+_MAKE = 0x010F
+_MODEL = 0x0110
+_EXIF_IFD = 0x8769
+_GPS_IFD = 0x8825
+# Exif IFD
+_DATETIME_ORIGINAL = 0x9003
+# GPS IFD
+_GPS_LATITUDE_REF = 0x01
+_GPS_LATITUDE = 0x02
+_GPS_LONGITUDE_REF = 0x03
+_GPS_LONGITUDE = 0x04
+_GPS_ALTITUDE = 0x06
+_GPS_IMG_DIRECTION = 0x11
+_GPS_HOR_POS_ERROR = 0x1F
+
+_IFD0_TAGS = {_MAKE, _MODEL, _EXIF_IFD, _GPS_IFD}
+_EXIF_TAGS = {_DATETIME_ORIGINAL}
+_GPS_TAGS = {
+    _GPS_LATITUDE_REF,
+    _GPS_LATITUDE,
+    _GPS_LONGITUDE_REF,
+    _GPS_LONGITUDE,
+    _GPS_ALTITUDE,
+    _GPS_IMG_DIRECTION,
+    _GPS_HOR_POS_ERROR,
+}
+
+# TIFF field type -> size of a single value in bytes
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8, 13: 4}
+_MAX_IFD_ENTRIES = 1000
+
+# JPEG markers without a length field
+_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+_SOS = 0xDA
+_EOI = 0xD9
+_APP1 = 0xE1
+
+
+class UnsupportedFile(Exception):
+    """Raised when a file cannot be handled by the header parser."""
+
+
+class _BudgetReader:
+    """Thin wrapper over a binary file that keeps track of the
+    number of bytes read and refuses to go over the budget."""
+
+    def __init__(self, f, budget: int):
+        self._f = f
+        self.budget = budget
+        self.bytes_read = 0
+
+    def read(self, size: int) -> bytes:
+        if self.bytes_read + size > self.budget:
+            raise UnsupportedFile('Read budget exceeded.')
+        data = self._f.read(size)
+        self.bytes_read += len(data)
+        if len(data) != size:
+            raise UnsupportedFile('Unexpected end of file.')
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> None:
+        self._f.seek(offset, whence)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        self._f.seek(offset)
+        return self.read(size)
+
+
+def _buffer_reader(buf: bytes) -> Callable[[int, int], bytes]:
+    def read_at(offset: int, size: int) -> bytes:
+        if offset < 0 or offset + size > len(buf):
+            raise UnsupportedFile('Offset outside of the EXIF segment.')
+        return buf[offset:offset + size]
+    return read_at
+
+
+def _decode(endian: str, typ: int, count: int, raw: bytes) -> Any:
+    if typ == 2:
+        return raw.split(b'\x00', 1)[0].decode('ascii')
+    if typ in {1, 7}:
+        return raw
+    if typ in {5, 10}:
+        fmt = 'I' if typ == 5 else 'i'
+        nums = struct.unpack(f'{endian}{2 * count}{fmt}', raw)
+        vals = tuple(nums[i] / nums[i + 1] for i in range(0, len(nums), 2))
+    else:
+        fmt = {3: 'H', 4: 'I', 9: 'i', 13: 'I'}[typ]
+        vals = struct.unpack(f'{endian}{count}{fmt}', raw)
+    return vals[0] if count == 1 else vals
+
+
+def _read_ifd(
+    read_at: Callable[[int, int], bytes], endian: str, offset: int, tags: set[int]
+) -> dict[int, Any]:
+    """Read the requested tags of a single IFD.
+
+    Args:
+        read_at (Callable[[int, int], bytes]): Function returning ``size`` bytes at
+            an offset relative to the start of the TIFF header.
+        endian (str): Either "<" or ">" for little and big endian data.
+        offset (int): Offset of the IFD from the start of the TIFF header.
+        tags (set[int]): Tag ids to extract.
+
+    Returns:
+        dict[int, Any]: Decoded values of the tags found in the IFD.
+    """
+    (n,) = struct.unpack(f'{endian}H', read_at(offset, 2))
+    if n > _MAX_IFD_ENTRIES:
+        raise UnsupportedFile(f'Suspicious number of IFD entries ({n}).')
+    entries = read_at(offset + 2, 12 * n)
+    res: dict[int, Any] = {}
+    for i in range(n):
+        tag, typ, count = struct.unpack(f'{endian}HHI', entries[12 * i:12 * i + 8])
+        if tag not in tags:
+            continue
+        if typ not in _TYPE_SIZES:
+            raise UnsupportedFile(f'Unexpected type {typ} of tag {tag:#x}.')
+        size = _TYPE_SIZES[typ] * count
+        value = entries[12 * i + 8:12 * i + 12]
+        if size > 4:
+            (ptr,) = struct.unpack(f'{endian}I', value)
+            value = read_at(ptr, size)
+        res[tag] = _decode(endian, typ, count, value[:size])
+    return res
+
+
+def _parse_tiff(read_at: Callable[[int, int], bytes]) -> tuple[Any, ...]:
+    head = read_at(0, 8)
+    if head[:2] == b'II':
+        endian = '<'
+    elif head[:2] == b'MM':
+        endian = '>'
+    else:
+        raise UnsupportedFile('Not a TIFF header.')
+    magic, ifd0_offset = struct.unpack(f'{endian}HI', head[2:])
+    if magic != 42:
+        raise UnsupportedFile('Not a TIFF header.')
+
+    ifd0 = _read_ifd(read_at, endian, ifd0_offset, _IFD0_TAGS)
+    exif = _read_ifd(read_at, endian, ifd0[_EXIF_IFD], _EXIF_TAGS) if _EXIF_IFD in ifd0 else {}
+    gps = _read_ifd(read_at, endian, ifd0[_GPS_IFD], _GPS_TAGS) if _GPS_IFD in ifd0 else {}
+
+    return (
+        gps.get(_GPS_LATITUDE),
+        gps.get(_GPS_LATITUDE_REF),
+        gps.get(_GPS_LONGITUDE),
+        gps.get(_GPS_LONGITUDE_REF),
+        gps.get(_GPS_ALTITUDE),
+        exif.get(_DATETIME_ORIGINAL) or DEFAULT_DATE,
+        gps.get(_GPS_HOR_POS_ERROR),
+        gps.get(_GPS_IMG_DIRECTION),
+        ifd0.get(_MAKE),
+        ifd0.get(_MODEL),
+    )
+
+
+def _parse_jpeg(reader: _BudgetReader) -> tuple[Any, ...]:
+    # walk the segment headers and seek over everything that isn't APP1
+    # so that only the few bytes of headers and the EXIF block are read
+    while True:
+        marker = reader.read(2)
+        if marker[0] != 0xFF:
+            raise UnsupportedFile('Corrupt JPEG segment marker.')
+        code = marker[1]
+        while code == 0xFF:
+            code = reader.read(1)[0]
+        if code in {_SOS, _EOI}:
+            # image data starts, there is no EXIF segment in this file
+            return EMPTY_RAW
+        if code in _STANDALONE_MARKERS:
+            continue
+        (length,) = struct.unpack('>H', reader.read(2))
+        if length < 2:
+            raise UnsupportedFile('Corrupt JPEG segment length.')
+        if code == _APP1:
+            payload = reader.read(length - 2)
+            if payload[:6] == b'Exif\x00\x00':
+                return _parse_tiff(_buffer_reader(payload[6:]))
+        else:
+            reader.seek(length - 2, os.SEEK_CUR)
+
+
+def _read(path: str | Path, budget: int) -> tuple[tuple[Any, ...] | None, int]:
+    with open(path, 'rb', buffering=0) as f:
+        reader = _BudgetReader(f, budget)
+        try:
+            head = reader.read(4)
+            if head[:2] == b'\xff\xd8':
+                reader.seek(2)
+                return _parse_jpeg(reader), reader.bytes_read
+            if head in {b'II*\x00', b'MM\x00*'}:
+                return _parse_tiff(reader.read_at), reader.bytes_read
+        except (UnsupportedFile, struct.error, UnicodeDecodeError, ZeroDivisionError, KeyError):
+            pass
+    return None, reader.bytes_read
+
+
+def read_exif_header(path: str | Path, budget: int = DEFAULT_READ_BUDGET) -> tuple[Any, ...] | None:
+    """Read the EXIF fields we store by seeking straight to the APP1 segment
+    of a JPEG or following the IFD chain of a TIFF file, reading no more
+    than ``budget`` bytes.
+
+    Args:
+        path (str | Path): Path to the image file.
+        budget (int, optional): Maximum number of bytes to read from the file.
+            Defaults to DEFAULT_READ_BUDGET.
+
+    Returns:
+        tuple[Any, ...] | None: EXIF values in the order of ``RAW_FIELDS`` or None
+            if the file is not a JPEG/TIFF or could not be parsed within the budget.
+    """
+    return _read(path, budget)[0]
+
+
+if __name__ == "__main__":
+    # compare the header parser against reading whole files with the
+    # exif library: python -m gisterical.core.exif_reader <folder>
+    import sys
+    import time
+
+    from exif import Image
+
+    from gisterical.core.image_paths import get_paths
+
+    class _CountingFile:
+        def __init__(self, f):
+            self._f = f
+            self.bytes_read = 0
+
+        def read(self, size: int = -1) -> bytes:
+            data = self._f.read(size)
+            self.bytes_read += len(data)
+            return data
+
+    paths = get_paths(sys.argv[1:])
+
+    t = time.perf_counter()
+    header_bytes = handled = 0
+    for p in paths:
+        res, nbytes = _read(p, DEFAULT_READ_BUDGET)
+        header_bytes += nbytes
+        handled += res is not None
+    header_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    exif_bytes = 0
+    for p in paths:
+        with open(p, 'rb') as f:
+            cf = _CountingFile(f)
+            try:
+                Image(cf).get('datetime_original')
+            except Exception:
+                pass
+            exif_bytes += cf.bytes_read
+    exif_time = time.perf_counter() - t
+
+    n = len(paths)
+    print(f"{n} files, {handled} handled by the header parser.")
+    print(f"header parser: {header_bytes / 1e6:.2f} MB read, {n / header_time:.1f} files/s")
+    print(f"exif library:  {exif_bytes / 1e6:.2f} MB read, {n / exif_time:.1f} files/s")
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import imagehash as imh
+from PIL import Image as PILImage
+from loguru import logger
+
+
+# phash only looks at a 32x32 thumbnail, so JPEGs are decoded at the
+# smallest DCT scale that still gives at least this many pixels per side
+DRAFT_SIZE = (128, 128)
+
+
+def hash_image(path: str | Path) -> tuple[str, str]:
+    """Calculate perceptual and color hashes of an image.
+
+    JPEG files are decoded at reduced resolution with ``draft()`` and the
+    decoded image is shared by both hashes.
+
+    Args:
+        path (str | Path): Path to the image file.
+
+    Returns:
+        tuple[str, str]: Perceptual and color hash as hex strings.
+    """
+    with PILImage.open(str(path)) as im:
+        im.draft("RGB", DRAFT_SIZE)
+        im.load()
+        return str(imh.phash(im)), str(imh.colorhash(im))
+
+
+def hash_rows(rows: list[tuple[int, str]]) -> list[tuple[int, str, str]]:
+    """Hash a batch of images stored in the database, skipping (and logging)
+    the ones that can't be opened.
+
+    Args:
+        rows (list[tuple[int, str]]): Image ids and paths.
+
+    Returns:
+        list[tuple[int, str, str]]: Image ids with their perceptual and color hashes.
+    """
+    res: list[tuple[int, str, str]] = []
+    for idx, pth in rows:
+        try:
+            res.append((idx, *hash_image(pth)))
+        except Exception as e:
+            logger.warning(f"Could not hash {pth}: {e}")
+    return res
+
+
+if __name__ == "__main__":
+    # compare full and draft decoding: python -m gisterical.core.image_hash <folder>
+    import sys
+    import time
+
+    from gisterical.core.image_paths import get_paths
+
+    paths = get_paths(sys.argv[1:])
+
+    t = time.perf_counter()
+    for p in paths:
+        with PILImage.open(str(p)) as im:
+            imh.phash(im), imh.colorhash(im)
+    full = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for p in paths:
+        hash_image(p)
+    draft = time.perf_counter() - t
+
+    print(f"{len(paths)} files: full decode {len(paths) / full:.1f} files/s, draft decode {len(paths) / draft:.1f} files/s")
@@ -2,16 +2,27 @@ import os
 import time
 import warnings
 import datetime as dt
+from itertools import chain
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Any
 
-from PIL import Image as PILImage
 from exif import Image
-import imagehash as imh
 from attrs import define
 from loguru import logger
 
 from gisterical.core.image_paths import get_paths
+from gisterical.core.image_hash import hash_image
+from gisterical.core.exif_reader import (
+    RAW_FIELDS,
+    EMPTY_RAW,
+    DEFAULT_DATE,
+    UNKNOWN_MAKE,
+    UNKNOWN_MODEL,
+    DEFAULT_READ_BUDGET,
+    read_exif_header,
+)
 
 warnings.filterwarnings('ignore', module='exif')
 
@@ -28,13 +39,200 @@ class PhotoData:
     camera_model: str
     phash: str | None = None
     colorhash: str | None = None
+    file_size: int | None = None
+    file_mtime: float | None = None
+    file_inode: int | None = None
+
+
+def read_raw_metadata(path: str | Path, read_budget: int = DEFAULT_READ_BUDGET) -> tuple[Any, ...]:
+    """Read the EXIF fields we store from a single image file.
+
+    The values are returned as a plain tuple ordered as ``RAW_FIELDS`` so
+    that they are cheap to send back from a worker process. JPEG and TIFF
+    headers are parsed directly and only files the header parser can't
+    handle are loaded in full by the exif library. A file that cannot be
+    parsed is logged and treated as having no EXIF data rather than
+    aborting the whole run.
+
+    Args:
+        path (str | Path): Path to the image file.
+        read_budget (int, optional): Maximum number of bytes the header parser
+            may read before falling back. Defaults to DEFAULT_READ_BUDGET.
+
+    Returns:
+        tuple[Any, ...]: EXIF values in the order of ``RAW_FIELDS``.
+    """
+    try:
+        res = read_exif_header(path, read_budget)
+        if res is not None:
+            return res
+        with open(path, "rb") as f:
+            tmp = Image(f)
+            try:
+                lat = tmp.get('gps_latitude')
+                lat_ref = tmp.get('gps_latitude_ref')
+                lon = tmp.get('gps_longitude')
+                lon_ref = tmp.get('gps_longitude_ref')
+                alt = tmp.get('gps_altitude')
+            except (AttributeError, KeyError):
+                lat = lon = alt = None
+                lat_ref = lon_ref = None
+
+            try:
+                date = tmp.get('datetime_original') or DEFAULT_DATE
+            except (AttributeError, KeyError):
+                date = DEFAULT_DATE
+
+            try:
+                hor_pos = tmp.get('gps_horizontal_positioning_error')
+                direct = tmp.get('gps_img_direction')
+            except (AttributeError, KeyError):
+                hor_pos = direct = -999
+
+            try:
+                mk = tmp.get('make')
+                mod = tmp.get('model')
+            except (AttributeError, KeyError):
+                mk = UNKNOWN_MAKE
+                mod = UNKNOWN_MODEL
+    except Exception as e:
+        logger.warning(f"Could not read EXIF data from {path}: {e}")
+        return EMPTY_RAW
+    return (lat, lat_ref, lon, lon_ref, alt, date, hor_pos, direct, mk, mod)
+
+
+def _read_chunk(paths: list[str], read_budget: int = DEFAULT_READ_BUDGET) -> list[tuple[Any, ...]]:
+    # executed in a worker process, so only plain tuples travel back
+    return [read_raw_metadata(p, read_budget) for p in paths]
+
+
+def _chunks(items: list[str], size: int) -> list[list[str]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def convert_coords_to_decimal(coords: tuple[float, ...], ref: str) -> float:
+    """Covert a tuple of coordinates in the format (degrees, minutes, seconds)
+    and a reference to a decimal representation.
+
+    Args:
+        coords (tuple[float,...]): A tuple of degrees, minutes and seconds
+        ref (str): Hemisphere reference of "N", "S", "E" or "W".
+
+    Returns:
+        float: A signed float of decimal representation of the coordinate.
+    """
+    if ref.upper() in {"W", "S"}:
+        mul = -1
+    elif ref.upper() in {"E", "N"}:
+        mul = 1
+    else:
+        msg = f"Incorrect hemisphere reference. Expecting one of 'N', 'S', 'E' or 'W', got {ref} instead."
+        logger.debug(msg)
+        raise ValueError(msg)
+    return mul * (coords[0] + coords[1] / 60 + coords[2] / 3600)
+
+
+def to_photo_data(
+    pth: str, dic: dict[str, Any], hash_images: bool = False, st: os.stat_result | None = None
+) -> PhotoData:
+    """Convert the raw EXIF values of a single file into a PhotoData record.
+
+    Args:
+        pth (str): Path to the image file.
+        dic (dict[str, Any]): Raw EXIF values keyed by ``RAW_FIELDS``.
+        hash_images (bool, optional): Whether to calculate image hashes. Defaults to False.
+        st (os.stat_result | None, optional): Result of ``os.stat`` for the file
+            if it is already known. Defaults to None.
+
+    Returns:
+        PhotoData: Metadata record ready to be added to the database.
+    """
+    try:
+        lat = convert_coords_to_decimal(dic['gps_latitude'], dic['gps_latitude_ref'])
+        lon = convert_coords_to_decimal(dic['gps_longitude'], dic['gps_longitude_ref'])
+        alt = dic['gps_altitude']
+    except (AttributeError, KeyError, TypeError, ValueError):
+        lat = lon = alt = -999
+
+    st = st or os.stat(pth)
+
+    # when getting dates so images (like those sent through WhataApp, Telegram etc)
+    # won't have correct date recorded so instead we take the last modified date
+    # and select it instead            
+    try:                
+        timestamp = dt.datetime.strptime(dic['datetime_original'], "%Y:%m:%d %H:%M:%S")
+    except (AttributeError, KeyError, ValueError):
+        ts = st.st_mtime
+        timestamp = dt.datetime.utcfromtimestamp(ts)
+    else:
+        # if the image has datetime recorded we check whether it is in the future
+        # (due to incorrect camera setup and such) or whether it is before 1/1/1970
+        # and if either of these is true then we take modified date still
+        if timestamp > dt.datetime.now() or timestamp < dt.datetime(1970, 1, 1):
+            ts = st.st_mtime
+            timestamp = dt.datetime.utcfromtimestamp(ts)                
+
+    if hash_images:
+        phash, chash = hash_image(pth)
+    else:
+        phash = chash = None
+
+    return PhotoData(
+        path=pth,
+        latitude=lat,
+        longitude=lon,
+        altitude=alt,
+        timestamp=timestamp,
+        gps_accuracy=dic['gps_horizontal_positioning_error'],
+        photo_direction=dic['gps_img_direction'],
+        camera_make=dic['make'],
+        camera_model=dic['model'],
+        phash=phash,
+        colorhash=chash,
+        file_size=st.st_size,
+        file_mtime=st.st_mtime,
+        file_inode=st.st_ino,
+    )
+
+
+def read_photo_data(
+    files: list[tuple[str, os.stat_result | None]], read_budget: int = DEFAULT_READ_BUDGET
+) -> list[PhotoData]:
+    """Read metadata records for a batch of files, skipping (and logging)
+    any file that disappeared or can't be read.
+
+    Args:
+        files (list[tuple[str, os.stat_result | None]]): Paths to the image files
+            along with their ``os.stat`` results, if already known.
+        read_budget (int, optional): Byte budget of the EXIF header parser.
+            Defaults to DEFAULT_READ_BUDGET.
+
+    Returns:
+        list[PhotoData]: Metadata records in the order of ``files``.
+    """
+    res: list[PhotoData] = []
+    for p, st in files:
+        try:
+            raw = dict(zip(RAW_FIELDS, read_raw_metadata(p, read_budget)))
+            res.append(to_photo_data(p, raw, st=st))
+        except OSError as e:
+            logger.warning(f"Skipping {p}: {e}")
+    return res
 
 
 class MetadataExtractor:
-    def __init__(self, image_paths: tuple[Path], hash_images: bool = False):
+    def __init__(
+        self,
+        image_paths: tuple[Path],
+        hash_images: bool = False,
+        jobs: int = 1,
+        read_budget: int = DEFAULT_READ_BUDGET,
+    ):
         logger.info("Collecting metadata from image files.")
         self.paths: tuple[Path] = image_paths
         self.__hash_images = hash_images
+        self.__jobs = max(1, jobs)
+        self.__read_budget = read_budget
         self._raw_metadata = self.__raw_metadata()
 
     def __raw_metadata(self) -> dict[str, dict[str, Any]]:
@@ -42,132 +240,25 @@ class MetadataExtractor:
         # using Image object because the latter eats too much memory
         # and has caused crashes in the past. With this memory 
         # issues are solved.
-        data: dict[str, dict[str, Any]] = {}
-        for p in self.paths:
-            with open(p, "rb") as f:
-                tmp = Image(f)
-                try:
-                    lat = tmp.get('gps_latitude')
-                    lat_ref = tmp.get('gps_latitude_ref')
-                    lon = tmp.get('gps_longitude')
-                    lon_ref = tmp.get('gps_longitude_ref')
-                    alt = tmp.get('gps_altitude')
-                except (AttributeError, KeyError):
-                    lat = lon = alt = None
-                    lat_ref = lon_ref = None
-                    
-                try:
-                    date = tmp.get('datetime_original') or '1900:1:1 00:00:00'
-                except (AttributeError, KeyError):
-                    date = '1900:1:1 00:00:00'
-                    
-                try:
-                    hor_pos = tmp.get('gps_horizontal_positioning_error')
-                    direct = tmp.get('gps_img_direction')
-                except (AttributeError, KeyError):
-                    hor_pos = direct = -999
-                    
-                try:
-                    mk = tmp.get('make')
-                    mod = tmp.get('model') 
-                except (AttributeError, KeyError):
-                    mk = "unknown device"
-                    mod = "unknown model"
-                
-                
-                data[str(p)] = {'gps_latitude': lat,
-                    'gps_latitude_ref': lat_ref,
-                    'gps_longitude': lon,
-                    'gps_longitude_ref': lon_ref,
-                    'gps_altitude': alt,
-                    'datetime_original': date,
-                    'gps_horizontal_positioning_error': hor_pos,
-                    'gps_img_direction': direct,
-                    'make': mk,
-                    'model': mod                 
-                }
-        return data
+        paths = [str(p) for p in self.paths]
+        if self.__jobs == 1 or len(paths) < 2:
+            values = _read_chunk(paths, self.__read_budget)
+        else:
+            # a few chunks per worker keeps them all busy when some folders
+            # have much larger files than others, while executor.map still
+            # returns the chunks in submission order
+            size = max(1, -(-len(paths) // (self.__jobs * 4)))
+            logger.info(f"Extracting metadata with {self.__jobs} worker processes.")
+            with ProcessPoolExecutor(max_workers=self.__jobs) as ex:
+                values = list(chain.from_iterable(ex.map(partial(_read_chunk, read_budget=self.__read_budget), _chunks(paths, size))))
+        return {p: dict(zip(RAW_FIELDS, v)) for p, v in zip(paths, values)}
 
     @property
     def metadata(self) -> list[PhotoData]:
-        res: list[PhotoData] = []
-        for cnt, (pth, dic) in enumerate(self._raw_metadata.items(), start=1):
-            # logger.info(f"Processing image {cnt}/{len(self._raw_metadata)}")
-            try:
-                lat = self._convert_coords_to_decimal(dic['gps_latitude'], dic['gps_latitude_ref'])
-                lon = self._convert_coords_to_decimal(dic['gps_longitude'], dic['gps_longitude_ref'])
-                alt = dic['gps_altitude']
-            except (AttributeError, KeyError):
-                lat = lon = alt = -999
-
-            # when getting dates so images (like those sent through WhataApp, Telegram etc)
-            # won't have correct date recorded so instead we take the last modified date
-            # and select it instead            
-            try:                
-                timestamp = dt.datetime.strptime(dic['datetime_original'], "%Y:%m:%d %H:%M:%S")
-            except (AttributeError, KeyError, ValueError):
-                ts = os.path.getmtime(pth)
-                timestamp = dt.datetime.utcfromtimestamp(ts)
-            else:
-                # if the image has datetime recorded we check whether it is in the future
-                # (due to incorrect camera setup and such) or whether it is before 1/1/1970
-                # and if either of these is true then we take modified date still
-                if timestamp > dt.datetime.now() or timestamp < dt.datetime(1970, 1, 1):
-                    ts = os.path.getmtime(pth)
-                    timestamp = dt.datetime.utcfromtimestamp(ts)                
-
-            gps_accuracy = dic['gps_horizontal_positioning_error']
-            photo_direction = dic['gps_img_direction']
-            camera_make = dic['make']
-            camera_model = dic['model']
-
-            if self.__hash_images:
-                logger.debug("Calculating image hashes.")
-                t = time.time()
-                im = PILImage.open(str(pth))
-                phash = str(imh.phash(im))
-                chash = str(imh.colorhash(im))
-                print(f"Hashing image took {time.time() - t} seconds")
-            else:
-                phash = chash = None
-
-            res.append(
-                PhotoData(
-                    path=pth,
-                    latitude=lat,
-                    longitude=lon,
-                    altitude=alt,
-                    timestamp=timestamp,
-                    gps_accuracy=gps_accuracy,
-                    photo_direction=photo_direction,
-                    camera_make=camera_make,
-                    camera_model=camera_model,
-                    phash=phash,
-                    colorhash=chash,
-                )
-            )
-        return res
+        return [to_photo_data(pth, dic, self.__hash_images) for pth, dic in self._raw_metadata.items()]
 
     def _convert_coords_to_decimal(self, coords: tuple[float, ...], ref: str) -> float:
-        """Covert a tuple of coordinates in the format (degrees, minutes, seconds)
-        and a reference to a decimal representation.
-
-        Args:
-            coords (tuple[float,...]): A tuple of degrees, minutes and seconds
-            ref (str): Hemisphere reference of "N", "S", "E" or "W".
-
-        Returns:
-            float: A signed float of decimal representation of the coordinate.
-        """
-        if ref.upper() in {"W", "S"}:
-            mul = -1
-        elif ref.upper() in {"E", "N"}:
-            mul = 1
-        else:
-            msg = f"Incorrect hemisphere reference. Expecting one of 'N', 'S', 'E' or 'W', got {ref} instead."
-            logger.debug(msg)
-            raise ValueError(msg)
-        return mul * (coords[0] + coords[1] / 60 + coords[2] / 3600)
+        return convert_coords_to_decimal(coords, ref)
 
 
 if __name__ == "__main__":
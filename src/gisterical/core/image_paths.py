@@ -1,31 +1,119 @@
+import os
 from pathlib import Path
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+from loguru import logger
+
+
+IMAGE_EXTENSIONS: tuple[str, ...] = (
+    ".jpg",
+    ".jpeg",
+    ".tif",
+    ".tiff",
+    ".bmp",
+    ".gif",
+    ".png",
+)
+
+
+def _scan_dir(
+    folder: str, extensions: frozenset[str]
+) -> tuple[list[tuple[Path, os.stat_result]], list[str], list[str]]:
+    """List a single directory returning matching files with their stat
+    results, the subdirectories that still need to be scanned and the paths
+    that couldn't be read."""
+    files: list[tuple[Path, os.stat_result]] = []
+    subdirs: list[str] = []
+    failed: list[str] = []
+    try:
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        logger.warning(f"Could not scan {folder}: {e}")
+        return files, subdirs, [folder]
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+                files.append((Path(entry.path), entry.stat()))
+        except OSError as e:
+            logger.warning(f"Skipping {entry.path}: {e}")
+            failed.append(entry.path)
+    return files, subdirs, failed
+
+
+def scan_images(
+    folders: list[str | Path],
+    search_extensions: tuple[str, ...] = IMAGE_EXTENSIONS,
+    workers: int = 1,
+    failed: list[str] | None = None,
+) -> Iterator[tuple[Path, os.stat_result]]:
+    """Walk the folders once, matching extensions case-insensitively, and
+    lazily yield image paths along with their ``os.stat`` results.
+
+    Args:
+        folders (list[str | Path]): Folders to search recursively.
+        search_extensions (tuple[str, ...], optional): File extensions to look for.
+            Defaults to IMAGE_EXTENSIONS.
+        workers (int, optional): Number of threads scanning directories concurrently,
+            which mostly helps on network filesystems. Defaults to 1.
+        failed (list[str] | None, optional): List to add the directories and files that
+            couldn't be read to, everything under them is missing from the results.
+            Defaults to None.
+
+    Yields:
+        Iterator[tuple[Path, os.stat_result]]: Image paths and their stat results.
+    """
+    extensions = frozenset(e.lower() for e in search_extensions)
+    todo = [str(f) for f in reversed(folders)]
+    failed = [] if failed is None else failed
+
+    if workers <= 1:
+        while todo:
+            files, subdirs, errors = _scan_dir(todo.pop(), extensions)
+            failed.extend(errors)
+            yield from files
+            # depth-first in name order, same as a recursive walk
+            todo.extend(reversed(subdirs))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        pending: set[Future] = {ex.submit(_scan_dir, f, extensions) for f in todo}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                files, subdirs, errors = fut.result()
+                failed.extend(errors)
+                pending.update(ex.submit(_scan_dir, d, extensions) for d in subdirs)
+                yield from files
+
+
+def iter_paths(
+    folders: list[str | Path],
+    search_extensions: tuple[str, ...] = IMAGE_EXTENSIONS,
+) -> Iterator[Path]:
+    """Lazily yield image paths found under the given folders.
+
+    Args:
+        folders (list[str | Path]): Folders to search recursively.
+        search_extensions (tuple[str, ...], optional): File extensions to look for.
+            Defaults to IMAGE_EXTENSIONS.
+
+    Yields:
+        Iterator[Path]: Paths of the image files.
+    """
+    for p, _ in scan_images(folders, search_extensions):
+        yield p
 
 
 def get_paths(
     folders: list[str | Path],
-    search_extensions: tuple[str, ...] = (
-        ".jpg",
-        ".jpeg",
-        ".tif",
-        ".tiff",
-        ".bmp",
-        ".gif",
-        ".png",
-    ),
+    search_extensions: tuple[str, ...] = IMAGE_EXTENSIONS,
 ) -> tuple[Path]:
-    all_files: list[Path] = []
-    for fol in folders:
-        if isinstance(fol, str):
-            fol = Path(fol)
-        
-        # on occasion extensions can be in upper case so adding
-        # a second array containing uppercase extensions
-        ext = list(search_extensions)
-        extensions = ext + [i.upper() for i in ext]
-        
-        for e in extensions:
-            all_files.extend(list(fol.rglob(f"*{e}")))
-    return tuple(all_files)
+    return tuple(iter_paths(folders, search_extensions))
 
 
 if __name__ == "__main__":
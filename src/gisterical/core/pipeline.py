@@ -0,0 +1,260 @@
+import os
+import threading
+from queue import Queue, Empty, Full
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+from loguru import logger
+
+from gisterical.core.exif_reader import DEFAULT_READ_BUDGET
+from gisterical.core.image_hash import hash_image, hash_rows
+from gisterical.core.image_metadata import PhotoData, read_photo_data
+from gisterical.core.image_paths import scan_images
+from gisterical.database.db_api import DbApi
+
+
+_DONE = object()
+
+
+class _Stopped(Exception):
+    """Raised inside a stage when another stage has failed."""
+
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    batch: list[Any] = []
+    for i in items:
+        batch.append(i)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _ordered_map(
+    ex: Executor, fn: Callable[[list[Any]], list[Any]], items: Iterable[Any], chunk: int, depth: int
+) -> Iterator[Any]:
+    """Map ``fn`` over chunks of ``items`` on an executor keeping at most
+    ``depth`` chunks in flight and yielding results in input order."""
+    pending: deque = deque()
+    for batch in _batched(items, chunk):
+        pending.append(ex.submit(fn, batch))
+        if len(pending) >= depth:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def _hash_chunk(data: list[PhotoData]) -> list[PhotoData]:
+    for d in data:
+        try:
+            d.phash, d.colorhash = hash_image(d.path)
+        except Exception as e:
+            logger.warning(f"Could not hash {d.path}: {e}")
+    return data
+
+
+class IngestPipeline:
+    """Streaming scan -> extract -> hash -> insert pipeline.
+
+    Every stage runs in its own thread and passes records to the next one
+    through a bounded queue, so a slow stage (usually the database) blocks
+    the ones before it instead of letting records pile up in memory.
+
+    Files already in the database with unchanged size, modification time
+    and inode are skipped during discovery, and with ``prune`` the rows of
+    files that no longer exist under the scanned folders are removed.
+    """
+
+    def __init__(
+        self,
+        api: DbApi,
+        hash_images: bool = False,
+        jobs: int = 1,
+        batch_size: int = 500,
+        queue_size: int = 1000,
+        read_budget: int = DEFAULT_READ_BUDGET,
+        prune: bool = False,
+        scan_workers: int = 1,
+    ):
+        self.api = api
+        self.hash_images = hash_images
+        self.jobs = max(1, jobs)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.read_budget = read_budget
+        self.prune = prune
+        self.scan_workers = scan_workers
+        self._known: dict[str, tuple[int, float, int]] = {}
+        # directories and files discovery couldn't read
+        self._failed: list[str] = []
+        self._skipped = 0
+        self._pool: Executor | None = None
+        self._stop = threading.Event()
+        self._errors: list[BaseException] = []
+
+    def run(self, folders: list[str | Path]) -> int:
+        """Ingest all images found under ``folders``.
+
+        Args:
+            folders (list[str | Path]): Folders to scan for images.
+
+        Returns:
+            int: Number of records passed to the database.
+        """
+        self._stop.clear()
+        self._errors = []
+        folders = [os.path.abspath(f) for f in folders]
+        self._known = self.api.get_known_files(folders)
+        self._failed = []
+        self._skipped = 0
+        stages: list[Callable[[Iterator[Any]], Iterator[Any]]] = [self._extract]
+        if self.hash_images:
+            stages.append(self._hash)
+
+        self._pool = ProcessPoolExecutor(max_workers=self.jobs) if self.jobs > 1 else None
+        queues: list[Queue] = [Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+        threads = [threading.Thread(target=self._run_stage, args=(partial(self._discover, folders), queues[0]))]
+        for i, stage in enumerate(stages):
+            threads.append(
+                threading.Thread(target=self._run_stage, args=(partial(stage, self._drain(queues[i])), queues[i + 1]))
+            )
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        cnt = 0
+        try:
+            for batch in _batched(self._drain(queues[-1]), self.batch_size):
+                self.api.add_photo_to_db(batch)
+                cnt += len(batch)
+                logger.info(f"{cnt} images added to the database.")
+        except _Stopped:
+            pass
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            for t in threads:
+                t.join()
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+        if self._errors:
+            raise self._errors[0]
+        logger.info(f"{cnt} new or changed images added, {self._skipped} unchanged images skipped.")
+        if cnt:
+            self.api.analyze()
+            self.api.resolve_locations()
+        if self.prune and self._known:
+            # whatever discovery didn't pop from the known files is gone from
+            # disk, unless it's under a directory that couldn't be read
+            failed = set(self._failed)
+            prefixes = tuple(os.path.join(p, "") for p in failed)
+            gone = [p for p in self._known if p not in failed and not p.startswith(prefixes)]
+            if len(gone) < len(self._known):
+                logger.warning(
+                    f"Not pruning {len(self._known) - len(gone)} images under {len(self._failed)} "
+                    "paths that couldn't be read."
+                )
+            if gone:
+                self.api.remove_photos(gone)
+        return cnt
+
+    def _discover(self, folders: list[str]) -> Iterator[tuple[str, os.stat_result]]:
+        for p, st in scan_images(folders, workers=self.scan_workers, failed=self._failed):
+            path = str(p)
+            if self._known.pop(path, None) == (st.st_size, st.st_mtime, st.st_ino):
+                self._skipped += 1
+                continue
+            yield path, st
+
+    def _extract(self, paths: Iterator[tuple[str, os.stat_result]]) -> Iterator[PhotoData]:
+        fn = partial(read_photo_data, read_budget=self.read_budget)
+        if self._pool is None:
+            for batch in _batched(paths, 64):
+                yield from fn(batch)
+        else:
+            yield from _ordered_map(self._pool, fn, paths, 64, self.jobs * 2)
+
+    def _hash(self, data: Iterator[PhotoData]) -> Iterator[PhotoData]:
+        if self._pool is None:
+            for batch in _batched(data, 16):
+                yield from _hash_chunk(batch)
+        else:
+            yield from _ordered_map(self._pool, _hash_chunk, data, 16, self.jobs * 2)
+
+    def _run_stage(self, stage: Callable[[], Iterator[Any]], q_out: Queue) -> None:
+        try:
+            for item in stage():
+                self._put(q_out, item)
+        except _Stopped:
+            return
+        except BaseException as e:
+            logger.exception(f"Ingest stage failed: {e}")
+            self._errors.append(e)
+            self._stop.set()
+            return
+        try:
+            self._put(q_out, _DONE)
+        except _Stopped:
+            pass
+
+    def _put(self, q: Queue, item: Any) -> None:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _drain(self, q: Queue) -> Iterator[Any]:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                item = q.get(timeout=0.1)
+            except Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+
+def backfill_hashes(api: DbApi, jobs: int = 1, batch_size: int = 500) -> int:
+    """Calculate hashes for images already in the database that were
+    added without ``--hash``.
+
+    Args:
+        api (DbApi): Database api instance.
+        jobs (int, optional): Number of worker processes. Defaults to 1.
+        batch_size (int, optional): Number of images fetched and updated at once. Defaults to 500.
+
+    Returns:
+        int: Number of images hashed.
+    """
+    cnt = 0
+    last_id = 0
+    ex = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        while True:
+            rows = api.get_unhashed_images(after_id=last_id, limit=batch_size)
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            if ex is None:
+                res = hash_rows(rows)
+            else:
+                res = list(_ordered_map(ex, hash_rows, rows, max(1, len(rows) // (jobs * 4)), jobs * 4))
+            api.update_hashes(res)
+            cnt += len(res)
+            logger.info(f"{cnt} images hashed.")
+    finally:
+        if ex is not None:
+            ex.shutdown(cancel_futures=True)
+    return cnt
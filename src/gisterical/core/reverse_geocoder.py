@@ -0,0 +1,439 @@
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+from scipy.spatial import cKDTree
+from loguru import logger
+
+from gisterical import registry
+from gisterical.database.city_policy import check_city_policy
+from gisterical.database.db_api import DbApi
+from gisterical.database.schema import read_cities
+from gisterical.util import geohash
+from gisterical.util.file_meta import FileMeta
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+# bump when the layout of the cached arrays or the reading of the files changes
+_CACHE_VERSION = 2
+_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "gisterical"
+# average number of polygon edges per latitude band of a country
+_EDGES_PER_BAND = 32
+_MAX_BANDS = 4096
+# number of points tested against the country polygons at once
+_POINT_BLOCK = 50_000
+
+
+def _to_xyz(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _ranges(start: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """Concatenated ``range(start[i], start[i] + count[i])`` for every i."""
+    return np.repeat(start, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+
+
+def _chord(distance_km: float) -> float:
+    """Straight line distance through the unit sphere for a distance along its surface."""
+    return 2 * np.sin(min(distance_km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def _rings(geometry: dict[str, Any]) -> list[np.ndarray]:
+    if geometry is None:
+        return []
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return []
+    return [np.asarray(ring, dtype=np.float64)[:, :2] for poly in polygons for ring in poly if len(ring) > 2]
+
+
+def _country_edges(rings: list[np.ndarray]) -> np.ndarray:
+    """Edges of all rings of a country as rows of x1, y1, x2, y2 without the
+    horizontal ones, which can never cross a horizontal ray."""
+    edges = np.concatenate([np.hstack([r, np.roll(r, -1, axis=0)]) for r in rings])
+    return edges[edges[:, 1] != edges[:, 3]]
+
+
+def _cache_key(*paths: Path) -> str:
+    # file size and modification time instead of a checksum of the
+    # contents, so that finding the cache doesn't read the source files
+    h = hashlib.sha256(str(_CACHE_VERSION).encode())
+    for p in paths:
+        st = p.stat()
+        h.update(f"{p.resolve()}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()[:32]
+
+
+def _build_cities(path: Path) -> dict[str, np.ndarray]:
+    rows = [c for c in read_cities(path) if c[2] is not None and c[3] is not None]
+    lat = np.array([c[2] for c in rows], dtype=np.float64)
+    lon = np.array([c[3] for c in rows], dtype=np.float64)
+    return {
+        "city_name": np.array([c[0] or "" for c in rows], dtype=str),
+        # cities without population sort last, as with NULLS LAST in the database
+        "city_population": np.array([-1 if c[4] is None else c[4] for c in rows], dtype=np.int64),
+        "city_xyz": _to_xyz(lat, lon),
+    }
+
+
+def _build_countries(path: Path) -> dict[str, np.ndarray]:
+    with open(path, "r", encoding="utf-8") as f:
+        features = json.load(f)["features"]
+
+    names, bboxes, bands, cells, edges = [], [], [], [], []
+    for feat in features:
+        rings = _rings(feat.get("geometry"))
+        if not rings:
+            continue
+        e = _country_edges(rings)
+        pts = np.concatenate(rings)
+        minx, miny = pts.min(axis=0)
+        maxx, maxy = pts.max(axis=0)
+        nb = int(min(_MAX_BANDS, max(1, len(e) // _EDGES_PER_BAND)))
+        height = (maxy - miny) / nb or 1.0
+
+        # an edge goes into every latitude band its y range overlaps, so a
+        # point only has to be tested against the edges of its own band
+        lo = np.clip(((np.minimum(e[:, 1], e[:, 3]) - miny) / height).astype(np.int64), 0, nb - 1)
+        hi = np.clip(((np.maximum(e[:, 1], e[:, 3]) - miny) / height).astype(np.int64), 0, nb - 1)
+        reps = hi - lo + 1
+        band = _ranges(lo, reps)
+        order = np.argsort(band, kind="stable")
+
+        names.append((feat.get("properties") or {}).get("ADMIN") or "")
+        bboxes.append((minx, miny, maxx, maxy))
+        bands.append(nb)
+        cells.append(np.bincount(band, minlength=nb))
+        edges.append(np.repeat(e, reps, axis=0)[order])
+
+    counts = np.concatenate(cells) if cells else np.empty(0, dtype=np.int64)
+    return {
+        "country_name": np.array(names, dtype=str),
+        "country_bbox": np.array(bboxes, dtype=np.float64).reshape(-1, 4),
+        "country_bands": np.array(bands, dtype=np.int64),
+        # first cell of every country in the cell_start offsets
+        "country_cell": (np.cumsum(bands, dtype=np.int64) - bands).astype(np.int64),
+        "cell_start": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        "edges": np.concatenate(edges) if edges else np.empty((0, 4)),
+    }
+
+
+class ReverseGeocoder:
+    """In-process lookup of the nearest city and the country containing a
+    point, built from the same cities and countries files as the database.
+
+    Cities are kept in a KD-tree over their coordinates on the unit sphere,
+    so a straight line (chord) distance bound is equivalent to a great circle
+    distance bound. Countries are prefiltered by bounding box and then tested
+    with a vectorized even-odd ray cast against the polygon edges, which are
+    split into latitude bands so that each point is only tested against the
+    edges its ray could cross.
+
+    The arrays are saved as ``.npy`` files in a cache directory keyed by the
+    source files and memory-mapped when loaded again. Only the KD-tree is
+    rebuilt on load, which takes milliseconds for the bundled cities file.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.city_name = arrays["city_name"]
+        self.city_population = arrays["city_population"]
+        self.country_name = arrays["country_name"]
+        self._tree = cKDTree(arrays["city_xyz"])
+
+    @classmethod
+    def build(cls, cities_path: Path, countries_path: Path) -> "ReverseGeocoder":
+        """Build the geocoder from the source files.
+
+        Args:
+            cities_path (Path): Cities CSV (or GeoNames dump).
+            countries_path (Path): Country boundaries GeoJSON.
+
+        Returns:
+            ReverseGeocoder: New geocoder.
+        """
+        return cls({**_build_cities(cities_path), **_build_countries(countries_path)})
+
+    @classmethod
+    def load(
+        cls,
+        cities_path: Path | None = None,
+        countries_path: Path | None = None,
+        cache_dir: Path | None = _CACHE_DIR,
+    ) -> "ReverseGeocoder":
+        """Load the geocoder from the cache, building and caching it first if
+        the source files changed since it was last built.
+
+        Args:
+            cities_path (Path | None, optional): Cities file. Defaults to the one in the settings.
+            countries_path (Path | None, optional): Countries file. Defaults to the one in the settings.
+            cache_dir (Path | None, optional): Cache directory or None to always build. Defaults to
+                ``$XDG_CACHE_HOME/gisterical``.
+
+        Returns:
+            ReverseGeocoder: Loaded geocoder.
+        """
+        data = Path(__file__).parent.parent
+        settings = registry.settings()
+        cities_path = Path(cities_path or data / settings.cities_data)
+        countries_path = Path(countries_path or data / settings.countries_data)
+        if cache_dir is None:
+            return cls.build(cities_path, countries_path)
+
+        target = Path(cache_dir) / f"geocoder-{_cache_key(cities_path, countries_path)}"
+        if not target.is_dir():
+            logger.info(f"Building reverse geocoder cache in {target}.")
+            geocoder = cls.build(cities_path, countries_path)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # write next to the final location and rename so that a
+            # concurrent or interrupted build never leaves a partial cache
+            tmp = Path(tempfile.mkdtemp(dir=target.parent, prefix=".geocoder-"))
+            try:
+                for name, arr in geocoder.arrays.items():
+                    np.save(tmp / f"{name}.npy", arr)
+                tmp.rename(target)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)
+                if not target.is_dir():
+                    raise
+            return geocoder
+        return cls({p.stem: np.load(p, mmap_mode="r") for p in target.glob("*.npy")})
+
+    def nearest_cities(
+        self, lat: np.ndarray, lon: np.ndarray, max_distance_km: float = np.inf
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Nearest city to every point.
+
+        Args:
+            lat (np.ndarray): Latitudes of the points.
+            lon (np.ndarray): Longitudes of the points.
+            max_distance_km (float, optional): Maximum distance to the city. Defaults to no limit.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Index of the city, -1 if there is none within
+                the distance, and the distance in kilometres.
+        """
+        if not len(self.city_name):
+            return np.full(len(lat), -1), np.full(len(lat), np.inf)
+        bound = _chord(max_distance_km) if np.isfinite(max_distance_km) else np.inf
+        chord, idx = self._tree.query(_to_xyz(lat, lon), distance_upper_bound=bound, workers=-1)
+        found = np.isfinite(chord)
+        idx = np.where(found, idx, -1)
+        dist = np.full(len(idx), np.inf)
+        dist[found] = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord[found] / 2, 1))
+        return idx, dist
+
+    def largest_cities(self, lat: np.ndarray, lon: np.ndarray, max_distance_km: float) -> np.ndarray:
+        """Most populous city within ``max_distance_km`` of every point.
+
+        Returns:
+            np.ndarray: Index of the city, -1 if there is none within the distance.
+        """
+        res = np.full(len(lat), -1)
+        if not len(self.city_name) or not len(lat):
+            return res
+        balls = self._tree.query_ball_point(_to_xyz(lat, lon), _chord(max_distance_km), workers=-1)
+        cnt = np.fromiter(map(len, balls), dtype=np.int64, count=len(balls))
+        if not cnt.any():
+            return res
+        cities = np.concatenate([b for b in balls if b]).astype(np.int64)
+        point = np.repeat(np.arange(len(balls)), cnt)
+        # sorted by point and then by population, the last city of every point wins
+        order = np.lexsort((self.city_population[cities], point))
+        last = np.cumsum(cnt[cnt > 0]) - 1
+        res[point[order][last]] = cities[order][last]
+        return res
+
+    def countries(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        """Country containing every point.
+
+        Returns:
+            np.ndarray: Index of the country, -1 for points outside of all countries.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        res = np.full(len(lat), -1)
+        for start in range(0, len(lat), _POINT_BLOCK):
+            block = slice(start, start + _POINT_BLOCK)
+            res[block] = self._countries(lat[block], lon[block])
+        return res
+
+    def _countries(self, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+        a = self.arrays
+        bbox = a["country_bbox"]
+        res = np.full(len(lat), -1)
+
+        # candidate (point, country) pairs from the bounding boxes: points
+        # sorted by longitude give the ones within the longitude span of every
+        # country with two binary searches, only those are checked for latitude
+        order = np.argsort(lon)
+        lon_sorted = lon[order]
+        lo = np.searchsorted(lon_sorted, bbox[:, 0], side="left")
+        cnt = np.searchsorted(lon_sorted, bbox[:, 2], side="right") - lo
+        p = order[_ranges(lo, cnt)]
+        c = np.repeat(np.arange(len(bbox)), cnt)
+        keep = (lat[p] >= bbox[c, 1]) & (lat[p] <= bbox[c, 3])
+        p, c = p[keep], c[keep]
+        if not len(p):
+            return res
+
+        nb = a["country_bands"][c]
+        height = (bbox[c, 3] - bbox[c, 1]) / nb
+        height[height == 0] = 1.0
+        band = np.clip(((lat[p] - bbox[c, 1]) / height).astype(np.int64), 0, nb - 1)
+        cell = a["country_cell"][c] + band
+        lo = a["cell_start"][cell]
+        cnt = a["cell_start"][cell + 1] - lo
+
+        # every pair against every edge of its band, flattened
+        pair = np.repeat(np.arange(len(p)), cnt)
+        e = a["edges"][_ranges(lo, cnt)]
+        px, py = lon[p][pair], lat[p][pair]
+        x1, y1, x2, y2 = e[:, 0], e[:, 1], e[:, 2], e[:, 3]
+        crosses = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+        hit = np.bincount(pair[crosses], minlength=len(p)) % 2 == 1
+
+        # pairs are ordered by country, so the first match of every point is
+        # the first country in the file, like LIMIT 1 in the database
+        p, first = np.unique(p[hit], return_index=True)
+        res[p] = c[hit][first]
+        return res
+
+
+class OfflineLocations:
+    """Location queries used for sorting, answered by a ``ReverseGeocoder``
+    instead of PostGIS. Only the image paths, dates and coordinates are read
+    from the database.
+    """
+
+    def __init__(self, api: DbApi, geocoder: ReverseGeocoder | None = None):
+        self.api = api
+        self.geocoder = geocoder or ReverseGeocoder.load()
+
+    def _located(self) -> tuple[list[tuple], np.ndarray, np.ndarray]:
+        rows = self.api.get_photo_coordinates()
+        lat = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+        lon = np.fromiter((r[3] for r in rows), dtype=np.float64, count=len(rows))
+        return rows, lat, lon
+
+    def _cities(self, lat: np.ndarray, lon: np.ndarray, distance_km: int, policy: str) -> np.ndarray:
+        check_city_policy(policy)
+        if policy == "largest":
+            return self.geocoder.largest_cities(lat, lon, distance_km)
+        return self.geocoder.nearest_cities(lat, lon, distance_km)[0]
+
+    def resolve_locations(self) -> int:
+        return 0
+
+    def iter_sort_rows(
+        self,
+        countries: bool,
+        cities: bool,
+        distance_km: int | None = None,
+        policy: str = "nearest",
+        batch_size: int = 10000,
+        geohash_precision: int | None = None,
+    ) -> Iterator[tuple]:
+        """Same rows as ``DbApi.iter_sort_rows``, geocoding every batch of
+        coordinates streamed from the database as it arrives."""
+        check_city_policy(policy)
+        if not countries and not cities:
+            yield from self.api.iter_sort_rows(
+                False, False, batch_size=batch_size, geohash_precision=geohash_precision
+            )
+            return
+        city_names, country_names = self.geocoder.city_name, self.geocoder.country_name
+        for batch in self.api.iter_photo_coordinates(batch_size):
+            located = [r for r in batch if r[2] is not None and r[3] is not None]
+            lat = np.fromiter((r[2] for r in located), dtype=np.float64, count=len(located))
+            lon = np.fromiter((r[3] for r in located), dtype=np.float64, count=len(located))
+            city = self._cities(lat, lon, distance_km, policy) if cities else np.zeros(len(located), dtype=np.int64)
+            country = self.geocoder.countries(lat, lon) if countries else np.zeros(len(located), dtype=np.int64)
+            if geohash_precision is not None:
+                cells = geohash.encode_array(lat, lon, geohash_precision).tolist()
+            else:
+                cells = [''] * len(located)
+            for r in batch:
+                if r[2] is None or r[3] is None:
+                    yield (r[0], r[1], "Uknown", "Unknown", "Unknown" if geohash_precision is not None else '')
+            for r, ci, co, cell in zip(located, city.tolist(), country.tolist(), cells):
+                if ci >= 0 and co >= 0:
+                    yield (
+                        r[0],
+                        r[1],
+                        str(country_names[co]) if countries else '',
+                        str(city_names[ci]) if cities else '',
+                        cell,
+                    )
+
+    def get_city_rows(self, distance_km: int, policy: str = "nearest", with_country: bool = False) -> list[tuple]:
+        rows, lat, lon = self._located()
+        city = self._cities(lat, lon, distance_km, policy)
+        country = self.geocoder.countries(lat, lon) if with_country else np.zeros(len(rows), dtype=np.int64)
+        city_names, country_names = self.geocoder.city_name, self.geocoder.country_name
+        return [
+            (r[0], r[1], str(country_names[co]) if with_country else '', str(city_names[ci]))
+            for r, ci, co in zip(rows, city.tolist(), country.tolist()) if ci >= 0 and co >= 0
+        ]
+
+    def get_country_rows(self) -> list[tuple]:
+        rows, lat, lon = self._located()
+        country = self.geocoder.countries(lat, lon)
+        names = self.geocoder.country_name
+        return [(r[0], r[1], str(names[co]), '') for r, co in zip(rows, country.tolist()) if co >= 0]
+
+    def get_no_location_rows(self) -> list[tuple]:
+        return self.api.get_no_location_rows()
+
+    def get_path_date_rows(self) -> list[tuple]:
+        return self.api.get_path_date_rows()
+
+    def get_photos_by_city(self, distance_km: int, policy: str = "nearest") -> list[FileMeta]:
+        return [FileMeta.from_row(r) for r in self.get_city_rows(distance_km, policy)]
+
+    def get_photo_city_country(self, distance_km: int, policy: str = "nearest") -> list[FileMeta]:
+        return [FileMeta.from_row(r) for r in self.get_city_rows(distance_km, policy, with_country=True)]
+
+    def get_photo_country(self) -> list[FileMeta]:
+        return [FileMeta.from_row(r) for r in self.get_country_rows()]
+
+    def get_photo_no_location(self) -> list[FileMeta]:
+        return self.api.get_photo_no_location()
+
+    def get_photo_path_date(self) -> list[FileMeta]:
+        return self.api.get_photo_path_date()
+
+
+if __name__ == "__main__":
+    # python -m gisterical.core.reverse_geocoder [n_points]
+    import sys
+    import time
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    t = time.perf_counter()
+    geocoder = ReverseGeocoder.load()
+    print(f"loaded in {time.perf_counter() - t:.3f} s")
+
+    rng = np.random.default_rng(0)
+    lat = np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+    lon = rng.uniform(-180, 180, n)
+
+    t = time.perf_counter()
+    city, _ = geocoder.nearest_cities(lat, lon, 50)
+    t_city = time.perf_counter() - t
+    t = time.perf_counter()
+    country = geocoder.countries(lat, lon)
+    t_country = time.perf_counter() - t
+    print(f"{n} points: nearest city in {t_city:.3f} s ({(city >= 0).sum()} found), "
+          f"country in {t_country:.3f} s ({(country >= 0).sum()} found)")
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from typing import Iterable, TextIO
+
+from loguru import logger
+
+from gisterical.util.file_ops import same_path
+
+
+JOURNAL_NAME = ".gisterical-journal.jsonl"
+# modes leaving an independent copy of the file at the target
+_COPY_MODES = ("copy", "reflink")
+
+
+class SortJournal:
+    """Append-only record of the files placed in an output folder.
+
+    Every placed file adds one JSON line with its source path, the target
+    path, the size and modification time the source had at the time and how
+    it was placed, so an interrupted or repeated sort into the same folder
+    can tell which targets are already up to date and skip them.
+    """
+
+    def __init__(self, folder: str | Path, mode: str = "copy"):
+        self.path = Path(folder) / JOURNAL_NAME
+        self.mode = mode
+        self.entries: dict[str, tuple[str, int, int, str]] = {}
+        self._f: TextIO | None = None
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                    # journals written before modes were recorded only had copies
+                    self.entries[r["dst"]] = (r["src"], r["size"], r["mtime"], r.get("mode", "copy"))
+                except (ValueError, KeyError, TypeError):
+                    # most likely the last line of an interrupted run
+                    continue
+        logger.info(f"Loaded {len(self.entries)} entries from the sort journal {self.path}.")
+
+    def owner(self, dst: str | Path) -> str | None:
+        """Source path last placed at ``dst``."""
+        e = self.entries.get(str(dst))
+        return e[0] if e else None
+
+    def is_placed(self, src: str | Path, dst: str | Path, st: os.stat_result) -> bool:
+        """Whether ``dst`` already holds the current version of ``src``, placed
+        the way the journal's mode places files.
+
+        Args:
+            src (str | Path): Source file.
+            dst (str | Path): Target path.
+            st (os.stat_result): Current stat result of the source file.
+
+        Returns:
+            bool: True if the source itself is at the target path. Otherwise for links, True
+                if the target is a link of that kind to the source. A source that still exists
+                elsewhere is never placed in move mode. For copies (and hard links to another
+                drive), True if the target is the same file as the source, the journal recorded
+                copying the source with the same size and modification time, or the target has
+                the same size and modification time.
+        """
+        if same_path(src, dst):
+            # the source itself is at the target, replacing it would destroy it
+            return True
+        if self.mode == "move":
+            return False
+        try:
+            dst_st = os.stat(dst)
+            is_link = os.path.islink(dst)
+        except OSError:
+            return False
+        same_file = (dst_st.st_dev, dst_st.st_ino) == (st.st_dev, st.st_ino)
+        if self.mode == "symlink":
+            return is_link and same_file
+        if self.mode == "hardlink" and dst_st.st_dev == st.st_dev:
+            return not is_link and same_file
+        # copies, including hard links across drives, which fall back to copying
+        if is_link:
+            return False
+        if same_file:
+            return True
+        if dst_st.st_size != st.st_size:
+            return False
+        entry = self.entries.get(str(dst))
+        if entry is not None and entry[:3] == (str(src), st.st_size, st.st_mtime_ns):
+            if entry[3] == self.mode or entry[3] in _COPY_MODES:
+                return True
+        return int(dst_st.st_mtime) == int(st.st_mtime)
+
+    def record(self, src: str | Path, dst: str | Path, st: os.stat_result):
+        line = json.dumps(
+            {"src": str(src), "dst": str(dst), "size": st.st_size, "mtime": st.st_mtime_ns, "mode": self.mode}
+        )
+        with self._lock:
+            if self._f is None:
+                self._f = open(self.path, "a", encoding="utf-8", buffering=1)
+            self._f.write(line + "\n")
+            self.entries[str(dst)] = (str(src), st.st_size, st.st_mtime_ns, self.mode)
+
+    def close(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+def _suffixed(dst: Path, src: str) -> Path:
+    digest = hashlib.sha1(src.encode("utf-8", "surrogateescape")).hexdigest()[:8]
+    return dst.with_name(f"{dst.stem}_{digest}{dst.suffix}")
+
+
+def resolve_collisions(
+    transfers: Iterable[tuple[str | Path, Path]], journal: SortJournal | None = None
+) -> list[tuple[str | Path, Path]]:
+    """Give every source its own target when several sources share a file
+    name in the same folder.
+
+    A source that is already at the target keeps the name, then the source
+    placed there according to the journal, or else the one with the
+    smallest path. The others get a suffix derived from their source path,
+    so the names don't change from one run to the next. A target that is
+    the path of another source is suffixed as well, so that no transfer
+    replaces a file before it has been transferred itself.
+
+    Args:
+        transfers (Iterable[tuple[str | Path, Path]]): Pairs of source and target paths.
+        journal (SortJournal | None, optional): Journal of the output folder. Defaults to None.
+
+    Returns:
+        list[tuple[str | Path, Path]]: Pairs with unique target paths.
+    """
+    by_target: dict[Path, list[str | Path]] = {}
+    pending: set[str] = set()
+    for src, dst in transfers:
+        by_target.setdefault(dst, []).append(src)
+        pending.add(os.path.abspath(src))
+
+    res: list[tuple[str | Path, Path]] = []
+    for dst, sources in by_target.items():
+        unique = {str(s): s for s in sources}
+        target = os.path.abspath(dst)
+        here = next((name for name in unique if os.path.abspath(name) == target), None)
+        if here is not None:
+            keep = here
+        elif target in pending:
+            # another source is at the target and goes somewhere else
+            keep = None
+        elif len(unique) == 1:
+            keep = next(iter(unique))
+        else:
+            owner = journal.owner(dst) if journal is not None else None
+            keep = owner if owner in unique else min(unique)
+        for name, src in unique.items():
+            res.append((src, dst if name == keep else _suffixed(dst, name)))
+    return res
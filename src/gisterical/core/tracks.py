@@ -0,0 +1,223 @@
+import json
+import datetime as dt
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+EARTH_RADIUS_M = 6_371_008.8
+# simplified tracks stay within this fraction of the search distance of the
+# original, and the distance is widened by as much so no photo is missed
+SIMPLIFY_FRACTION = 0.1
+
+
+@dataclass
+class Track:
+    """Lines and polygons read from a GPX or GeoJSON file, as arrays of
+    (longitude, latitude) vertices, and the time span of the track when the
+    file records one."""
+
+    lines: list[np.ndarray] = field(default_factory=list)
+    polygons: list[list[np.ndarray]] = field(default_factory=list)
+    start: dt.datetime | None = None
+    end: dt.datetime | None = None
+
+    @property
+    def vertices(self) -> int:
+        return sum(map(len, self.lines)) + sum(len(r) for p in self.polygons for r in p)
+
+    def query_geometry(self, distance_m: float) -> tuple[list[str], float]:
+        """Simplified geometries to search around and the distance to use.
+
+        Args:
+            distance_m (float): Distance from the track in metres.
+
+        Returns:
+            tuple[list[str], float]: WKT of every line and polygon, and the search distance
+                in metres widened by the simplification tolerance.
+        """
+        tolerance = distance_m * SIMPLIFY_FRACTION
+        wkt = [_wkt_line(simplify(line, tolerance)) for line in self.lines]
+        wkt += [_wkt_polygon([_simplify_ring(r, tolerance) for r in rings]) for rings in self.polygons]
+        return wkt, distance_m + tolerance
+
+
+def simplify(points: np.ndarray, tolerance_m: float) -> np.ndarray:
+    """Douglas-Peucker simplification keeping every vertex within
+    ``tolerance_m`` metres of the simplified line. Distances are measured on
+    an equirectangular projection centred on the track, which is accurate
+    enough at the scale of a tolerance.
+
+    Args:
+        points (np.ndarray): (n, 2) array of longitudes and latitudes.
+        tolerance_m (float): Maximum distance of a dropped vertex from the result.
+
+    Returns:
+        np.ndarray: Kept vertices, always including the first and the last one.
+    """
+    n = len(points)
+    if n < 3 or tolerance_m <= 0:
+        return points
+    rad = np.radians(points)
+    xy = np.column_stack((rad[:, 0] * np.cos(rad[:, 1].mean()), rad[:, 1])) * EARTH_RADIUS_M
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    # vertices whose interval is already within the tolerance
+    settled = keep.copy()
+    # every open interval between kept vertices is split at its farthest
+    # vertex in the same pass, instead of one interval at a time
+    while True:
+        cand = np.flatnonzero(~settled)
+        if not len(cand):
+            break
+        kept = np.flatnonzero(keep)
+        interval = np.searchsorted(kept, cand) - 1
+        a, b = xy[kept[interval]], xy[kept[interval + 1]]
+        p, d = xy[cand] - a, b - a
+        length2 = np.einsum("ij,ij->i", d, d)
+        t = np.clip(np.einsum("ij,ij->i", p, d) / np.where(length2 > 0, length2, 1.0), 0.0, 1.0)
+        p -= t[:, None] * d
+        dist = np.einsum("ij,ij->i", p, p)
+
+        starts = np.flatnonzero(np.r_[True, interval[1:] != interval[:-1]])
+        group = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(cand)]))
+        farthest = np.maximum.reduceat(dist, starts)
+        split = farthest > tolerance_m * tolerance_m
+        settled[cand[~split[group]]] = True
+        at_max = np.flatnonzero((dist == farthest[group]) & split[group])
+        _, first = np.unique(group[at_max], return_index=True)
+        keep[cand[at_max[first]]] = True
+        settled[cand[at_max[first]]] = True
+    return points[keep]
+
+
+def _simplify_ring(ring: np.ndarray, tolerance_m: float) -> np.ndarray:
+    # a ring smaller than the tolerance would collapse to a line, and a
+    # polygon needs at least 4 vertices, so small rings are kept as they are
+    simplified = simplify(ring, tolerance_m)
+    return simplified if len(simplified) >= 4 else ring
+
+
+def _coords(points: np.ndarray) -> str:
+    return ", ".join(f"{x:.7f} {y:.7f}" for x, y in points.tolist())
+
+
+def _wkt_line(points: np.ndarray) -> str:
+    return f"LINESTRING({_coords(points)})"
+
+
+def _wkt_polygon(rings: list[np.ndarray]) -> str:
+    return "POLYGON(" + ", ".join(f"({_coords(r)})" for r in rings) + ")"
+
+
+def _parse_time(value: str) -> dt.datetime | None:
+    try:
+        t = dt.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    # EXIF times are local and have no time zone, so compare in local time
+    return t.astimezone().replace(tzinfo=None) if t.tzinfo else t
+
+
+def _time_span(times: list[dt.datetime | None]) -> tuple[dt.datetime | None, dt.datetime | None]:
+    times = [t for t in times if t is not None]
+    return (min(times), max(times)) if times else (None, None)
+
+
+def _read_gpx(path: Path) -> Track:
+    root = ET.parse(path).getroot()
+    ns = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+    track = Track()
+    times = []
+    segments = root.iter(f"{ns}trkseg")
+    routes = root.iter(f"{ns}rte")
+    for seg, tag in [(s, "trkpt") for s in segments] + [(r, "rtept") for r in routes]:
+        pts = seg.findall(f"{ns}{tag}")
+        line = np.array([(float(p.get("lon")), float(p.get("lat"))) for p in pts], dtype=np.float64)
+        if len(line) >= 2:
+            track.lines.append(line)
+        times += [_parse_time(t.text) for p in pts if (t := p.find(f"{ns}time")) is not None and t.text]
+    track.start, track.end = _time_span(times)
+    return track
+
+
+def _geojson_geometries(doc: dict) -> list[tuple[dict, dict]]:
+    if doc.get("type") == "FeatureCollection":
+        return [g for f in doc.get("features", []) for g in _geojson_geometries(f)]
+    if doc.get("type") == "Feature":
+        geom = doc.get("geometry") or {}
+        if geom.get("type") == "GeometryCollection":
+            return [(g, doc.get("properties") or {}) for g in geom.get("geometries", [])]
+        return [(geom, doc.get("properties") or {})]
+    if doc.get("type") == "GeometryCollection":
+        return [(g, {}) for g in doc.get("geometries", [])]
+    return [(doc, {})]
+
+
+def _read_geojson(path: Path) -> Track:
+    with open(path, "r", encoding="utf-8") as f:
+        doc = json.load(f)
+    track = Track()
+    times = []
+    for geom, props in _geojson_geometries(doc):
+        kind, coords = geom.get("type"), geom.get("coordinates") or []
+        if kind == "LineString":
+            coords = [coords]
+        if kind in ("LineString", "MultiLineString"):
+            track.lines += [np.array(c, dtype=np.float64)[:, :2] for c in coords if len(c) >= 2]
+        elif kind == "Polygon":
+            track.polygons.append([np.array(r, dtype=np.float64)[:, :2] for r in coords])
+        elif kind == "MultiPolygon":
+            track.polygons += [[np.array(r, dtype=np.float64)[:, :2] for r in p] for p in coords]
+        # times written by GPX converters, per vertex or per line
+        stamps = props.get("coordTimes") or props.get("times") or []
+        if stamps and isinstance(stamps[0], list):
+            stamps = [t for part in stamps for t in part]
+        times += [_parse_time(t) for t in stamps if isinstance(t, str)]
+    track.start, track.end = _time_span(times)
+    return track
+
+
+def read_track(path: str | Path) -> Track:
+    """Read a track from a GPX file (tracks and routes) or a GeoJSON file
+    (lines and polygons).
+
+    Args:
+        path (str | Path): File path, the format is picked by its extension.
+
+    Raises:
+        ValueError: If the file has no lines or polygons.
+
+    Returns:
+        Track: Geometries and time span of the track.
+    """
+    path = Path(path)
+    track = _read_gpx(path) if path.suffix.lower() == ".gpx" else _read_geojson(path)
+    if not track.lines and not track.polygons:
+        raise ValueError(f"No lines or polygons found in {path}.")
+    return track
+
+
+if __name__ == "__main__":
+    # simplification of a long random walk at a few search distances:
+    # python -m gisterical.core.tracks [vertices]
+    import sys
+    import time
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    rng = np.random.default_rng(0)
+    # roughly 10 m steps, like a GPS logger recording every few seconds
+    steps = rng.normal(scale=1e-4, size=(n, 2)).cumsum(axis=0) + rng.normal(scale=2e-5, size=(n, 2))
+    track = Track(lines=[np.array([144.96, -37.81]) + steps])
+    for distance in (10, 50, 200, 1000):
+        t = time.perf_counter()
+        wkt, widened = track.query_geometry(distance)
+        elapsed = time.perf_counter() - t
+        kept = sum(w.count(",") + 1 for w in wkt)
+        print(
+            f"{distance:>5} m: {n} -> {kept} vertices ({kept / n:.1%}), searching within {widened:.0f} m, "
+            f"{elapsed * 1000:.0f} ms, {sum(map(len, wkt)) / 1024:.0f} KB of WKT"
+        )
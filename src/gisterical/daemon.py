@@ -0,0 +1,231 @@
+"""Long running ``gisterical --serve`` process and the client the command
+line uses to forward commands to it.
+
+The daemon keeps the database engine and its connection pool, the offline
+geocoder and the results of read queries between commands. Commands are
+sent over a Unix socket as one JSON line with the arguments and the
+working directory of the client, run one at a time, and their output and
+log are streamed back followed by the exit status. A client that changed
+the database or the connection settings itself sends a control line
+instead, so the daemon drops its cached results or reconnects.
+"""
+import io
+import os
+import sys
+import json
+import socket
+import signal
+import tempfile
+import contextlib
+from pathlib import Path
+from typing import Callable
+
+from loguru import logger
+
+
+def default_socket() -> Path:
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return Path(runtime) / "gisterical.sock"
+    return Path(tempfile.gettempdir()) / f"gisterical-{os.getuid()}.sock"
+
+
+def _send(conn: socket.socket, message: dict) -> None:
+    conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+
+def forward(argv: list[str], path: str | Path | None = None) -> int | None:
+    """Run a command in the daemon, printing its output and log.
+
+    Args:
+        argv (list[str]): Command line arguments.
+        path (str | Path | None, optional): Socket of the daemon. Defaults to ``default_socket()``.
+
+    Returns:
+        int | None: Exit status of the command, or None if no daemon is running.
+    """
+    path = str(path or default_socket())
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+
+    with conn, conn.makefile("r", encoding="utf-8") as replies:
+        _send(conn, {"argv": argv, "cwd": os.getcwd(), "color": sys.stderr.isatty()})
+        for line in replies:
+            message = json.loads(line)
+            if "log" in message:
+                sys.stderr.write(message["log"])
+            elif "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "exit" in message:
+                return message["exit"]
+    logger.error("The daemon closed the connection before the command finished.")
+    return 1
+
+
+def notify(command: str, path: str | Path | None = None) -> bool:
+    """Send a control command to the daemon: "clear-cache" after the database
+    was changed outside of it, or "reload" after the connection settings
+    changed.
+
+    Args:
+        command (str): "clear-cache" or "reload".
+        path (str | Path | None, optional): Socket of the daemon. Defaults to ``default_socket()``.
+
+    Returns:
+        bool: True if a daemon was running and did it.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(str(path or default_socket()))
+    except OSError:
+        conn.close()
+        return False
+    with conn, conn.makefile("r", encoding="utf-8") as replies:
+        _send(conn, {"control": command})
+        reply = json.loads(replies.readline() or "{}")
+    return reply.get("exit") == 0
+
+
+class _Output(io.TextIOBase):
+    # stdout of a command, sent to the client as it's written
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        with contextlib.suppress(OSError):
+            _send(self.conn, {"out": text})
+        return len(text)
+
+
+def _run_request(conn: socket.socket, request: dict, run: Callable[[list[str]], None]) -> int:
+    def sink(text: str):
+        # a client that went away doesn't stop the command
+        with contextlib.suppress(OSError):
+            _send(conn, {"log": str(text)})
+
+    handler = logger.add(sink, colorize=request.get("color", False))
+    cwd = os.getcwd()
+    try:
+        os.chdir(request["cwd"])
+        with contextlib.redirect_stdout(_Output(conn)):
+            run(request["argv"])
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    except Exception:
+        logger.exception(f"Command {request['argv']} failed.")
+        return 1
+    finally:
+        os.chdir(cwd)
+        logger.remove(handler)
+
+
+def _control(command: str) -> int:
+    from gisterical import registry
+    from gisterical.database.cached_api import CachingDbApi
+
+    if command == "reload":
+        # the next command reads the new settings and connects again
+        registry.reset()
+        registry.register("api", CachingDbApi())
+        logger.info("Connection settings reloaded.")
+    elif command == "clear-cache":
+        registry.api().clear_cache()
+        logger.info("Cached results cleared.")
+    else:
+        logger.warning(f"Unknown control command {command!r}.")
+        return 2
+    return 0
+
+
+def _parse_request(line: str) -> dict | None:
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(request, dict):
+        return None
+    if isinstance(request.get("control"), str):
+        return request
+    if isinstance(request.get("argv"), list) and isinstance(request.get("cwd"), str):
+        return request
+    return None
+
+
+def _handle(conn: socket.socket, run: Callable[[list[str]], None]):
+    with conn, conn.makefile("r", encoding="utf-8") as requests:
+        line = requests.readline()
+        if not line:
+            return
+        request = _parse_request(line)
+        if request is None:
+            logger.warning(f"Ignoring malformed request {line[:200]!r}.")
+            code = 2
+        elif "control" in request:
+            code = _control(request["control"])
+        else:
+            logger.info(f"Running {request['argv']} in {request['cwd']}.")
+            code = _run_request(conn, request, run)
+        with contextlib.suppress(OSError):
+            _send(conn, {"exit": code})
+
+
+def _listen(path: Path) -> socket.socket:
+    if path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(path))
+        except OSError:
+            # left behind by a daemon that didn't shut down cleanly
+            path.unlink()
+        else:
+            raise RuntimeError(f"A daemon is already listening on {path}.")
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    os.chmod(path, 0o600)
+    server.listen()
+    return server
+
+
+def serve(run: Callable[[list[str]], None], path: str | Path | None = None):
+    """Answer commands on a Unix socket until interrupted or terminated.
+
+    Args:
+        run (Callable[[list[str]], None]): Function running a command from its arguments.
+        path (str | Path | None, optional): Socket to listen on. Defaults to ``default_socket()``.
+    """
+    from gisterical import registry
+    from gisterical.database.cached_api import CachingDbApi
+
+    path = Path(path or default_socket())
+    registry.register("api", CachingDbApi())
+    server = _listen(path)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.info(f"Listening on {path}.")
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                _handle(conn, run)
+            except (OSError, UnicodeDecodeError) as e:
+                # a client that went away or sent garbage doesn't stop the daemon
+                logger.warning(f"Dropped a connection: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        with contextlib.suppress(OSError):
+            path.unlink()
+        logger.info("Daemon stopped.")
@@ -0,0 +1,82 @@
+import threading
+from functools import wraps
+from collections import OrderedDict
+from typing import Callable
+
+from gisterical.database.db_api import DbApi
+
+
+# queries whose results only change when images are added, changed or moved
+_CACHED = (
+    "find_photos_by_city_name",
+    "find_photos_by_country_name",
+    "get_city_rows",
+    "get_country_rows",
+    "get_no_location_rows",
+    "get_path_date_rows",
+    "get_photo_coordinates",
+)
+# methods writing to the tables the cached queries read
+_WRITES = (
+    "add_photo_to_db",
+    "remove_photos",
+    "update_hashes",
+    "update_paths",
+    "resolve_locations",
+)
+
+
+def _cached(method: Callable) -> Callable:
+    @wraps(method)
+    def wrapper(self: "CachingDbApi", *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return list(self._cache[key])
+        res = method(self, *args, **kwargs)
+        with self._cache_lock:
+            self._cache[key] = res
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return list(res)
+
+    return wrapper
+
+
+def _invalidating(method: Callable) -> Callable:
+    @wraps(method)
+    def wrapper(self: "CachingDbApi", *args, **kwargs):
+        res = None
+        try:
+            res = method(self, *args, **kwargs)
+            return res
+        finally:
+            # resolve_locations returns 0 when there was nothing to resolve
+            if res != 0:
+                self.clear_cache()
+
+    return wrapper
+
+
+class CachingDbApi(DbApi):
+    """``DbApi`` keeping the results of read queries, for a process that runs
+    many commands against the same database. The cache is cleared by every
+    write made through it, writes from other processes are not seen until
+    then.
+    """
+
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._cache: OrderedDict[tuple, list] = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+
+for _name in _CACHED:
+    setattr(CachingDbApi, _name, _cached(getattr(DbApi, _name)))
+for _name in _WRITES:
+    setattr(CachingDbApi, _name, _invalidating(getattr(DbApi, _name)))
@@ -0,0 +1,7 @@
+# how a single city is picked for an image when several are within the distance
+CITY_POLICIES: tuple[str, ...] = ("nearest", "largest")
+
+
+def check_city_policy(policy: str) -> None:
+    if policy not in CITY_POLICIES:
+        raise ValueError(f"Unknown city policy '{policy}', expected one of {', '.join(CITY_POLICIES)}.")
@@ -1,159 +1,608 @@
-import datetime as dt
+import os
+import time
 from pathlib import Path
-from shutil import copyfile
+from typing import Iterator
 
+import psycopg2
+from psycopg2.extras import execute_values
 from loguru import logger
-from sqlalchemy import create_engine
+from sqlalchemy import delete, func, or_, select, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 
-from gisterical.database.schema import Image, Country, City
+from gisterical import registry
+from gisterical.database.city_policy import check_city_policy
+from gisterical.database.pg_copy import to_csv
+from gisterical.database.schema import Image, ImageLocation, Country, City, image_objects
+from gisterical.database.search import TRACK_PIECES_SQL, SearchCriteria, search_query
 from gisterical.core.image_metadata import PhotoData
-from gisterical.settings.settings import load_settings
+from gisterical.util import geohash
 from gisterical.util.file_meta import FileMeta
 
+_IMAGE_COLUMNS = (
+    "path",
+    "location",
+    "timestamp",
+    "gps_accuracy",
+    "photo_direction",
+    "device_make",
+    "device_model",
+    "phash",
+    "colorhash",
+    "file_size",
+    "file_mtime",
+    "file_inode",
+    "geohash",
+)
+_COLS = ", ".join(_IMAGE_COLUMNS)
+_UPDATE_COLS = ", ".join(f"{c} = EXCLUDED.{c}" for c in _IMAGE_COLUMNS if c != "path")
+# rows are copied into a per-connection staging table and merged from there,
+# so that re-adding a changed file updates its row instead of failing the chunk
+_CREATE_STAGE = (
+    f"CREATE TEMP TABLE IF NOT EXISTS image_stage ON COMMIT DELETE ROWS AS SELECT {_COLS} FROM image WITH NO DATA"
+)
+_COPY_IMAGE = f"COPY image_stage ({_COLS}) FROM STDIN WITH (FORMAT csv)"
+_MERGE_STAGE = (
+    f"INSERT INTO image ({_COLS}) SELECT DISTINCT ON (path) {_COLS} FROM image_stage "
+    f"ORDER BY path ON CONFLICT (path) DO UPDATE SET {_UPDATE_COLS}"
+)
+_INSERT_IMAGE = f"INSERT INTO image ({_COLS}) VALUES %s ON CONFLICT (path) DO UPDATE SET {_UPDATE_COLS}"
 
-SETTINGS = load_settings()
+
+def _image_row(d: PhotoData) -> tuple:
+    if -999 not in {d.latitude, d.longitude, d.altitude}:
+        # a GPS fix without altitude still gives a usable location
+        alt = d.altitude if d.altitude is not None else 0
+        loc = f"POINTZ({d.longitude} {d.latitude} {alt})"
+        try:
+            cell = geohash.encode(d.latitude, d.longitude)
+        except ValueError:
+            cell = None
+    else:
+        loc, cell = None, None
+    acc = d.gps_accuracy if d.gps_accuracy != -999 else None
+    direction = d.photo_direction if d.photo_direction != -999 else None
+    return (
+        d.path,
+        loc,
+        d.timestamp,
+        acc,
+        direction,
+        d.camera_make,
+        d.camera_model,
+        d.phash,
+        d.colorhash,
+        d.file_size,
+        d.file_mtime,
+        d.file_inode,
+        cell,
+    )
+
+
+_RESOLVE_LOCATIONS = text(
+    """
+    INSERT INTO image_location (image_id, city_id, city_distance, country_id)
+    SELECT i.id, c.id, c.dist, cp.country_id
+    FROM image i
+    LEFT JOIN LATERAL (
+        SELECT city.id, ST_Distance(city.location::geography, i.location::geography) AS dist
+        FROM city
+        ORDER BY city.location::geography <-> i.location::geography
+        LIMIT 1
+    ) c ON true
+    LEFT JOIN LATERAL (
+        SELECT country_part.country_id
+        FROM country_part
+        WHERE ST_Contains(country_part.geometry, i.location)
+        LIMIT 1
+    ) cp ON true
+    WHERE i.location IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM image_location l WHERE l.image_id = i.id)
+    LIMIT :n
+    """
+)
+
+# perceptual hashes are 16 hex digits, summed as signed 64-bit integers
+_HASH_CHECKSUM = text(
+    "SELECT count(*), coalesce(sum(('x' || phash)::bit(64)::bigint), 0) FROM image "
+    "WHERE phash IS NOT NULL AND id <= :up_to_id"
+)
+
+# most populous city within the distance of every located image, the
+# ST_DWithin filter runs against the GiST index on city.location::geography
+_LARGEST_CITY = """
+    SELECT i.path, i.timestamp, c.name AS city{country_col}
+    FROM image i
+    JOIN LATERAL (
+        SELECT city.name
+        FROM city
+        WHERE ST_DWithin(city.location::geography, i.location::geography, :distance)
+        ORDER BY city.population DESC NULLS LAST
+        LIMIT 1
+    ) c ON true
+    {country_join}
+    WHERE i.location IS NOT NULL
+    """
+_LARGEST_CITY_ONLY = text(_LARGEST_CITY.format(country_col="", country_join=""))
+_LARGEST_CITY_COUNTRY = text(
+    _LARGEST_CITY.format(
+        country_col=", co.name AS country",
+        country_join="JOIN image_location l ON l.image_id = i.id JOIN country co ON co.id = l.country_id",
+    )
+)
+
+
+def _sort_query(countries: bool, cities: bool, policy: str = "nearest", geohashes: bool = False):
+    """Single query returning (path, date, country, city, geohash) of every
+    image to sort, with geohashes cut to ``:precision`` characters. Images
+    without a location get an unknown country, city and geohash, located
+    images missing a required city or country are left out."""
+    cell = (
+        "CASE WHEN i.location IS NULL THEN 'Unknown' ELSE COALESCE(left(i.geohash, :precision), 'Unknown') END"
+        if geohashes
+        else "''"
+    )
+    if not countries and not cities:
+        return text(f"SELECT i.path, i.timestamp, '' AS country, '' AS city, {cell} AS geohash FROM image i")
+
+    joins = ["LEFT JOIN image_location l ON l.image_id = i.id"]
+    required = []
+    if cities and policy == "largest":
+        joins.append(
+            "LEFT JOIN LATERAL (SELECT city.id, city.name FROM city "
+            "WHERE ST_DWithin(city.location::geography, i.location::geography, :distance) "
+            "ORDER BY city.population DESC NULLS LAST LIMIT 1) ci ON true"
+        )
+    elif cities:
+        joins.append("LEFT JOIN city ci ON ci.id = l.city_id AND l.city_distance <= :distance")
+    if cities:
+        required.append("ci.id IS NOT NULL")
+    if countries:
+        joins.append("LEFT JOIN country co ON co.id = l.country_id")
+        required.append("co.id IS NOT NULL")
+    country = "co.name" if countries else "''"
+    city = "ci.name" if cities else "''"
+    return text(
+        f"SELECT i.path, i.timestamp, "
+        f"CASE WHEN i.location IS NULL THEN 'Uknown' ELSE {country} END AS country, "
+        f"CASE WHEN i.location IS NULL THEN 'Unknown' ELSE {city} END AS city, "
+        f"{cell} AS geohash "
+        f"FROM image i {' '.join(joins)} "
+        f"WHERE i.location IS NULL OR ({' AND '.join(required)})"
+    )
+
+
+def _insert_rows(conn, rows: list[tuple]) -> int:
+    """Insert image rows, splitting them in halves when a statement fails
+    until the failing rows are isolated and skipped. Returns the number of
+    rows added."""
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, _INSERT_IMAGE, rows, page_size=1000)
+        conn.commit()
+        return len(rows)
+    except psycopg2.Error as e:
+        conn.rollback()
+        if len(rows) == 1:
+            logger.error(f"Skipping {rows[0][0]} that could not be added: {e}")
+            return 0
+    mid = len(rows) // 2
+    return _insert_rows(conn, rows[:mid]) + _insert_rows(conn, rows[mid:])
 
 
 class DbApi:
-    conn_str = SETTINGS.conn_str
-    engine: Engine = create_engine(conn_str)
-    session = sessionmaker(engine)
+    @property
+    def engine(self) -> Engine:
+        return registry.engine()
+
+    @property
+    def session(self) -> sessionmaker:
+        return registry.session()
+
+    def clear_cache(self):
+        """Forget cached query results, nothing is cached here."""
 
-    def add_photo_to_db(self, data: list[PhotoData]):
+    def add_photo_to_db(self, data: list[PhotoData], chunk_size: int = 5000):
+        """Bulk load image metadata with ``COPY``, committing every ``chunk_size``
+        rows. Rows for paths already in the database replace the existing ones,
+        and of several records with the same path the last one is kept. A chunk
+        that can't be copied is retried as multi-row ``INSERT ... ON CONFLICT``
+        statements, halving the rows until the bad ones are found, so a bad row
+        only costs itself.
+
+        Args:
+            data (list[PhotoData]): Metadata records to add.
+            chunk_size (int, optional): Number of rows per transaction. Defaults to 5000.
+        """
         logger.debug(f"Adding {len(data)} files to the database.")
+        t = time.time()
+        added = 0
+        conn = self.engine.raw_connection()
+        try:
+            for i in range(0, len(data), chunk_size):
+                # ON CONFLICT can't update the same row twice in one statement
+                rows = list({r[0]: r for r in map(_image_row, data[i:i + chunk_size])}.values())
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(_CREATE_STAGE)
+                        cur.copy_expert(_COPY_IMAGE, to_csv(rows))
+                        cur.execute(_MERGE_STAGE)
+                    conn.commit()
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    logger.warning(f"COPY of {len(rows)} rows failed, retrying with INSERT: {e}")
+                    added += _insert_rows(conn, rows)
+                    continue
+                added += len(rows)
+        finally:
+            conn.close()
+        elapsed = max(time.time() - t, 1e-9)
+        logger.info(f"Added {added} images in {elapsed:.2f} s ({added / elapsed:.0f} rows/s).")
+
+    def analyze(self):
+        """Refresh planner statistics of the image table after bulk changes."""
+        with self.engine.begin() as conn:
+            conn.execute(text("ANALYZE image"))
+
+    def get_known_files(self, folders: list[str]) -> dict[str, tuple[int, float, int]]:
+        """Get size, modification time and inode of all images already
+        stored under the given folders.
+
+        Args:
+            folders (list[str]): Absolute paths of the folders.
+
+        Returns:
+            dict[str, tuple[int, float, int]]: File stats keyed by image path.
+        """
+        cond = or_(*[Image.path.startswith(f.rstrip(os.sep) + os.sep, autoescape=True) for f in folders])
         with self.session.begin() as sess:
-            for d in data:
-                if -999 not in {d.latitude, d.longitude, d.altitude}:
-                    loc = f"POINTZ({d.longitude} {d.latitude} {d.altitude})"
-                else:
-                    loc = None
-                acc = d.gps_accuracy if d.gps_accuracy != -999 else None
-                direction = d.photo_direction if d.photo_direction != -999 else None
-
-                new_result = Image(
-                    path=d.path,
-                    location=loc,
-                    timestamp=d.timestamp,
-                    gps_accuracy=acc,
-                    photo_direction=direction,
-                    device_make=d.camera_make,
-                    device_model=d.camera_model,
-                    phash=d.phash,
-                    colorhash=d.colorhash,
+            q = sess.query(Image.path, Image.file_size, Image.file_mtime, Image.file_inode).filter(cond)
+            return {i[0]: (i[1], i[2], i[3]) for i in q}
+
+    def get_unhashed_images(self, after_id: int = 0, limit: int = 500) -> list[tuple[int, str]]:
+        """Get a page of images that have no perceptual hash yet, ordered by id.
+
+        Args:
+            after_id (int, optional): Only return images with a larger id. Defaults to 0.
+            limit (int, optional): Maximum number of images to return. Defaults to 500.
+
+        Returns:
+            list[tuple[int, str]]: Image ids and paths.
+        """
+        with self.session.begin() as sess:
+            q = sess.query(Image.id, Image.path).filter(Image.phash == None).\
+                filter(Image.id > after_id).order_by(Image.id).limit(limit)
+            return [(i[0], i[1]) for i in q]
+
+    def get_image_hashes(self, after_id: int = 0) -> list[tuple[int, str, int]]:
+        """Get perceptual hashes of all hashed images as 64-bit integers.
+
+        Args:
+            after_id (int, optional): Only return images with a larger id, so that
+                an existing index can be updated with new images. Defaults to 0.
+
+        Returns:
+            list[tuple[int, str, int]]: Image ids, paths and perceptual hashes.
+        """
+        with self.session.begin() as sess:
+            q = sess.query(Image.id, Image.path, Image.phash).filter(Image.phash != None).\
+                filter(Image.id > after_id).order_by(Image.id)
+            return [(i[0], i[1], int(i[2], 16)) for i in q]
+
+    def get_hash_checksum(self, up_to_id: int) -> tuple[int, int]:
+        """Count and sum of the perceptual hashes of images up to an id, to
+        tell whether an index built from ``get_image_hashes`` is still current.
+        Hashes are summed as signed 64-bit integers.
+
+        Args:
+            up_to_id (int): Largest image id to include.
+
+        Returns:
+            tuple[int, int]: Number of hashed images and the sum of their hashes.
+        """
+        with self.session.begin() as sess:
+            count, total = sess.execute(_HASH_CHECKSUM, {"up_to_id": up_to_id}).one()
+            return count, int(total)
+
+    def update_hashes(self, rows: list[tuple[int, str, str]]):
+        """Store perceptual and color hashes of images.
+
+        Args:
+            rows (list[tuple[int, str, str]]): Image ids with their perceptual and color hashes.
+        """
+        if not rows:
+            return
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    "UPDATE image SET phash = v.phash, colorhash = v.colorhash "
+                    "FROM (VALUES %s) AS v (id, phash, colorhash) WHERE image.id = v.id",
+                    rows,
                 )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove_photos(self, paths: list[str], chunk_size: int = 5000):
+        """Delete images from the database.
+
+        Args:
+            paths (list[str]): Paths of the images to remove.
+            chunk_size (int, optional): Number of paths deleted per statement. Defaults to 5000.
+        """
+        logger.info(f"Removing {len(paths)} images that no longer exist.")
+        with self.session.begin() as sess:
+            for i in range(0, len(paths), chunk_size):
+                ids = select(Image.id).where(Image.path.in_(paths[i:i + chunk_size]))
+                sess.execute(image_objects.delete().where(image_objects.c.image_id.in_(ids)))
+                sess.execute(delete(Image).where(Image.id.in_(ids)).execution_options(synchronize_session=False))
+
+    def update_paths(self, moves: list[tuple[str, str]], chunk_size: int = 5000) -> None:
+        """Point images at the new paths of files that were moved. Rows
+        already using one of the new paths are replaced.
+
+        Args:
+            moves (list[tuple[str, str]]): Old and new path of every moved file.
+            chunk_size (int, optional): Number of rows updated per statement. Defaults to 5000.
+        """
+        # files already at their target keep their rows, as do rows of other
+        # moved files whose old path is a target
+        moves = [(old, new) for old, new in moves if old != new]
+        sources = {old for old, _ in moves}
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cur:
+                for i in range(0, len(moves), chunk_size):
+                    chunk = moves[i:i + chunk_size]
+                    targets = [new for _, new in chunk if new not in sources]
+                    cur.execute(
+                        "DELETE FROM image_objects WHERE image_id IN (SELECT id FROM image WHERE path = ANY(%s))",
+                        (targets,),
+                    )
+                    cur.execute("DELETE FROM image WHERE path = ANY(%s)", (targets,))
+                    execute_values(
+                        cur,
+                        "UPDATE image SET path = v.new FROM (VALUES %s) AS v (old, new) WHERE image.path = v.old",
+                        chunk,
+                        page_size=chunk_size,
+                    )
+            conn.commit()
+        finally:
+            conn.close()
+        logger.info(f"Updated the paths of {len(moves)} moved images.")
 
-                sess.add(new_result)
-                sess.flush()
-            sess.commit()
-        logger.debug("Successfully added!")
+    def resolve_locations(self, batch_size: int = 10000) -> int:
+        """Fill the location cache for located images that don't have an entry
+        yet: nearest city (found with a KNN index scan), its distance and the
+        country containing the image.
 
-    def select_files_and_output(
+        Args:
+            batch_size (int, optional): Number of images resolved per transaction. Defaults to 10000.
+
+        Returns:
+            int: Number of images resolved.
+        """
+        total = 0
+        while True:
+            with self.engine.begin() as conn:
+                n = conn.execute(_RESOLVE_LOCATIONS, {"n": batch_size}).rowcount
+            total += n
+            if n < batch_size:
+                break
+        if total:
+            logger.info(f"Resolved nearest city and country for {total} images.")
+        return total
+
+    def iter_sort_rows(
         self,
-        location: tuple[float, ...] = (0, 0, 0),
-        distance_km: int | float = 1e10,
-        start_date: dt.datetime = dt.datetime(1900, 1, 1),
-        end_date: dt.datetime = dt.datetime(9999, 1, 1),
-        target_folder: str | Path = "/home/pavel/Pictures/temp",
-    ):
-        logger.info(
-            f"Searching for images within {distance_km} kilometers "
-            f"from coordinates {location} between {start_date} "
-            f"and {end_date}."
-        )
-        p = Path(target_folder)
-        if not p.is_dir():
-            p.mkdir()
+        countries: bool,
+        cities: bool,
+        distance_km: int | None = None,
+        policy: str = "nearest",
+        batch_size: int = 10000,
+        geohash_precision: int | None = None,
+    ) -> Iterator[tuple]:
+        """Stream (path, date, country, city, geohash) rows of every image to
+        sort from a server-side cursor, ``batch_size`` rows at a time, so the
+        client never holds more than one batch of raw rows.
+
+        A lot of photos don't have location data but often you'd still want
+        to sort them by date, so when sorting by location they are returned
+        with an unknown country and city by the same query.
+
+        Args:
+            countries (bool): Include the country containing each image.
+            cities (bool): Include the city within ``distance_km`` of each image.
+            distance_km (int | None, optional): Maximum distance to the city. Defaults to None.
+            policy (str, optional): "nearest" or "largest" city. Defaults to "nearest".
+            batch_size (int, optional): Number of rows fetched at once. Defaults to 10000.
+            geohash_precision (int | None, optional): Include the geohash of each image cut to
+                this many characters, read from the stored column without a spatial join.
+                Defaults to None.
 
+        Yields:
+            Iterator[tuple]: Path, date, country, city and geohash of the images.
+        """
+        check_city_policy(policy)
+        logger.info("Querying images to sort.")
+        params = {"distance": (distance_km or 0) * 1000, "precision": geohash_precision}
+        with self.engine.connect() as conn:
+            res = conn.execution_options(stream_results=True).execute(
+                _sort_query(countries, cities, policy, geohash_precision is not None), params
+            ).yield_per(batch_size)
+            for rows in res.partitions():
+                yield from rows
+
+    def get_city_rows(self, distance_km: int, policy: str = "nearest", with_country: bool = False) -> list[tuple]:
+        """Get images with the name of a city within ``distance_km`` of them.
+        Images with no city that close are left out.
+
+        Args:
+            distance_km (int): Maximum distance between an image and the city.
+            policy (str, optional): "nearest" picks the closest city from the location
+                cache, "largest" the most populous one within the distance. Defaults to "nearest".
+            with_country (bool, optional): Also return the country containing the image,
+                otherwise the country is empty. Defaults to False.
+
+        Returns:
+            list[tuple]: Path, date, country and city of the images.
+        """
+        check_city_policy(policy)
+        logger.info(f'Querying images with {policy} city{" and country" if with_country else ""} information.')
+        if policy == "largest":
+            query = _LARGEST_CITY_COUNTRY if with_country else _LARGEST_CITY_ONLY
+            with self.engine.connect() as conn:
+                q = conn.execute(query, {"distance": distance_km * 1000}).all()
+            return [(i.path, i.timestamp, i.country if with_country else '', i.city) for i in q]
         with self.session.begin() as sess:
-            q = (
-                sess.query(Image.path)
-                .filter(
-                    Image.location.ST_DistanceSphere(
-                        f"POINTZ({location[0]} {location[1]} {location[2]})"
-                    )
-                    <= distance_km * 1000
-                )
-                .filter(Image.timestamp >= start_date)
-                .filter(Image.timestamp <= end_date)
-            )
+            q = sess.query(Image.path, Image.timestamp, City.name).\
+                join(ImageLocation, ImageLocation.image_id == Image.id).\
+                join(City, City.id == ImageLocation.city_id)
+            if with_country:
+                q = q.add_columns(Country.name).join(Country, Country.id == ImageLocation.country_id)
+            q = q.filter(ImageLocation.city_distance <= distance_km * 1000).all()
+        return [(i[0], i[1], i[3] if with_country else '', i[2]) for i in q]
 
-            res: list[str] = [i[0] for i in q.all()]
-            logger.info(f"{len(res)} files found. Copying the files to {target_folder}.")
+    def get_country_rows(self) -> list[tuple]:
+        """Get path, date and country of the images inside a country, with an empty city."""
+        logger.info('Querying images with country information.')
+        with self.session.begin() as sess:
+            q = sess.query(Image.path, Image.timestamp, Country.name).\
+                join(ImageLocation, ImageLocation.image_id == Image.id).\
+                join(Country, Country.id == ImageLocation.country_id).all()
+        return [(i[0], i[1], i[2], '') for i in q]
 
-        for pth in res:
-            fname = Path(pth).name
-            copyfile(str(pth), str(p / fname))
-        logger.info("Success!")
-        
-    def get_photos_by_city(self, distance_km: int):
-        logger.info('Querying images with nearest city data.')        
+    def get_no_location_rows(self) -> list[tuple]:
+        """Get path and date of the images without a location, with unknown country and city."""
         with self.session.begin() as sess:
-            q = sess.query(Image.path, Image.timestamp, City.name).distinct(Image.path).\
-                join(City, Image.location.ST_DWithin(City.location, distance_km * 1000, True)).\
-                    order_by(Image.path, City.population.desc()).all()
-        return [FileMeta(path=Path(i[0]), date=i[1], city=i[2]) for i in q]
-    
-    def get_photo_path_date(self):
+            q = sess.query(Image.path, Image.timestamp).\
+                filter(Image.location==None).all()
+        return [(i[0], i[1], "Uknown", "Unknown") for i in q]
+
+    def get_path_date_rows(self) -> list[tuple]:
+        """Get path and date of all images, with empty country and city."""
         logger.info("Querying photo datetime information")
         with self.session.begin() as sess:
             q = sess.query(Image.path, Image.timestamp).all()
-            return [FileMeta(path=Path(i[0]), date=i[1]) for i in q]        
-        
-    def get_photo_city_country(self, distance_km: int):
-        logger.info('Querying images with nearest city and country information.')
+        return [(i[0], i[1], '', '') for i in q]
+
+    def get_photos_by_city(self, distance_km: int, policy: str = "nearest"):
+        return [FileMeta.from_row(r) for r in self.get_city_rows(distance_km, policy)]
+    
+    def iter_photo_coordinates(self, batch_size: int = 10000) -> Iterator[list[tuple]]:
+        """Stream path, date, latitude and longitude of all images in batches
+        from a server-side cursor, with None coordinates for images without a
+        location.
+        """
+        q = select(Image.path, Image.timestamp, func.ST_Y(Image.location), func.ST_X(Image.location))
+        with self.engine.connect() as conn:
+            res = conn.execution_options(stream_results=True).execute(q).yield_per(batch_size)
+            yield from res.partitions()
+
+    def get_photo_coordinates(self) -> list[tuple]:
+        """Get path, date, latitude and longitude of every image with a location."""
         with self.session.begin() as sess:
-            q = sess.query(Image.path, Image.timestamp, Country.name, City.name).distinct(Image.path).\
-                join(City, Image.location.ST_DWithin(City.location, distance_km * 1000, True)).\
-                join(Country, Country.geometry.ST_Contains(Image.location)).\
-                    order_by(Image.path, City.population.desc()).all()    
-        return [FileMeta(path=Path(i[0]), date=i[1], country=i[2], city=i[3]) for i in q]
+            return sess.query(
+                Image.path, Image.timestamp, func.ST_Y(Image.location), func.ST_X(Image.location)
+            ).filter(Image.location != None).all()
+
+    def get_photo_path_date(self):
+        return [FileMeta.from_row(r) for r in self.get_path_date_rows()]
+        
+    def get_photo_city_country(self, distance_km: int, policy: str = "nearest"):
+        return [FileMeta.from_row(r) for r in self.get_city_rows(distance_km, policy, with_country=True)]
                     
     def get_photo_country(self):
-        logger.info('Querying images with country information.')
-        with self.session.begin() as sess:
-            q = sess.query(Image.path, Image.timestamp, Country.name).\
-                join(Country, Country.geometry.ST_Contains(Image.location)).all()
-        return [FileMeta(path=Path(i[0]), date=i[1], country=i[2]) for i in q]   
+        return [FileMeta.from_row(r) for r in self.get_country_rows()]
     
     def get_photo_no_location(self):
-        with self.session.begin() as sess:
-            q = sess.query(Image.path, Image.timestamp).\
-                filter(Image.location==None).all()
-        return [FileMeta(path=Path(i[0]), date=i[1], country="Uknown", city="Unknown") for i in q]
+        return [FileMeta.from_row(r) for r in self.get_no_location_rows()]
     
+    def search(self, criteria: SearchCriteria, page_size: int = 1000) -> Iterator[list[Path]]:
+        """Find images meeting all the search criteria, a page at a time.
+
+        Pages are read with keyset pagination on the image id, each in its
+        own short query, so neither the first page nor the last one needs
+        the previous results and no transaction stays open between pages.
+
+        Args:
+            criteria (SearchCriteria): Search conditions.
+            page_size (int, optional): Maximum number of paths per page. Defaults to 1000.
+
+        Yields:
+            Iterator[list[Path]]: Paths of the matching images, in the order they were added.
+        """
+        sql, params = search_query(criteria)
+        query = text(sql)
+        if "track" in params:
+            with self.engine.connect() as conn:
+                params["track_pieces"] = conn.execute(text(TRACK_PIECES_SQL), params).scalars().all()
+        after = 0
+        while True:
+            with self.engine.connect() as conn:
+                rows = conn.execute(query, {**params, "after": after, "limit": page_size}).all()
+            if rows:
+                yield [Path(r[1]) for r in rows]
+            if len(rows) < page_size:
+                return
+            after = rows[-1][0]
+
     def find_photos_by_city_name(self, distance_km: int, name: str) -> list[Path]:
-        with self.session.begin() as sess:
-            q: list[tuple[str]] = sess.query(Image.path)\
-                .join(City, Image.location.ST_DWithin(City.location, distance_km * 1000, True))\
-                    .filter(City.name == name).all()
-        return [Path(i[0]) for i in q]
+        return [p for page in self.search(SearchCriteria(city=name, distance_km=distance_km)) for p in page]
     
     def find_photos_by_country_name(self, name: str) -> list[Path]:
-        with self.session.begin() as sess:
-            q = sess.query(Image.path)\
-                .join(Country, Country.geometry.ST_Contains(Image.location))\
-                    .filter(Country.name == name)
-        return [Path(i[0]) for i in q]
+        return [p for page in self.search(SearchCriteria(country=name)) for p in page]
      
 
 if __name__ == "__main__":
-    # import time
-    # from core.image_paths import PhotoPaths
-    # from core.image_metadata import MetadataExtractor
+    # time the ways of picking a city for every image as the radius grows:
+    # python -m gisterical.database.db_api [radius_km ...]
+    import sys
 
-    # t = time.time()
-    # p = PhotoPaths(["/media/storage/Photo"])
-    # meta = MetadataExtractor(p)
+    # the old query, joining every city within the radius to every image
+    distinct_on = text(
+        """
+        SELECT DISTINCT ON (i.path) i.path, c.name
+        FROM image i
+        JOIN city c ON ST_DWithin(c.location::geography, i.location::geography, :distance)
+        ORDER BY i.path, c.population DESC
+        """
+    )
+    # nearest city found with the KNN operator and capped by the distance
+    nearest_knn = text(
+        """
+        SELECT i.path, c.name
+        FROM image i
+        JOIN LATERAL (
+            SELECT city.name, city.location
+            FROM city
+            ORDER BY city.location::geography <-> i.location::geography
+            LIMIT 1
+        ) c ON ST_DWithin(c.location::geography, i.location::geography, :distance)
+        WHERE i.location IS NOT NULL
+        """
+    )
 
-    # api = DbApi()
-    # api.add_photo_to_db(meta.metadata)
-    # print(f"Completed in {time.time() - t} seconds")
+    def run(query, km: int) -> list:
+        with api.engine.connect() as conn:
+            return conn.execute(query, {"distance": km * 1000}).all()
 
     api = DbApi()
-    # res = api.select_files_and_output(location=(-31.95, 115.86, 0), distance_km=50)
-    # res = api.get_photo_country()
-    
-    res = api.find_photos_by_country_name('Russia')
-    print(res)
+    api.resolve_locations()
+    radii = [int(r) for r in sys.argv[1:]] or [1, 10, 50, 100, 250]
+    queries = {
+        "distinct on": lambda km: run(distinct_on, km),
+        "nearest knn": lambda km: run(nearest_knn, km),
+        "nearest cached": lambda km: api.get_photos_by_city(km, "nearest"),
+        "largest": lambda km: api.get_photos_by_city(km, "largest"),
+    }
+    print("radius km | " + " | ".join(f"{name:>14}" for name in queries))
+    for km in radii:
+        times = []
+        for fn in queries.values():
+            t = time.perf_counter()
+            fn(km)
+            times.append(time.perf_counter() - t)
+        print(f"{km:>9} | " + " | ".join(f"{t:>12.3f} s" for t in times))
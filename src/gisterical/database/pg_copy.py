@@ -0,0 +1,45 @@
+import io
+from typing import Any, Iterable, Iterator
+
+
+def csv_field(v: Any) -> str:
+    # strings are always quoted so that only unquoted empty fields (None) are read as NULL
+    if v is None:
+        return ""
+    if isinstance(v, str):
+        return '"' + v.replace('"', '""') + '"'
+    return str(v)
+
+
+def csv_line(row: Iterable[Any]) -> str:
+    return ",".join(csv_field(v) for v in row) + "\n"
+
+
+def to_csv(rows: list[tuple]) -> io.StringIO:
+    """Serialise rows into an in-memory CSV buffer for ``COPY ... FROM STDIN``."""
+    buf = io.StringIO()
+    for r in rows:
+        buf.write(csv_line(r))
+    buf.seek(0)
+    return buf
+
+
+class CopyStream:
+    """Minimal file-like object feeding rows from an iterator to
+    ``cursor.copy_expert`` as CSV, so arbitrarily large inputs are streamed
+    to the server without being held in memory."""
+
+    def __init__(self, rows: Iterable[tuple]):
+        self._lines: Iterator[str] = (csv_line(r) for r in rows)
+        self._buf = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buf) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buf += line
+        if size < 0:
+            size = len(self._buf)
+        res, self._buf = self._buf[:size], self._buf[size:]
+        return res
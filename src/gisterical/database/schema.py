@@ -1,27 +1,28 @@
-import json
+import csv
+import hashlib
 from pathlib import Path
+from typing import Iterator, TextIO
 
 from loguru import logger
 from geoalchemy2 import Geometry
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy import (
     Column,
     ForeignKey,
     Integer,
+    BigInteger,
     String,
     Float,
     DateTime,
     UniqueConstraint,
     Table,
-    create_engine,
+    text,
 )
 
-from gisterical.settings.settings import load_settings
-
-SETTINGS = load_settings()
+from gisterical import registry
+from gisterical.database.pg_copy import CopyStream
 
 Base = declarative_base()
-engine = create_engine(SETTINGS.conn_str)
 
 
 image_objects = Table(
@@ -35,6 +36,7 @@ image_objects = Table(
 
 class Image(Base):
     __tablename__ = "image"
+    __table_args__ = (UniqueConstraint("path", name="unique_path"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     path = Column(String)
@@ -46,11 +48,14 @@ class Image(Base):
     device_model = Column(String)
     phash = Column(String)
     colorhash = Column(String)
+    file_size = Column(BigInteger)
+    file_mtime = Column(Float)
+    file_inode = Column(BigInteger)
+    # full precision geohash of the location, see gisterical.util.geohash
+    geohash = Column(String(12))
 
     objects = relationship("Object", secondary=image_objects)
 
-    unique_path = UniqueConstraint("path", name="unique_path")
-
 
 class Object(Base):
     __tablename__ = "object"
@@ -70,6 +75,37 @@ class Country(Base):
     geometry = Column(Geometry)
 
 
+class CountryPart(Base):
+    # country polygons cut with ST_Subdivide into pieces of a few hundred
+    # vertices so that point-in-polygon tests hit small, tightly indexed boxes
+    __tablename__ = "country_part"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    country_id = Column(Integer, ForeignKey("country.id", ondelete="CASCADE"), index=True)
+    geometry = Column(Geometry)
+
+
+class ImageLocation(Base):
+    # nearest city and country of every located image, resolved once at
+    # ingest. Rows are removed by a trigger when the image location changes
+    # and by TRUNCATE ... CASCADE when the reference data is reloaded.
+    __tablename__ = "image_location"
+
+    image_id = Column(Integer, ForeignKey("image.id", ondelete="CASCADE"), primary_key=True)
+    city_id = Column(Integer, ForeignKey("city.id"), index=True)
+    city_distance = Column(Float)
+    country_id = Column(Integer, ForeignKey("country.id"), index=True)
+
+
+class ReferenceData(Base):
+    # checksums of the loaded city and country files, so that
+    # unchanged reference data isn't reloaded on every --setup
+    __tablename__ = "reference_data"
+
+    name = Column(String, primary_key=True)
+    checksum = Column(String)
+
+
 class City(Base):
     __tablename__ = "city"
 
@@ -80,70 +116,312 @@ class City(Base):
     population = Column(Integer)
 
 
-def populate_cities(session: sessionmaker):
+# bump when reading the cities file changes, so cities loaded by an older
+# version are reloaded even though the file is the same
+_CITIES_VERSION = 2
+
+
+def file_checksum(path: Path) -> str:
+    """SHA-256 of a file, read in blocks so large gazetteers don't need to fit in memory."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _is_loaded(conn, name: str, checksum: str) -> bool:
+    q = conn.execute(text("SELECT checksum FROM reference_data WHERE name = :n"), {"n": name}).first()
+    return q is not None and q[0] == checksum
+
+
+def _mark_loaded(conn, name: str, checksum: str):
+    conn.execute(
+        text(
+            "INSERT INTO reference_data (name, checksum) VALUES (:n, :c) "
+            "ON CONFLICT (name) DO UPDATE SET checksum = EXCLUDED.checksum"
+        ),
+        {"n": name, "c": checksum},
+    )
+
+
+def _to_float(v: str) -> float | None:
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(v: str) -> int | None:
+    try:
+        return int(float(v))
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_city(name: str, country: str, lat: str, lon: str, pop: str) -> tuple:
+    return (name or None, country or None, _to_float(lat), _to_float(lon), _to_int(pop))
+
+
+def _read_worldcities(f: TextIO) -> Iterator[tuple]:
+    for r in csv.DictReader(f):
+        yield _parse_city(r["city"], r["country"], r["lat"], r["lng"], r["population"])
+
+
+def _read_country_info(path: Path) -> dict[str, str]:
+    # GeoNames countryInfo.txt: ISO code in the first and name in the fifth column
+    if not path.exists():
+        logger.warning(f"{path} not found, GeoNames cities keep country codes instead of names.")
+        return {}
+    names = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            r = line.rstrip("\n").split("\t")
+            if not line.startswith("#") and len(r) > 4:
+                names[r[0]] = r[4]
+    return names
+
+
+def _read_geonames(f: TextIO, countries: dict[str, str]) -> Iterator[tuple]:
+    # tab separated GeoNames dump (allCountries.txt, cities500.txt etc.):
+    # name, latitude, longitude, feature class, country code and population
+    # columns. Only populated places (feature class P) are cities, the full
+    # dump also has mountains, streams, hotels, administrative regions etc.
+    for line in f:
+        r = line.rstrip("\n").split("\t")
+        if len(r) > 14 and r[6] == "P":
+            yield _parse_city(r[1], countries.get(r[8], r[8]), r[4], r[5], r[14])
+
+
+def read_cities(path: Path) -> Iterator[tuple]:
+    """Read a cities file, either the simplemaps ``worldcities.csv`` or a tab
+    separated GeoNames dump (``.txt``). Country codes of GeoNames cities are
+    replaced by names from ``countryInfo.txt`` in the same folder, like the
+    country names of ``worldcities.csv``.
+
+    Args:
+        path (Path): Path to the cities file.
+
+    Yields:
+        Iterator[tuple]: Name, country, latitude, longitude and population of every
+            city, with None for missing or malformed values.
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.suffix.lower() == ".txt":
+            yield from _read_geonames(f, _read_country_info(path.parent / "countryInfo.txt"))
+        else:
+            yield from _read_worldcities(f)
+
+
+def _city_row(name: str | None, country: str | None, lat: float | None, lon: float | None, pop: int | None) -> tuple:
+    loc = f"POINT({lon} {lat})" if lat is not None and lon is not None else None
+    return (name, country, loc, pop)
+
+
+def populate_cities() -> bool:
+    """Stream the cities file into the city table with ``COPY``. Both the
+    simplemaps ``worldcities.csv`` and tab separated GeoNames dumps (``.txt``)
+    are supported. Nothing is done when the file hasn't changed since it was
+    last loaded.
+
+    Returns:
+        bool: True if the city table was (re)loaded.
+    """
+    path = Path(__file__).parent.parent / registry.settings().cities_data
+    checksum = f"{file_checksum(path)}:{_CITIES_VERSION}"
+    with registry.engine().connect() as conn:
+        if _is_loaded(conn, "cities", checksum):
+            logger.info("City data is up to date.")
+            return False
+
     logger.info("Adding coordinates for world cities.")
-    cities = Path(__file__).parent.parent / SETTINGS.cities_data
-    with open(cities, "r") as f:
-        with session.begin() as sess:
-            for idx, row in enumerate(f.readlines()):
-                r = row.split(",")
-                
-                try:
-                    city = r[0].replace('"', "")
-                except (TypeError, ValueError):
-                    city = None
-                    
-                try:
-                    country = r[4].replace('"', "")
-                except (TypeError, ValueError):
-                    country = None
-                
-                try:
-                    pop = int(r[9].replace('"', ""))
-                except (TypeError, ValueError):
-                    pop = None
-
-                try:
-                    lat = float(r[2].replace('"', ""))
-                    lon = float(r[3].replace('"', ""))
-                    loc = f"POINT({lon} {lat})"
-                except (TypeError, ValueError):
-                    loc = None
-
-                if idx >= 1:
-                    new_city = City(
-                        name=city,
-                        country=country,
-                        location=loc,
-                        population=pop,
-                    )
-                    sess.add(new_city)
-                    sess.flush()
-            sess.commit()
-
-
-def populate_countries(session: sessionmaker):
-    logger.info("Adding country boundaries.")
-    path = Path(__file__).parent.parent / SETTINGS.countries_data
-    with open(path) as f:
-        cnt = json.load(f)
-    ft = cnt["features"]
-    with session.begin() as sess:
-        for f in ft:
-            new_cnt = Country(
-                name=f["properties"]["ADMIN"],
-                iso_code=f["properties"]["ISO_A3"],
-                geometry=json.dumps(f["geometry"]),
+    conn = registry.engine().raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE city CASCADE")
+            cur.copy_expert(
+                "COPY city (name, country, location, population) FROM STDIN WITH (FORMAT csv)",
+                CopyStream(_city_row(*c) for c in read_cities(path)),
+            )
+            cur.execute(
+                "INSERT INTO reference_data (name, checksum) VALUES ('cities', %s) "
+                "ON CONFLICT (name) DO UPDATE SET checksum = EXCLUDED.checksum",
+                (checksum,),
             )
-            sess.add(new_cnt)
-        sess.commit()
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+
+def populate_countries() -> bool:
+    """Load country boundaries from the GeoJSON file in a single statement,
+    letting PostGIS parse the features. Nothing is done when the file hasn't
+    changed since it was last loaded.
+
+    Returns:
+        bool: True if the country table was (re)loaded.
+    """
+    path = Path(__file__).parent.parent / registry.settings().countries_data
+    checksum = file_checksum(path)
+    with registry.engine().begin() as conn:
+        if _is_loaded(conn, "countries", checksum):
+            logger.info("Country data is up to date.")
+            return False
+        logger.info("Adding country boundaries.")
+        conn.execute(text("TRUNCATE country CASCADE"))
+        conn.execute(
+            text(
+                "INSERT INTO country (name, iso_code, geometry) "
+                "SELECT f->'properties'->>'ADMIN', f->'properties'->>'ISO_A3', "
+                # GeoJSON is read as SRID 4326, image and city locations have no SRID
+                "ST_SetSRID(ST_GeomFromGeoJSON(f->>'geometry'), 0) "
+                "FROM json_array_elements(CAST(:doc AS json)->'features') AS f"
+            ),
+            {"doc": path.read_text(encoding="utf-8")},
+        )
+        _mark_loaded(conn, "countries", checksum)
+    return True
+
+
+SPATIAL_INDEXES: tuple[str, ...] = (
+    "CREATE INDEX IF NOT EXISTS idx_image_location ON image USING GIST (location)",
+    # ST_DWithin(..., True) compares geographies, so the joins need an index on the cast
+    "CREATE INDEX IF NOT EXISTS idx_image_location_geog ON image USING GIST ((location::geography))",
+    "CREATE INDEX IF NOT EXISTS idx_city_location ON city USING GIST (location)",
+    "CREATE INDEX IF NOT EXISTS idx_city_location_geog ON city USING GIST ((location::geography))",
+    "CREATE INDEX IF NOT EXISTS idx_country_geometry ON country USING GIST (geometry)",
+    "CREATE INDEX IF NOT EXISTS idx_country_part_geometry ON country_part USING GIST (geometry)",
+)
+
+
+def build_country_parts(max_vertices: int = 256):
+    """Split country polygons into parts of at most ``max_vertices`` vertices.
+
+    Args:
+        max_vertices (int, optional): Maximum number of vertices per part. Defaults to 256.
+    """
+    logger.info("Subdividing country boundaries.")
+    with registry.engine().begin() as conn:
+        conn.execute(text("TRUNCATE country_part"))
+        conn.execute(
+            text(
+                "INSERT INTO country_part (country_id, geometry) "
+                "SELECT id, ST_Subdivide(ST_MakeValid(geometry), :n) FROM country"
+            ),
+            {"n": max_vertices},
+        )
+
+
+def create_spatial_indexes():
+    """Create GiST indexes used by the spatial joins and refresh planner statistics."""
+    with registry.engine().begin() as conn:
+        for stmt in SPATIAL_INDEXES:
+            conn.execute(text(stmt))
+        for table in ("image", "city", "country", "country_part"):
+            conn.execute(text(f"ANALYZE {table}"))
+
+
+SEARCH_INDEXES: tuple[str, ...] = (
+    "CREATE INDEX IF NOT EXISTS idx_image_timestamp ON image (timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_image_device_model ON image (device_model)",
+    "CREATE INDEX IF NOT EXISTS idx_city_name ON city (name)",
+)
+
+
+def create_search_indexes():
+    """Create B-tree indexes on the columns searched by name, date and camera model."""
+    logger.info("Creating search indexes.")
+    with registry.engine().begin() as conn:
+        for stmt in SEARCH_INDEXES:
+            conn.execute(text(stmt))
+
+
+def build_geohashes():
+    """Fill in the geohash of images added before the column existed and index
+    it for grouping and searching by prefix."""
+    logger.info("Computing geohashes of image locations.")
+    with registry.engine().begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE image SET geohash = ST_GeoHash(location, 12) "
+                "WHERE geohash IS NULL AND location IS NOT NULL "
+                "AND ST_Y(location) BETWEEN -90 AND 90 AND ST_X(location) BETWEEN -180 AND 180"
+            )
+        )
+        # text_pattern_ops lets LIKE 'prefix%' use the index whatever the collation
+        conn.execute(
+            text("CREATE INDEX IF NOT EXISTS idx_image_geohash ON image (geohash text_pattern_ops)")
+        )
+
+
+LOCATION_TRIGGER: tuple[str, ...] = (
+    "CREATE OR REPLACE FUNCTION image_location_invalidate() RETURNS trigger AS $$ "
+    "BEGIN DELETE FROM image_location WHERE image_id = NEW.id; RETURN NEW; END $$ LANGUAGE plpgsql",
+    "DROP TRIGGER IF EXISTS image_location_invalidate ON image",
+    "CREATE TRIGGER image_location_invalidate AFTER UPDATE OF location ON image FOR EACH ROW "
+    "WHEN (OLD.location IS DISTINCT FROM NEW.location) EXECUTE PROCEDURE image_location_invalidate()",
+)
+
+
+def upgrade_schema():
+    """Bring a database created by an older version up to date: create missing
+    tables, add the file stat columns and the unique path constraint (dropping
+    duplicated paths that could be inserted before the constraint existed),
+    install the location cache trigger, drop the SRID of country boundaries,
+    compute missing geohashes and build the
+    subdivided country parts, spatial and search indexes."""
+    Base.metadata.create_all(registry.engine())
+    with registry.engine().begin() as conn:
+        for col, typ in (
+            ("file_size", "BIGINT"),
+            ("file_mtime", "DOUBLE PRECISION"),
+            ("file_inode", "BIGINT"),
+            ("geohash", "VARCHAR(12)"),
+        ):
+            conn.execute(text(f"ALTER TABLE image ADD COLUMN IF NOT EXISTS {col} {typ}"))
+        exists = conn.execute(text("SELECT 1 FROM pg_constraint WHERE conname = 'unique_path'")).first()
+        if not exists:
+            logger.info("Removing duplicated images and adding unique path constraint.")
+            dups = "SELECT a.id FROM image a JOIN image b ON a.path = b.path AND a.id > b.id"
+            conn.execute(text(f"DELETE FROM image_objects WHERE image_id IN ({dups})"))
+            conn.execute(text(f"DELETE FROM image WHERE id IN ({dups})"))
+            conn.execute(text("ALTER TABLE image ADD CONSTRAINT unique_path UNIQUE (path)"))
+        # countries loaded by an older version with the SRID of GeoJSON can't be
+        # compared with image locations, which have none
+        for table in ("country", "country_part"):
+            conn.execute(text(f"UPDATE {table} SET geometry = ST_SetSRID(geometry, 0) WHERE ST_SRID(geometry) <> 0"))
+        missing_parts = conn.execute(
+            text("SELECT EXISTS (SELECT 1 FROM country) AND NOT EXISTS (SELECT 1 FROM country_part)")
+        ).scalar()
+        has_index = conn.execute(text("SELECT to_regclass('idx_image_location_geog') IS NOT NULL")).scalar()
+        has_search_index = conn.execute(text("SELECT to_regclass('idx_city_name') IS NOT NULL")).scalar()
+        has_geohash_index = conn.execute(text("SELECT to_regclass('idx_image_geohash') IS NOT NULL")).scalar()
+        has_trigger = conn.execute(
+            text("SELECT 1 FROM pg_trigger WHERE tgname = 'image_location_invalidate'")
+        ).first()
+        if not has_trigger:
+            for stmt in LOCATION_TRIGGER:
+                conn.execute(text(stmt))
+    if missing_parts:
+        build_country_parts()
+    if missing_parts or not has_index:
+        create_spatial_indexes()
+    if not has_search_index:
+        create_search_indexes()
+    if not has_geohash_index:
+        build_geohashes()
 
 
 def create_schema():
-    session = sessionmaker(engine)
-    Base.metadata.create_all(engine)
-    populate_cities(session)
-    populate_countries(session)
+    Base.metadata.create_all(registry.engine())
+    upgrade_schema()
+    cities = populate_cities()
+    countries = populate_countries()
+    if countries:
+        build_country_parts()
+    if cities or countries:
+        create_spatial_indexes()
 
 
 if __name__ == "__main__":
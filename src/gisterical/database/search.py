@@ -0,0 +1,128 @@
+import datetime as dt
+from dataclasses import dataclass
+
+
+# largest number of vertices in a piece of a track, short pieces have small
+# bounding boxes and each one finds its photos with a tight index scan
+TRACK_PIECE_VERTICES = 64
+
+# the pieces of a track as hex WKB, cut once per search rather than once per page
+TRACK_PIECES_SQL = (
+    f"SELECT encode(ST_AsBinary(ST_Subdivide(ST_MakeValid(ST_GeomFromText(w)), {TRACK_PIECE_VERTICES})), 'hex') "
+    "FROM unnest(CAST(:track AS text[])) AS w"
+)
+
+
+@dataclass
+class SearchCriteria:
+    """Conditions an image has to meet to be found, all of them optional and
+    combined with AND.
+
+    Attributes:
+        city: Name of a city, images within ``distance_km`` of any city with that name match.
+        country: Name of the country the image was taken in.
+        point: Latitude and longitude, images within ``distance_km`` of it match.
+        distance_km: Radius around the city or point, required with either of them.
+        bbox: West, south, east and north bounds in degrees. West greater than east
+            is a box across the antimeridian.
+        start: Earliest time the image was taken (inclusive).
+        end: Latest time the image was taken (exclusive).
+        make: Camera manufacturer as stored in the EXIF data.
+        model: Camera model as stored in the EXIF data.
+        track: WKT lines and polygons, images within ``track_distance_m`` of any of them match.
+        track_distance_m: Distance from the track in metres, required with it.
+    """
+
+    city: str | None = None
+    country: str | None = None
+    point: tuple[float, float] | None = None
+    distance_km: float | None = None
+    bbox: tuple[float, float, float, float] | None = None
+    start: dt.datetime | None = None
+    end: dt.datetime | None = None
+    make: str | None = None
+    model: str | None = None
+    track: list[str] | None = None
+    track_distance_m: float | None = None
+
+    def __post_init__(self):
+        if (self.city is not None or self.point is not None) and not self.distance_km:
+            raise ValueError("A distance is required to search around a city or a point.")
+        if self.bbox is not None and self.bbox[1] > self.bbox[3]:
+            raise ValueError("The south bound of the search box is above its north bound.")
+        if self.track is not None and not self.track_distance_m:
+            raise ValueError("A distance is required to search along a track.")
+
+
+def search_query(criteria: SearchCriteria) -> tuple[str, dict]:
+    """SQL for one page of the images matching ``criteria``, ordered by id
+    and starting after the ``:after`` id, with at most ``:limit`` rows.
+
+    Every condition can use an index: names and dates the B-tree indexes,
+    distances the geography index on image locations and boxes the
+    geometry one. A track is cut into pieces of at most
+    ``TRACK_PIECE_VERTICES`` vertices and each piece probes the geography
+    index once, rather than the whole track matching every photo inside its
+    bounding box. The pieces are a ``:track_pieces`` parameter, the hex WKB
+    rows of ``TRACK_PIECES_SQL`` run with the ``track`` parameter returned
+    here.
+
+    Args:
+        criteria (SearchCriteria): Search conditions.
+
+    Returns:
+        tuple[str, dict]: Statement selecting image ids and paths, and its parameters
+            other than ``after`` and ``limit``.
+    """
+    c = criteria
+    where = ["i.id > :after"]
+    params: dict = {}
+    if c.city is not None:
+        where.append(
+            "EXISTS (SELECT 1 FROM city c WHERE c.name = :city "
+            "AND ST_DWithin(c.location::geography, i.location::geography, :distance))"
+        )
+        params["city"] = c.city
+    if c.point is not None:
+        where.append("ST_DWithin(i.location::geography, ST_MakePoint(:lon, :lat)::geography, :distance)")
+        params["lat"], params["lon"] = c.point
+    if c.distance_km:
+        params["distance"] = c.distance_km * 1000
+    if c.country is not None:
+        where.append(
+            "EXISTS (SELECT 1 FROM image_location il JOIN country co ON co.id = il.country_id "
+            "WHERE il.image_id = i.id AND co.name = :country)"
+        )
+        params["country"] = c.country
+    if c.bbox is not None:
+        west, south, east, north = c.bbox
+        if west <= east:
+            where.append("i.location && ST_MakeEnvelope(:west, :south, :east, :north)")
+        else:
+            where.append(
+                "(i.location && ST_MakeEnvelope(:west, :south, 180, :north) "
+                "OR i.location && ST_MakeEnvelope(-180, :south, :east, :north))"
+            )
+        params.update(west=west, south=south, east=east, north=north)
+    if c.track is not None:
+        where.append(
+            "i.id IN (SELECT ti.id FROM image ti JOIN ("
+            "SELECT ST_GeogFromWKB(decode(w, 'hex')) AS g FROM unnest(CAST(:track_pieces AS text[])) AS w) t "
+            "ON ST_DWithin(ti.location::geography, t.g, :track_distance))"
+        )
+        params["track"] = c.track
+        params["track_distance"] = c.track_distance_m
+    if c.start is not None:
+        where.append("i.timestamp >= :start")
+        params["start"] = c.start
+    if c.end is not None:
+        where.append("i.timestamp < :end")
+        params["end"] = c.end
+    if c.make is not None:
+        where.append("i.device_make = :make")
+        params["make"] = c.make
+    if c.model is not None:
+        where.append("i.device_model = :model")
+        params["model"] = c.model
+    sql = f"SELECT i.id, i.path FROM image i WHERE {' AND '.join(where)} ORDER BY i.id LIMIT :limit"
+    return sql, params
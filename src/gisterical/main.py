@@ -1,87 +1,266 @@
+from __future__ import annotations
+
+import os
+import re
+import sys
 import argparse
+import datetime as dt
 from time import time
 from pathlib import Path
-from loguru import logger
-from shutil import copyfile
-
-from gisterical.core.image_metadata import MetadataExtractor
-from gisterical.core.image_paths import get_paths
-from gisterical.core.create_folder_structure import Node, traverse, populate_folder_structure, make_folder
-from gisterical.database.db_api import DbApi
-from gisterical.database.schema import create_schema
-from gisterical.settings.settings import load_settings, update_settings
-from gisterical.util.file_meta import FileMeta
-
-
-SETTINGS = load_settings()
-api = DbApi()
-parser = argparse.ArgumentParser(
-    description="Sort images based on date and/or location using a local PostGIS database to store metadata.",
-)
-
-# give option of using either a long or short labels
-inp = parser.add_mutually_exclusive_group(required=False)
-out = parser.add_mutually_exclusive_group(required=False)
-nam = parser.add_mutually_exclusive_group(required=False)
-
-parser.add_argument(
-    "--set-connection", 
-    action="store_true", 
-    help="Perform intial setup", 
-    default=False, 
-    required=False
-)
-parser.add_argument(
-    "--setup", 
-    action="store_true", 
-    help="Perform intial setup", 
-    default=False, 
-    required=False
-)
-parser.add_argument(
-    "--add-folder", 
-    action="store_true", 
-    help="Add photos to the database. Input folder has to be provided.",
-    default=False,
-    required=False
-)
-parser.add_argument(
-    "--sort",
-    action="store",
-    type=str,
-    help="Sort images and output to a folder",
-    nargs="+",
-    default=False, 
-    required=False
-)
-
-inp.add_argument("--input", action="store", type=str, help="Input folder for initial setup")
-inp.add_argument("-i", action="store", type=str, help="Input folder for initial setup")
-
-out.add_argument("--output", action="store", type=str, help="Output folder for sorting and search operations")
-out.add_argument("-o", action="store", type=str, help="Output folder for sorting and search operations")
-
-parser.add_argument("--find-by-city", action="store", type=str, 
-                    help="Find photos taken within certain distance from a specific city and output to target folder. " 
-                    "Output folder, city name, and distance parameters have to be provided.")
-parser.add_argument("--find-by-country", action="store", type=str, 
-                    help="Find photos taken within a country and output to target folder. "
-                    "Country name and output folder parameters need to be provided.")
-nam.add_argument("--name", action="store", type=str, help="A city or country name to search in photos.")
-nam.add_argument("-n", action="store", type=str, help="A city or country name to search in photos.")
-
-parser.add_argument("--distance", action="store", type=int, help="Maximum match distance to between a photo location and a city.")
- 
-parser.add_argument(
-    "--hash",
-    help="Calculate image hashes during setup and store in the database",
-    action="store_true",
-)
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+from gisterical import registry
+from gisterical.database.city_policy import CITY_POLICIES
+from gisterical.util.link_modes import LINK_MODES
+
+if TYPE_CHECKING:
+    from gisterical.core.copy_engine import CopyEngine
+    from gisterical.util.file_meta import FileMeta
+
+
+def _floats(n: int) -> Callable[[str], tuple[float, ...]]:
+    def parse(value: str) -> tuple[float, ...]:
+        try:
+            parts = tuple(float(v) for v in value.split(","))
+        except ValueError:
+            parts = ()
+        if len(parts) != n:
+            raise argparse.ArgumentTypeError(f"expected {n} comma separated numbers, got '{value}'")
+        return parts
+
+    return parse
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Command line parser. Only modules needed to describe the options are
+    imported here, everything else is imported by the task that uses it so
+    that ``--help`` stays fast.
+    """
+    parser = argparse.ArgumentParser(
+        prog="gisterical",
+        description="Sort images based on date and/or location using a local PostGIS database to store metadata.",
+    )
 
-args = parser.parse_args()
+    # give option of using either a long or short labels
+    inp = parser.add_mutually_exclusive_group(required=False)
+    out = parser.add_mutually_exclusive_group(required=False)
+    nam = parser.add_mutually_exclusive_group(required=False)
 
+    parser.add_argument(
+        "--set-connection", 
+        action="store_true", 
+        help="Perform intial setup", 
+        default=False, 
+        required=False
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run as a daemon keeping database connections and caches warm. Other gisterical commands "
+        "are forwarded to it while it runs.",
+    )
+    parser.add_argument(
+        "--socket",
+        action="store",
+        type=str,
+        help="Unix socket of the daemon, by default gisterical.sock in $XDG_RUNTIME_DIR.",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Run the command in this process even if a daemon is running.",
+    )
+    parser.add_argument(
+        "--setup", 
+        action="store_true", 
+        help="Perform intial setup", 
+        default=False, 
+        required=False
+    )
+    parser.add_argument(
+        "--add-folder", 
+        action="store_true", 
+        help="Add photos to the database. Input folder has to be provided.",
+        default=False,
+        required=False
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="When adding a folder, also remove images under it that no longer exist on disk.",
+        default=False,
+        required=False
+    )
+    parser.add_argument(
+        "--sort",
+        action="store",
+        type=str,
+        help="Sort images and output to a folder",
+        nargs="+",
+        default=False, 
+        required=False
+    )
 
-def perform_initial_setup(source_folder: str):
+    inp.add_argument("--input", action="store", type=str, help="Input folder for initial setup")
+    inp.add_argument("-i", action="store", type=str, help="Input folder for initial setup")
+
+    out.add_argument("--output", action="store", type=str, help="Output folder for sorting and search operations")
+    out.add_argument("-o", action="store", type=str, help="Output folder for sorting and search operations")
+
+    parser.add_argument("--find-by-city", action="store", type=str, 
+                        help="Find photos taken within certain distance from a specific city and output to target folder. " 
+                        "Output folder, city name, and distance parameters have to be provided.")
+    parser.add_argument("--find-by-country", action="store", type=str, 
+                        help="Find photos taken within a country and output to target folder. "
+                        "Country name and output folder parameters need to be provided.")
+    parser.add_argument(
+        "--search",
+        action="store_true",
+        help="Find photos meeting all of --city, --country, --near, --bbox, --track, --start-date, --end-date, "
+        "--make and --model that are given. Photos are copied to the output folder, or their paths printed without one.",
+    )
+    parser.add_argument("--city", action="store", type=str, help="Search near a city, within --distance.")
+    parser.add_argument("--country", action="store", type=str, help="Search photos taken in a country.")
+    parser.add_argument(
+        "--near",
+        action="store",
+        type=_floats(2),
+        metavar="LAT,LON",
+        help="Search near a point, within --distance.",
+    )
+    parser.add_argument(
+        "--bbox",
+        action="store",
+        type=_floats(4),
+        metavar="WEST,SOUTH,EAST,NORTH",
+        help="Search within a longitude and latitude box.",
+    )
+    parser.add_argument(
+        "--track",
+        action="store",
+        type=str,
+        metavar="FILE",
+        help="Search along the tracks and routes of a GPX file, or the lines and polygons of a GeoJSON file.",
+    )
+    parser.add_argument(
+        "--track-distance",
+        action="store",
+        type=float,
+        default=100,
+        help="Distance from the --track in metres.",
+    )
+    parser.add_argument(
+        "--track-time",
+        action="store_true",
+        help="Only find photos taken while the --track was recorded, unless --start-date or --end-date are given.",
+    )
+    parser.add_argument(
+        "--start-date", action="store", type=dt.date.fromisoformat, help="Search photos taken on or after a date."
+    )
+    parser.add_argument(
+        "--end-date", action="store", type=dt.date.fromisoformat, help="Search photos taken on or before a date."
+    )
+    parser.add_argument("--make", action="store", type=str, help="Search photos taken with a camera make.")
+    parser.add_argument("--model", action="store", type=str, help="Search photos taken with a camera model.")
+    parser.add_argument(
+        "--page-size",
+        action="store",
+        type=int,
+        default=1000,
+        help="Number of search results read from the database at a time.",
+    )
+    nam.add_argument("--name", action="store", type=str, help="A city or country name to search in photos.")
+    nam.add_argument("-n", action="store", type=str, help="A city or country name to search in photos.")
+
+    parser.add_argument("--distance", action="store", type=int, help="Maximum match distance to between a photo location and a city.")
+    parser.add_argument(
+        "--city-policy",
+        action="store",
+        choices=CITY_POLICIES,
+        default="nearest",
+        help="City used when sorting by city if several are within the distance: the nearest or the most populous one.",
+    )
+    parser.add_argument(
+        "--copy-threads",
+        action="store",
+        type=int,
+        default=2,
+        help="Number of files copied at the same time between every pair of source and target drives.",
+    )
+    parser.add_argument(
+        "--link-mode",
+        action="store",
+        choices=LINK_MODES,
+        default="copy",
+        help="How files are placed in the output folder when sorting or searching: copied, hard linked, "
+        "reflinked (copy-on-write clone), symlinked or moved. Links fall back to copies across drives.",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Read copied files back and compare them with a checksum of the original calculated while copying.",
+    )
+    parser.add_argument(
+        "--columnar",
+        help="Group images for sorting in NumPy arrays instead of Python objects, using less memory for large libraries",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--geocoder",
+        action="store",
+        choices=("postgis", "offline"),
+        default="postgis",
+        help="Find cities and countries for sorting in the database or with an in-process geocoder built from the same data files.",
+    )
+
+    parser.add_argument(
+        "--hash",
+        help="Calculate image hashes during setup and store in the database",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--hash-backfill",
+        help="Calculate hashes for images already in the database that don't have them yet",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--find-duplicates",
+        help="Report groups of near-duplicate images using the stored perceptual hashes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-distance",
+        action="store",
+        type=int,
+        default=4,
+        help="Maximum Hamming distance between perceptual hashes of near-duplicate images.",
+    )
+    parser.add_argument(
+        "--jobs",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of worker processes used to extract image metadata and calculate hashes.",
+    )
+    parser.add_argument(
+        "--scan-threads",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of threads scanning directories for images, useful on network filesystems.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        action="store",
+        type=int,
+        default=1000,
+        help="Number of images written to the database per transaction during setup or when adding folders.",
+    )
+
+    return parser
+
+
+def perform_initial_setup(source_folder: str, input_args: argparse.Namespace):
     """Perform initial set-up of the database for which we create 
     the base schema, extract the necessary metadata extracted from images,
     and populate image data along with the country and city data into
@@ -89,15 +268,30 @@ def perform_initial_setup(source_folder: str):
 
     Args:
         source_folder (str): A string of the source folder containing images.
+        input_args (argparse.Namespace): A Namespace object with input arguments.
     """
-    do_hash = bool(args.hash)
+    from gisterical.core.pipeline import IngestPipeline
+    from gisterical.database.schema import create_schema
+
+    do_hash = bool(input_args.hash)
     create_schema()
-    p = get_paths([source_folder])
-    meta = MetadataExtractor(p, hash_images=do_hash)
-    api.add_photo_to_db(meta.metadata)
+    IngestPipeline(
+        registry.api(),
+        hash_images=do_hash,
+        jobs=input_args.jobs,
+        batch_size=input_args.batch_size,
+        scan_workers=input_args.scan_threads,
+    ).run([source_folder])
+
 
+def _sort_flags(values: list[str]) -> list[str]:
+    # "YmC" or "Y m C", a geohash flag carries its precision: "Yg5" or "Y g5"
+    if len(values) != 1:
+        return values
+    return re.findall(r"g\d*|.", values[0])
 
-def check_flags(args: argparse.Namespace) -> tuple[list[str], int, Path]:
+
+def check_flags(args: argparse.Namespace) -> tuple[list[str], int, Path, int | None]:
     """Check positional flags and validate.
 
     Args:
@@ -105,14 +299,21 @@ def check_flags(args: argparse.Namespace) -> tuple[list[str], int, Path]:
 
     Raises:
         ValueError: raised if unrecognised arguments are passed; output folder is missing;
-            distance argument not present when "c" flag is included.
+            distance argument not present when "c" flag is included; the geohash flag
+            is repeated or its precision is missing or out of range.
 
     Returns:
-        tuple[list[str], int, Path]: A tuple consisting of a list of individual positional params, 
-            integer of distance to find nearest city in kilometres and the output path.
+        tuple[list[str], int, Path, int | None]: A tuple consisting of a list of individual
+            positional params, integer of distance to find nearest city in kilometres, the
+            output path and the geohash precision of the "g" flag.
     """
-    inp = list(args.sort[0]) if len(args.sort) == 1 else args.sort
-    v = set(inp).intersection({'C', 'c', 'Y', 'm', 'd'})
+    from gisterical.util.geohash import MAX_PRECISION
+    from loguru import logger
+
+    inp = _sort_flags(args.sort)
+    cells = [f for f in inp if re.fullmatch(r"g\d+", f)]
+    inp = ["g" if f in cells else f for f in inp]
+    v = set(inp).intersection({'C', 'c', 'Y', 'm', 'd', 'g'})
 
     if not args.output and not args.o:
         raise ValueError('Output folder parameter required when sorting!')
@@ -121,17 +322,51 @@ def check_flags(args: argparse.Namespace) -> tuple[list[str], int, Path]:
 
     if len(v) != len(inp):
         logger.exception(f'Some of the input arguments {inp} not recognised. '
-                        f'Accepted flags are "C", "c", "Y", "m" and "d".')
+                        f'Accepted flags are "C", "c", "Y", "m", "d" and "g<precision>".')
         raise ValueError('Positional arguments not recognised!')
     if "c" in inp and not args.distance:
         raise ValueError("Distance argument (--distance) required when sorting by city.")
-    return inp, args.distance , pth 
+    precision = int(cells[0][1:]) if cells else None
+    if "g" in inp and (precision is None or not 1 <= precision <= MAX_PRECISION):
+        raise ValueError(f"Geohash precision has to be between 1 and {MAX_PRECISION}, e.g. g5.")
+    return inp, args.distance, pth, precision
+
+
+def _sort_rows(input_args: argparse.Namespace) -> tuple[Path, Iterator[tuple], list[str]]:
+    """Parse positional flags used for sorting and stream the data necessary
+    to build a tree-like folder structure from the database.
+
+    Args:
+        input_args (argparse.Namespace): A Namespace object with input arguments.
+
+    Returns:
+        tuple[Path, Iterator[tuple], list[str]]: A tuple consisting of the output path location,
+            an iterator of (path, date, country, city, geohash) rows and the list of validated
+            sorting flags.
+    """
+    sorted_flags, distance, out_path, precision = check_flags(input_args)
+    api = registry.api()
+    if input_args.geocoder == "offline":
+        from gisterical.core.reverse_geocoder import OfflineLocations
+
+        locations = OfflineLocations(api, registry.geocoder())
+    else:
+        locations = api
+    if {"C", "c"}.intersection(sorted_flags):
+        # picks up images added before the location cache existed
+        locations.resolve_locations()
+    rows = locations.iter_sort_rows(
+        countries="C" in sorted_flags,
+        cities="c" in sorted_flags,
+        distance_km=distance,
+        policy=input_args.city_policy,
+        geohash_precision=precision,
+    )
+    return out_path, rows, sorted_flags
 
 
 def _parse_positional_args(input_args: argparse.Namespace) -> tuple[Path, list[FileMeta], list[str]]:
-    """Parse positional flags used for sorting and decide which specific
-    database api method to run to get the data necessary to build a tree-like
-    folder structure.
+    """Same as ``_sort_rows`` with the rows turned into FileMeta objects.
 
     Args:
         input_args (argparse.Namespace): A Namespace object with input arguments.
@@ -141,27 +376,10 @@ def _parse_positional_args(input_args: argparse.Namespace) -> tuple[Path, list[F
             a list of FileMeta objects representing required file metadata and the list of
             validated sorting flags.
     """
-    sorted_flags, distance, out_path = check_flags(input_args) 
-    if len({"C", "c"}.intersection(sorted_flags)) == 2:
-        # a lot of photos don't have location data but often you'd still want
-        # to sort them by date. If you do a spatial join then these photos will
-        # be missed so we run another query on the db where we extract all
-        # photos with missing location information. This is computationally
-        # very cheap so there's little benefit to not doing this.
-        data_mis = api.get_photo_no_location()
-        data_loc = api.get_photo_city_country(distance)
-        data = data_loc + data_mis
-    elif "c" in sorted_flags:
-        data_mis = api.get_photo_no_location()
-        data_loc = api.get_photos_by_city(distance)
-        data = data_loc + data_mis
-    elif "C" in sorted_flags:
-        data_mis = api.get_photo_no_location()
-        data_loc = api.get_photo_country()
-        data = data_mis + data_loc
-    else:
-        data = api.get_photo_path_date()
-    return out_path, data, sorted_flags
+    from gisterical.util.file_meta import FileMeta
+
+    out_path, rows, sorted_flags = _sort_rows(input_args)
+    return out_path, [FileMeta.from_row(r) for r in rows], sorted_flags
 
 
 def run_sort_task(input_args: argparse.Namespace):
@@ -169,29 +387,82 @@ def run_sort_task(input_args: argparse.Namespace):
     get the required data, then using metadata extracted from db
     build an m-ary tree of folder structure, traverse the tree to
     build the dataset and finally create necessary folders and
-    move files to new locations.
+    move files to new locations. With ``--columnar`` the rows are
+    grouped as NumPy arrays instead of FileMeta objects.
 
     Args:
         input_args (argparse.Namespace): A Namespace object with input arguments.
     """
-    out_path, data, sorted_flags = _parse_positional_args(input_args)    
-    n = Node(out_path, data, sorted_flags)
-    tree = traverse(n)
+    from gisterical.core.create_folder_structure import Node, traverse, populate_folder_structure, make_folder
+
+    if input_args.columnar:
+        from gisterical.core.columnar import ColumnarMetadata, sort_plan
+
+        out_path, rows, sorted_flags = _sort_rows(input_args)
+        tree = sort_plan(ColumnarMetadata.from_rows(rows), out_path, sorted_flags)
+    else:
+        out_path, data, sorted_flags = _parse_positional_args(input_args)    
+        n = Node(out_path, data, sorted_flags)
+        tree = traverse(n)
         
     for leaf in tree:
         make_folder(leaf)
     
-    populate_folder_structure(tree)  
+    engine = _copy_engine(input_args, out_path)
+    populate_folder_structure(tree, engine)  
+    _record_moves(engine)
  
  
-def copy_files(paths: list[Path], target_folder: Path):
+def _copy_engine(input_args: argparse.Namespace, out_path: Path) -> CopyEngine:
+    from gisterical.core.copy_engine import CopyEngine
+    from gisterical.core.sort_journal import SortJournal
+    from gisterical.util.file_ops import placer
+
+    return CopyEngine(
+        per_device=input_args.copy_threads,
+        copy=placer(input_args.link_mode, input_args.verify),
+        keep_done=input_args.link_mode == "move",
+        journal=SortJournal(out_path, input_args.link_mode),
+    )
+
+
+def _record_moves(engine: CopyEngine):
+    # moved files are no longer at the paths stored in the database
+    if engine.keep_done and engine.done:
+        registry.api().update_paths([(str(src), os.path.abspath(dst)) for src, dst in engine.done])
+
+
+def copy_files(paths: Iterable[Path], target_folder: Path, input_args: argparse.Namespace):
+    from gisterical.core.create_folder_structure import make_folder
+    from gisterical.core.sort_journal import resolve_collisions
+
     if not target_folder.exists():
         make_folder(target_folder)
-    for f in paths:
-        target_file = target_folder / f.name
-        copyfile(str(f), str(target_file))  
+    engine = _copy_engine(input_args, target_folder)
+    engine.run(resolve_collisions(((f, target_folder / f.name) for f in paths), engine.journal))
+    _record_moves(engine)
         
 
+def find_duplicates(max_distance: int):
+    """Find clusters of near-duplicate images among hashed images
+    and log their paths.
+
+    Args:
+        max_distance (int): Maximum Hamming distance between perceptual hashes.
+    """
+    from loguru import logger
+
+    from gisterical.core.duplicates import LibraryHashes
+
+    # kept by a running daemon, so later runs only index new images
+    hashes = registry.get("library_hashes", LibraryHashes)
+    hashes.refresh(registry.api())
+    clusters = hashes.index.clusters(max_distance)
+    logger.info(f"Found {len(clusters)} groups of near-duplicates among {len(hashes.index)} hashed images.")
+    for c in clusters:
+        logger.info("Near-duplicates:\n" + "\n".join(hashes.paths[i] for i in c))
+
+
 def _validate_search_inputs(args: argparse.Namespace) -> Path:
     if not args.output and not args.o:
         raise ValueError('Output folder must be provided for search operations.')
@@ -202,29 +473,160 @@ def _validate_search_inputs(args: argparse.Namespace) -> Path:
     return out
     
         
-def main():   
+def run_search(input_args: argparse.Namespace):
+    """Find photos meeting all the given search criteria and copy them to
+    the output folder, or print their paths a page at a time when there is
+    no output folder.
+
+    Args:
+        input_args (argparse.Namespace): A Namespace object with input arguments.
+    """
+    from loguru import logger
+
+    from gisterical.database.search import SearchCriteria
+
+    a = input_args
+    start = dt.datetime.combine(a.start_date, dt.time()) if a.start_date else None
+    end = dt.datetime.combine(a.end_date + dt.timedelta(days=1), dt.time()) if a.end_date else None
+    track, track_distance = None, None
+    if a.track:
+        from gisterical.core.tracks import read_track
+
+        t = read_track(a.track)
+        track, track_distance = t.query_geometry(a.track_distance)
+        logger.info(f"Searching within {track_distance:.0f} m of {t.vertices} track vertices.")
+        if a.track_time and start is None and end is None:
+            if t.start is None:
+                raise ValueError(f"{a.track} has no times to search within.")
+            # EXIF times have whole seconds
+            start, end = t.start.replace(microsecond=0), t.end + dt.timedelta(seconds=1)
+    criteria = SearchCriteria(
+        city=a.city,
+        country=a.country,
+        point=a.near,
+        distance_km=a.distance,
+        bbox=a.bbox,
+        start=start,
+        end=end,
+        make=a.make,
+        model=a.model,
+        track=track,
+        track_distance_m=track_distance,
+    )
+    api = registry.api()
+    if criteria.country is not None:
+        api.resolve_locations()
+    pages = api.search(criteria, page_size=a.page_size)
+
+    out = a.output or a.o
+    if out:
+        copy_files((p for page in pages for p in page), Path(out), a)
+        return
+    found = 0
+    for page in pages:
+        print("\n".join(map(str, page)), flush=True)
+        found += len(page)
+    logger.info(f"Found {found} photos.")
+
+
+def _upgrade_schema():
+    from gisterical.database.schema import upgrade_schema
+
+    # once per process, a daemon doesn't check the schema for every command
+    registry.get("schema", upgrade_schema)
+
+
+def main(argv: list[str] | None = None):
+    """Run a command, in the daemon if one is running and the command can
+    be forwarded to it.
+
+    Args:
+        argv (list[str] | None, optional): Command line arguments. Defaults to ``sys.argv[1:]``.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    args = build_parser().parse_args(argv)
+    if args.serve:
+        from gisterical.daemon import serve
+
+        return serve(lambda a: run(build_parser().parse_args(a)), args.socket)
+    if not (args.no_daemon or args.set_connection):
+        from gisterical.daemon import forward
+
+        code = forward(argv, args.socket)
+        if code is not None:
+            if code:
+                sys.exit(code)
+            return
+    run(args)
+    if args.no_daemon or args.set_connection:
+        from loguru import logger
+
+        from gisterical.daemon import notify
+
+        # a running daemon would keep the old connection or cached results
+        # from before the changes made by this command
+        if notify("reload" if args.set_connection else "clear-cache", args.socket):
+            logger.info("Updated the running daemon.")
+
+
+def run(args: argparse.Namespace):
+    """Run a command in this process.
+
+    Args:
+        args (argparse.Namespace): A Namespace object with input arguments.
+    """
+    from loguru import logger
+
     t = time() 
     if args.set_connection:
+        from gisterical.settings.settings import update_settings
+
         update_settings()
+        registry.reset()
     elif args.setup and (args.input or args.i):
-        perform_initial_setup(args.input or args.i)
+        perform_initial_setup(args.input or args.i, args)
+        # cities and countries are reloaded without going through the api
+        registry.api().clear_cache()
     elif args.sort:
+        _upgrade_schema()
         run_sort_task(args)
+    elif args.search:
+        _upgrade_schema()
+        run_search(args)
     elif args.find_by_city:
         out = _validate_search_inputs(args)
-        paths = api.find_photos_by_city_name(args.distance, args.find_by_city)
-        copy_files(paths, out)
+        _upgrade_schema()
+        paths = registry.api().find_photos_by_city_name(args.distance, args.find_by_city)
+        copy_files(paths, out, args)
     elif args.find_by_country:
         out = _validate_search_inputs(args)
-        paths = api.find_photos_by_country_name(args.find_by_country)
-        copy_files(paths, out)       
+        _upgrade_schema()
+        registry.api().resolve_locations()
+        paths = registry.api().find_photos_by_country_name(args.find_by_country)
+        copy_files(paths, out, args)       
+    elif args.find_duplicates:
+        _upgrade_schema()
+        find_duplicates(args.max_distance)
+    elif args.hash_backfill:
+        from gisterical.core.pipeline import backfill_hashes
+
+        _upgrade_schema()
+        backfill_hashes(registry.api(), jobs=args.jobs, batch_size=args.batch_size)
     elif args.add_folder:
+        from gisterical.core.pipeline import IngestPipeline
+
         if not args.input and not args.i:
             raise ValueError("Input folder must be provided.")
         fol = args.input or args.i
-        p = get_paths([fol])
-        meta = MetadataExtractor(p, hash_images=args.hash)
-        api.add_photo_to_db(meta.metadata)
+        _upgrade_schema()
+        IngestPipeline(
+            registry.api(),
+            hash_images=args.hash,
+            jobs=args.jobs,
+            batch_size=args.batch_size,
+            prune=args.prune,
+            scan_workers=args.scan_threads,
+        ).run([fol])
     logger.info(f'Successfully completed in {time() - t} seconds.')        
 
 
@@ -0,0 +1,150 @@
+"""Objects shared by the whole application, created the first time they are
+used rather than when their modules are imported.
+
+Settings, the database engine, the ``DbApi`` used by the command line and
+the offline geocoder live here, so that running ``gisterical --help`` or
+``--set-connection`` doesn't read the settings, connect to the database or
+import SQLAlchemy, and every module that needs them gets the same
+instances. A long running ``--serve`` process keeps them between commands.
+"""
+from __future__ import annotations
+
+import threading
+from typing import TYPE_CHECKING, Callable, TypeVar
+
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.orm import sessionmaker
+
+    from gisterical.core.reverse_geocoder import ReverseGeocoder
+    from gisterical.database.db_api import DbApi
+    from gisterical.settings.settings import Settings
+
+
+T = TypeVar("T")
+
+_lock = threading.RLock()
+_objects: dict[str, object] = {}
+
+
+def get(name: str, factory: Callable[[], T]) -> T:
+    """Shared object ``name``, created by calling ``factory`` the first time."""
+    try:
+        return _objects[name]
+    except KeyError:
+        pass
+    with _lock:
+        if name not in _objects:
+            _objects[name] = factory()
+        return _objects[name]
+
+
+def register(name: str, obj: object):
+    """Use ``obj`` as the shared object ``name`` from now on."""
+    with _lock:
+        _objects[name] = obj
+
+
+def _load_settings() -> Settings:
+    from gisterical.settings.settings import load_settings
+
+    return load_settings()
+
+
+def _create_engine() -> Engine:
+    from sqlalchemy import create_engine
+
+    return create_engine(settings().conn_str)
+
+
+def _create_session() -> sessionmaker:
+    from sqlalchemy.orm import sessionmaker
+
+    return sessionmaker(engine())
+
+
+def _create_api() -> DbApi:
+    from gisterical.database.db_api import DbApi
+
+    return DbApi()
+
+
+def _load_geocoder() -> ReverseGeocoder:
+    from gisterical.core.reverse_geocoder import ReverseGeocoder
+
+    return ReverseGeocoder.load()
+
+
+def settings() -> Settings:
+    return get("settings", _load_settings)
+
+
+def engine() -> Engine:
+    return get("engine", _create_engine)
+
+
+def session() -> sessionmaker:
+    return get("session", _create_session)
+
+
+def api() -> DbApi:
+    return get("api", _create_api)
+
+
+def geocoder() -> ReverseGeocoder:
+    return get("geocoder", _load_geocoder)
+
+
+def reset():
+    """Forget every object, e.g. after the connection settings changed, closing
+    the connections of the engine."""
+    with _lock:
+        eng = _objects.pop("engine", None)
+        _objects.clear()
+    if eng is not None:
+        eng.dispose()
+
+
+if __name__ == "__main__":
+    # guard the start-up time of the command line against regressions:
+    # python -m gisterical.registry [runs] [budget in ms, default 75]
+    import sys
+    import time
+    import statistics
+    import subprocess
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else 75.0
+    heavy = (
+        "sqlalchemy", "geoalchemy2", "psycopg2", "numpy", "scipy", "PIL", "imagehash", "exif", "attrs", "loguru"
+    )
+
+    def timed(code: str) -> float:
+        times = []
+        for _ in range(runs):
+            t = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=False, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - t)
+        return statistics.median(times) * 1000
+
+    interpreter = timed("pass")
+    cli = timed("from gisterical.main import main; main(['--help'])")
+    print(f"python startup: {interpreter:.0f} ms, gisterical --help: {cli:.0f} ms (+{cli - interpreter:.0f} ms)")
+
+    loaded = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; from gisterical.main import build_parser; build_parser(); print(' '.join(sys.modules))",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    imported = sorted({m.split(".")[0] for m in loaded}.intersection(heavy))
+    if imported:
+        print(f"Imported at start-up: {', '.join(imported)}")
+    if cli - interpreter > budget:
+        print(f"Start-up is over the budget of {budget:.0f} ms.")
+    if imported or cli - interpreter > budget:
+        sys.exit(1)
@@ -4,6 +4,8 @@ from pathlib import Path
 from attrs import define
 
 
+SETTINGS_PATH = Path(__file__).parent / "settings.json"
+
 @define
 class Settings:
     conn_str: str
@@ -12,7 +14,7 @@ class Settings:
 
 
 def load_settings() -> Settings:
-    with open(Path().resolve() / "src/gisterical/settings/settings.json", "r") as f:
+    with open(SETTINGS_PATH, "r") as f:
         s = json.load(f)
         conn_str = f"postgresql+psycopg2://{s['user']}:{s['password']}@{s['hostname']}/{s['database_name']}"
         return Settings(conn_str=conn_str, cities_data=s['cities_data'], countries_data=s['countries_data'])
@@ -30,7 +32,7 @@ def update_settings():
     user = input('Enter user name of database owner: ')
     password = input('Enter password of database owner: ')
 
-    with open(Path().resolve() / "src/gisterical/settings/settings.json", "r") as f:
+    with open(SETTINGS_PATH, "r") as f:
         s = json.load(f)
         
     sett_dict = {
@@ -42,7 +44,7 @@ def update_settings():
         "hostname": host,
     }
     
-    with open(Path().resolve() / "src/gisterical/settings/settings.json", "w") as f:
+    with open(SETTINGS_PATH, "w") as f:
         json.dump(sett_dict, f)
         
 
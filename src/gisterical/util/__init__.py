@@ -1,2 +1,12 @@
-from .decorators import func_time
-from .file_meta import FileMeta
\ No newline at end of file
+def __getattr__(name: str):
+    # imported on first use, so that importing a light module of the package
+    # (e.g. the link modes for the command line) doesn't import loguru
+    if name == "func_time":
+        from .decorators import func_time
+
+        return func_time
+    if name == "FileMeta":
+        from .file_meta import FileMeta
+
+        return FileMeta
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
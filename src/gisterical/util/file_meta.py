@@ -8,4 +8,12 @@ class FileMeta:
     path: str | Path
     date: dt.datetime
     country: str | None = field(default='')
-    city: str | None = field(default='')
\ No newline at end of file
+    city: str | None = field(default='')
+    geohash: str | None = field(default='')
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "FileMeta":
+        """Build from a (path, date, country, city) database row, optionally
+        followed by a geohash."""
+        path, date, country, city, *cell = row
+        return cls(path=Path(path), date=date, country=country, city=city, geohash=cell[0] if cell else '')
@@ -0,0 +1,322 @@
+import os
+import errno
+import shutil
+import hashlib
+import functools
+import contextlib
+from pathlib import Path
+from typing import Callable
+
+from loguru import logger
+
+from gisterical.util.link_modes import LINK_MODES
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+
+# _IOW(0x94, 9, int) from linux/fs.h, clones the extents of one file into another
+FICLONE = 0x40049409
+_FAST_COPY_CHUNK = 64 << 20
+_HASH_CHUNK = 8 << 20
+# copy_file_range/sendfile can't be used for this pair of files
+_NO_KERNEL_COPY = {
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK, errno.EBADF
+}
+
+
+def same_path(src: str | Path, dst: str | Path) -> bool:
+    """Whether the file ``src`` resolves to is ``dst`` itself, rather than
+    another name (a link) of the same file. Replacing ``dst`` would then
+    destroy the source."""
+    dst = os.path.abspath(dst)
+    real_dst = os.path.join(os.path.realpath(os.path.dirname(dst)), os.path.basename(dst))
+    return os.path.realpath(src) == real_dst
+
+
+def _check_distinct(src: str | Path, dst: str | Path) -> None:
+    if same_path(src, dst):
+        raise shutil.SameFileError(f"{src} and {dst} are the same file.")
+
+
+def _detach_target(src: str | Path, dst: str | Path) -> None:
+    # a target left by an earlier symlink or hard link sort shares the
+    # source file, writing into it would truncate the original
+    _check_distinct(src, dst)
+    if os.path.islink(dst) or (os.path.exists(dst) and os.path.samefile(src, dst)):
+        os.unlink(dst)
+
+
+def _advise(fd: int, advice: str, offset: int = 0, length: int = 0) -> None:
+    # only a hint, platforms without posix_fadvise just keep the cache
+    if hasattr(os, "posix_fadvise"):
+        with contextlib.suppress(OSError):
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+
+
+def _drop_cache(fd: int, offset: int = 0, length: int = 0) -> None:
+    # dirty pages are queued for writeback and dropped once written
+    _advise(fd, "POSIX_FADV_DONTNEED", offset, length)
+
+
+def _kernel_copy(fs: int, fd: int, chunk_size: int) -> bool:
+    # copy_file_range, or sendfile where it's not supported (older kernels,
+    # pairs of filesystems), returning False if neither works for the files
+    use_range = hasattr(os, "copy_file_range")
+    offset = 0
+    while True:
+        try:
+            if use_range:
+                n = os.copy_file_range(fs, fd, chunk_size, offset, offset)
+            else:
+                n = os.sendfile(fd, fs, offset, chunk_size)
+        except OSError as e:
+            if offset or e.errno not in _NO_KERNEL_COPY:
+                raise
+            if not use_range:
+                return False
+            use_range = False
+            continue
+        if not n:
+            return True
+        _drop_cache(fs, offset, n)
+        _drop_cache(fd, offset, n)
+        offset += n
+
+
+def _hashing_copy(fs: int, fd: int, chunk_size: int) -> str:
+    h = hashlib.blake2b()
+    buf = bytearray(min(chunk_size, _HASH_CHUNK))
+    view = memoryview(buf)
+    offset = 0
+    with open(fs, "rb", buffering=0, closefd=False) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+            written = 0
+            while written < n:
+                written += os.write(fd, view[written:n])
+            _drop_cache(fs, offset, n)
+            _drop_cache(fd, offset, n)
+            offset += n
+    return h.hexdigest()
+
+
+def _file_digest(path: str | Path) -> str:
+    h = hashlib.blake2b()
+    buf = bytearray(_HASH_CHUNK)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+        _drop_cache(f.fileno())
+    return h.hexdigest()
+
+
+def fast_copy(
+    src: str | Path, dst: str | Path, verify: bool = False, chunk_size: int = _FAST_COPY_CHUNK
+) -> str | None:
+    """Copy a file without filling the page cache and keep its timestamps.
+
+    The data is copied in large chunks by the kernel (``copy_file_range``,
+    or ``sendfile``) and the pages of both files are dropped from the cache
+    as soon as they are no longer needed, so copying many gigabytes doesn't
+    evict everything else in memory. This means the target is flushed to
+    the disk before returning. With ``verify`` the data goes through user
+    space instead, to be hashed in the same pass, and the target is read
+    back from the disk and compared.
+
+    Args:
+        src (str | Path): Source file.
+        dst (str | Path): Target path, replaced if it exists.
+        verify (bool, optional): Check the target against a checksum of the source. Defaults to False.
+        chunk_size (int, optional): Bytes copied at a time. Defaults to 64 MiB.
+
+    Raises:
+        OSError: If the copy fails or the target doesn't match the source. No partial
+            target is left behind.
+
+    Returns:
+        str | None: BLAKE2b digest of the data when verifying.
+    """
+    digest = None
+    with open(src, "rb", buffering=0) as fsrc:
+        fs = fsrc.fileno()
+        st = os.fstat(fs)
+        _advise(fs, "POSIX_FADV_SEQUENTIAL")
+        try:
+            with open(dst, "wb", buffering=0) as fdst:
+                fd = fdst.fileno()
+                if verify or not _kernel_copy(fs, fd, chunk_size):
+                    digest = _hashing_copy(fs, fd, chunk_size)
+                os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+                # the pages of the target can only be dropped once written
+                os.fdatasync(fd)
+                _drop_cache(fd)
+            if verify and _file_digest(dst) != digest:
+                raise OSError(errno.EIO, f"Copy of {src} does not match the original.", str(dst))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(dst)
+            raise
+    return digest if verify else None
+
+
+def copy(src: str | Path, dst: str | Path, verify: bool = False) -> None:
+    _detach_target(src, dst)
+    fast_copy(src, dst, verify=verify)
+
+
+def reflink(src: str | Path, dst: str | Path) -> None:
+    """Make ``dst`` share the data blocks of ``src`` (btrfs, XFS, bcachefs...).
+
+    Raises:
+        OSError: If the filesystem can't clone files or they are on different filesystems.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform.")
+    _detach_target(src, dst)
+    with open(src, "rb") as fs, open(dst, "wb") as fd:
+        try:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        except OSError:
+            fd.close()
+            os.unlink(dst)
+            raise
+        st = os.fstat(fs.fileno())
+        os.utime(fd.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _clone(src: str | Path, dst: str | Path) -> None:
+    # cheapest first, falling back to an ordinary copy (which still lets
+    # the filesystem share blocks through copy_file_range where it can)
+    try:
+        return reflink(src, dst)
+    except shutil.SameFileError:
+        raise
+    except OSError as e:
+        logger.debug(f"reflink {src} -> {dst} failed: {e}")
+    copy(src, dst)
+
+
+def _replacing(link: Callable[[str, str], None], src: str, dst: str) -> None:
+    # links can't overwrite, while copies always replaced existing targets
+    _check_distinct(src, dst)
+    try:
+        link(src, dst)
+    except FileExistsError:
+        os.unlink(dst)
+        link(src, dst)
+
+
+def hardlink(src: str | Path, dst: str | Path) -> None:
+    """Hard link ``dst`` to ``src``, copying when that's not possible (e.g.
+    different devices or a filesystem without hard links)."""
+    try:
+        _replacing(os.link, str(src), str(dst))
+    except shutil.SameFileError:
+        raise
+    except OSError as e:
+        logger.debug(f"hardlink {src} -> {dst} failed: {e}")
+        _clone(src, dst)
+
+
+def symlink(src: str | Path, dst: str | Path) -> None:
+    _replacing(os.symlink, os.path.abspath(src), str(dst))
+
+
+def move(src: str | Path, dst: str | Path) -> None:
+    """Rename ``src`` to ``dst`` on the same device, otherwise copy and
+    delete the source."""
+    _check_distinct(src, dst)
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        _clone(src, dst)
+        shutil.copystat(str(src), str(dst))
+        os.unlink(src)
+
+
+_PLACERS: dict[str, Callable[[str | Path, str | Path], None]] = {
+    "copy": copy,
+    "hardlink": hardlink,
+    "reflink": _clone,
+    "symlink": symlink,
+    "move": move,
+}
+
+
+def placer(mode: str, verify: bool = False) -> Callable[[str | Path, str | Path], None]:
+    """Function putting a file at its target path for a link mode.
+
+    Args:
+        mode (str): One of LINK_MODES.
+        verify (bool, optional): Verify the copies against a checksum of the source, only
+            used by the copy mode. Defaults to False.
+
+    Raises:
+        ValueError: If the mode is unknown.
+
+    Returns:
+        Callable[[str | Path, str | Path], None]: Function taking the source and target paths,
+            raising ``shutil.SameFileError`` instead of replacing a target that is the source.
+    """
+    if mode not in _PLACERS:
+        raise ValueError(f"Unknown link mode '{mode}', expected one of {', '.join(LINK_MODES)}.")
+    if mode == "copy" and verify:
+        return functools.partial(copy, verify=True)
+    return _PLACERS[mode]
+
+
+if __name__ == "__main__":
+    # compare against shutil.copyfile on a set of JPEG sized files:
+    # python -m gisterical.util.file_ops [folder] [files] [MB per file]
+    import sys
+    import time
+    import tempfile
+
+    base = sys.argv[1] if len(sys.argv) > 1 else None
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    size = int(float(sys.argv[3]) * 2**20) if len(sys.argv) > 3 else 6 * 2**20
+
+    def cached_kb() -> int:
+        try:
+            with open("/proc/meminfo") as f:
+                return next(int(line.split()[1]) for line in f if line.startswith("Cached:"))
+        except (OSError, StopIteration):
+            return 0
+
+    def uncache(paths: list[Path]) -> None:
+        os.sync()
+        for p in paths:
+            with open(p, "rb") as f:
+                _drop_cache(f.fileno())
+
+    with tempfile.TemporaryDirectory(dir=base) as tmp:
+        sources = []
+        for i in range(n):
+            p = Path(tmp) / f"IMG_{i:05d}.jpg"
+            p.write_bytes(os.urandom(size))
+            sources.append(p)
+
+        methods = {
+            "shutil.copyfile": lambda s, d: shutil.copyfile(s, d),
+            "fast_copy": fast_copy,
+            "fast_copy verify": lambda s, d: fast_copy(s, d, verify=True),
+        }
+        for name, fn in methods.items():
+            out = Path(tmp) / name.replace(" ", "_").replace(".", "_")
+            out.mkdir()
+            targets = [out / p.name for p in sources]
+            uncache(sources)
+            before = cached_kb()
+            t = time.perf_counter()
+            for s, d in zip(sources, targets):
+                fn(s, d)
+            elapsed = time.perf_counter() - t
+            grown = (cached_kb() - before) / 1024
+            print(f"{name:>18}: {n * size / elapsed / 2**20:7.1f} MB/s, page cache grew by {grown:.0f} MB")
+            uncache(targets)
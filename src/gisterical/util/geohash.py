@@ -0,0 +1,86 @@
+"""Geohash cells of coordinates, the same strings as PostGIS ``ST_GeoHash``.
+
+A geohash interleaves the bits of the longitude and the latitude, so every
+prefix of a hash is a larger cell containing it: 1 character is a cell of
+about 5000 km, 3 characters about 150 km, 5 about 5 km and 7 about 150 m.
+Grouping photos by location is then a matter of cutting hashes to the same
+length.
+"""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+MAX_PRECISION = 12
+# bits per coordinate at the maximum precision, 5 bits per character
+_BITS = MAX_PRECISION * 5 // 2
+
+
+def _spread(v):
+    # put a zero bit between every bit of a 30 bit integer, for Python
+    # integers and arrays of unsigned 64 bit integers alike
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    return (v | (v << 1)) & 0x5555555555555555
+
+
+def _check_precision(precision: int):
+    if not 1 <= precision <= MAX_PRECISION:
+        raise ValueError(f"Geohash precision has to be between 1 and {MAX_PRECISION}, got {precision}.")
+
+
+def encode(lat: float, lon: float, precision: int = MAX_PRECISION) -> str:
+    """Geohash of a point.
+
+    Args:
+        lat (float): Latitude in degrees.
+        lon (float): Longitude in degrees.
+        precision (int, optional): Number of characters. Defaults to 12.
+
+    Raises:
+        ValueError: If the coordinates or the precision are out of range.
+
+    Returns:
+        str: Geohash of the cell containing the point.
+    """
+    _check_precision(precision)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Coordinates ({lat}, {lon}) are out of range.")
+    top = (1 << _BITS) - 1
+    y = min(int((lat + 90) / 180 * (1 << _BITS)), top)
+    x = min(int((lon + 180) / 360 * (1 << _BITS)), top)
+    # the longitude takes the first bit of every pair
+    bits = (_spread(x) << 1) | _spread(y)
+    return "".join(BASE32[(bits >> (55 - 5 * i)) & 31] for i in range(precision))
+
+
+def encode_array(lat: np.ndarray, lon: np.ndarray, precision: int = MAX_PRECISION) -> np.ndarray:
+    """Geohashes of many points at once, see ``encode``. Coordinates out of
+    range are clipped to it.
+
+    Args:
+        lat (np.ndarray): Latitudes in degrees.
+        lon (np.ndarray): Longitudes in degrees.
+        precision (int, optional): Number of characters. Defaults to 12.
+
+    Returns:
+        np.ndarray: Array of geohash strings.
+    """
+    import numpy as np
+
+    _check_precision(precision)
+    top = (1 << _BITS) - 1
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    y = np.clip((lat + 90) / 180 * (1 << _BITS), 0, top).astype(np.uint64)
+    x = np.clip((lon + 180) / 360 * (1 << _BITS), 0, top).astype(np.uint64)
+    bits = (_spread(x) << np.uint64(1)) | _spread(y)
+    shifts = np.arange(55, 55 - 5 * precision, -5, dtype=np.uint64)
+    codes = (bits[:, None] >> shifts) & np.uint64(31)
+    chars = np.frombuffer(BASE32.encode("ascii"), dtype=np.uint8)[codes]
+    return chars.view(f"S{precision}").ravel().astype(str)
@@ -0,0 +1,2 @@
+# ways of putting a file at its target path, see file_ops.placer
+LINK_MODES: tuple[str, ...] = ("copy", "hardlink", "reflink", "symlink", "move")